@@ -22,6 +22,8 @@ class AcceptHelpDialog():
 
         self.accept = True
 
+    def run(self):
+        ''' Shows the dialog, returning when it has been answered '''
         self.window.show_all()
         self.window.run()
 
@@ -40,4 +42,10 @@ class AcceptHelpDialog():
     def isAccept(self):
         return self.accept
 
+    def cancel(self):
+        ''' Closes the dialog as if it was rejected '''
+        debug('Help request was cancelled')
+        self.accept = False
+        self.window.destroy()
+
 
@@ -3,9 +3,12 @@ Set of code that is not dependant on the gui
 '''
 from collections import defaultdict
 from logging import debug, info, warn, error
+import hashlib
+import heapq
 
 import service
 import client
+from catalog import SubjectCatalog
 
 from util import CallbackMixin
 
@@ -17,7 +20,14 @@ HOST = 'localhost'
 #-------------------------------------------------------------------------------
 
 class CascadersData(object):
-    ''' Manages a list of cascaders and provides helpful functions '''
+    '''
+    Manages a list of cascaders and provides helpful functions
+
+    So that filtering doesn't have to look at every cascader, each cascader
+    is given a bit and there are indexes of subject -> bitset and
+    lab -> bitset, where a bitset is an int with the bits of the cascaders
+    set. Filtering is then just anding the bitsets
+    '''
 
     def __init__(self, locator, username):
         '''
@@ -30,9 +40,65 @@ class CascadersData(object):
         self.username = username
         self.cascaders = {}
 
+        #username -> bit, and bit -> username
+        self.bits = {}
+        self.bitUsers = []
+        self.freeBits = []
+
+        #subject -> bitset, lab -> bitset and host -> username
+        self.bySubject = {}
+        self.byLab = {}
+        self.byHost = {}
+        #bitset of the cascaders with any subjects
+        self.withSubjects = 0
+
+        #tables from the server for decoding the hosts and subjects of
+        #cascaders sent as ids, see setWireTables
+        self.wireSubjects = []
+        self.wireHosts = []
+
     def __str__(self):
         return str(self.cascaders)
 
+    def getHostsDigest(self):
+        '''
+        Digest of the hosts the locator knows about, so the server knows if
+        it needs to send its own
+        '''
+        hosts = self.locator.getHosts() if self.locator is not None else []
+        return hashlib.md5('\n'.join(hosts)).hexdigest()
+
+    def setWireTables(self, subjects, hosts=None):
+        '''
+        Sets the tables from the server that are used to decode cascaders
+        sent with the host as an id and the subjects as a bitmask. If hosts
+        is None they are the same as the hosts the locator has
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.setWireTables(['a', 'b', 'c'], ['host1', 'host2'])
+        >>> cd.addCascader('remote', 1, 5)
+        >>> cd.findCascader(username='remote')
+        ('remote', ('host2', set(['a', 'c'])))
+
+        Anything the server doesn't have an id for is sent as it was
+        >>> cd.setCascader('remote', 'unknown', ['d'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('unknown', set(['d'])))
+        '''
+        if hosts is None:
+            hosts = self.locator.getHosts()
+        self.wireSubjects = list(subjects)
+        self.wireHosts = list(hosts)
+
+    def _decode(self, host, subjects):
+        ''' Returns the hostname and set of subjects '''
+        if isinstance(host, int):
+            host = self.wireHosts[host]
+        if isinstance(subjects, (int, long)):
+            subjects = [subject for i, subject in enumerate(self.wireSubjects)
+                        if subjects >> i & 1]
+        return host, set(subjects)
+
     def addCascader(self, username, host, subjects):
         '''
         >>> cd = CascadersData(None, 'me')
@@ -53,18 +119,117 @@ class CascadersData(object):
         >>> cd.findCascader(username='remote')
         ('remote', ('remotehost', set(['a', 'b'])))
         '''
+        host, subjects = self._decode(host, subjects)
         try:
             _, curSubjects = self.cascaders[username]
-            self.cascaders[username] = (host, set(subjects) | curSubjects)
+            self._set(username, host, subjects | curSubjects)
         except KeyError:
-            self.cascaders[username] = (host, set(subjects))
+            self._set(username, host, subjects)
+
+    def setCascader(self, username, host, subjects):
+        '''
+        Sets the host and subjects of a cascader, unlike addCascader this
+        replaces the subjects that are already known
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a', 'b'])
+        >>> cd.setCascader('remote', 'remotehost', ['b'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('remotehost', set(['b'])))
+        '''
+        self._set(username, *self._decode(host, subjects))
+
+    def replaceCascaders(self, cascaders):
+        '''
+        Replaces all the cascaders with the given list of tuples of
+        (username, host, subjects)
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('old', 'oldhost', ['a'])
+        >>> cd.replaceCascaders([('new', 'newhost', ['b'])])
+        >>> cd.findCascader(username='new')
+        ('new', ('newhost', set(['b'])))
+        >>> 'old' in cd.cascaders
+        False
+        '''
+        for username in self.cascaders.keys():
+            self._remove(username)
+        for username, host, subjects in cascaders:
+            self.addCascader(username, host, subjects)
 
     def removeCascader(self, username):
         try:
-            del self.cascaders[username]
+            self._remove(username)
         except KeyError:
             warn('Cascader that left didn\'t exist')
 
+    #--------------------------------------------------------------------------
+    # index maintenance, everything that changes self.cascaders goes here
+
+    def _getBit(self, username):
+        try:
+            return self.bits[username]
+        except KeyError:
+            if self.freeBits:
+                bit = self.freeBits.pop()
+                self.bitUsers[bit] = username
+            else:
+                bit = len(self.bitUsers)
+                self.bitUsers.append(username)
+            self.bits[username] = bit
+            return bit
+
+    def _unindex(self, username):
+        ''' Removes the cascader from the indexes, but not from cascaders '''
+        host, subjects = self.cascaders[username]
+        clear = ~(1 << self.bits[username])
+        for subject in subjects:
+            self._clearBits(self.bySubject, subject, clear)
+        lab = self._labFromHostname(host)
+        if lab is not None:
+            self._clearBits(self.byLab, lab, clear)
+        if self.byHost.get(host) == username:
+            del self.byHost[host]
+        self.withSubjects &= clear
+
+    def _clearBits(self, index, key, clear):
+        bitset = index[key] & clear
+        if bitset:
+            index[key] = bitset
+        else:
+            del index[key]
+
+    def _set(self, username, host, subjects):
+        if username in self.cascaders:
+            self._unindex(username)
+        self.cascaders[username] = (host, subjects)
+
+        mask = 1 << self._getBit(username)
+        for subject in subjects:
+            self.bySubject[subject] = self.bySubject.get(subject, 0) | mask
+        lab = self._labFromHostname(host)
+        if lab is not None:
+            self.byLab[lab] = self.byLab.get(lab, 0) | mask
+        if host is not None:
+            self.byHost[host] = username
+        if subjects:
+            self.withSubjects |= mask
+
+    def _remove(self, username):
+        ''' Raises KeyError if the cascader doesn't exist '''
+        self._unindex(username)
+        del self.cascaders[username]
+        bit = self.bits.pop(username)
+        self.bitUsers[bit] = None
+        self.freeBits.append(bit)
+
+    def _labFromHostname(self, host):
+        if self.locator is None or host is None:
+            return None
+        return self.locator.labFromHostname(host)
+
+    #--------------------------------------------------------------------------
+
     def addCascaderSubjects(self, username, subjects):
         '''
         Adding the same subject again is fine
@@ -82,17 +247,17 @@ class CascadersData(object):
         '''
         try:
             host, curSubjects = self.cascaders[username]
-            self.cascaders[username] = (host, curSubjects | set(subjects))
+            self._set(username, host, curSubjects | set(subjects))
         except KeyError:
             warn('Cascader (%s) that added subjects '
                  'didn\'t exist' % username)
-            self.cascaders[username] = (None, set(subjects))
+            self._set(username, None, set(subjects))
 
     def removeCascaderSubjects(self, username, subjects):
         debug('Cascader %s removed subjects %s' % (username, subjects))
         try: 
             host, curSubjects = self.cascaders[username]
-            self.cascaders[username] = host, curSubjects - set(subjects)
+            self._set(username, host, curSubjects - set(subjects))
         except KeyError:
             warn('Tried to remove subjects from cascader %s, '
                  'prob not cascading' % username)
@@ -104,30 +269,134 @@ class CascadersData(object):
         this will not return any cascaders that are not cascading in 
         any subjects
 
-        TODO really slow, not sure it matters
-
         >>> cd = CascadersData(None, 'me')
         >>> cd.addCascader('remote', 'remotehost', [])
         >>> cd.findCascader(username='remote')
-        '''
-        for user, (cascHost, cascSubjects) in self.cascaders.iteritems():
-            if len(cascSubjects) == 0:
-                continue
-
-            if includeMe == False and user == self.username:
-                continue
 
-            if host and host != cascHost:
-                continue
-
-            if lab and self.locator.labFromHostname(cascHost) != lab:
-                continue
+        >>> cd.addCascader('me', 'myhost', ['a'])
+        >>> cd.addCascader('other', 'otherhost', ['b'])
+        >>> cd.addCascaderSubjects('remote', ['a', 'c'])
+        >>> sorted(u for u, _ in cd.findCascaders(subjects=['a', 'b']))
+        ['other', 'remote']
+        >>> cd.findCascader(host='otherhost', subjects=['b', 'c'])
+        ('other', ('otherhost', set(['b'])))
+        >>> cd.removeCascaderSubjects('remote', ['a', 'c'])
+        >>> list(cd.findCascaders(subjects=['a'], includeMe=True))
+        [('me', ('myhost', set(['a'])))]
+        '''
+        if host:
+            try:
+                bitset = 1 << self.bits[self.byHost[host]]
+            except KeyError:
+                return
+        else:
+            bitset = self.withSubjects
+
+        bitset = self._filter(bitset, lab, subjects, includeMe)
+        while bitset:
+            lowest = bitset & -bitset
+            user = self.bitUsers[lowest.bit_length() - 1]
+            bitset ^= lowest
+            yield user, self.cascaders[user]
+
+    def _filter(self, bitset, lab, subjects, includeMe):
+        ''' Returns the bits of the bitset that match the filters '''
+        bitset &= self.withSubjects
+
+        if not includeMe and self.username in self.bits:
+            bitset &= ~(1 << self.bits[self.username])
+
+        if lab:
+            bitset &= self.byLab.get(lab, 0)
+
+        if subjects:
+            bySubjects = 0
+            for subject in subjects:
+                bySubjects |= self.bySubject.get(subject, 0)
+            bitset &= bySubjects
+        return bitset
+
+    def matches(self, username, lab=None, subjects=None, includeMe=False):
+        '''
+        Checks if the cascader would be found by findCascaders with the
+        same filters
 
-            if (subjects and
-                    len(set(subjects).intersection(set(cascSubjects))) == 0):
-                continue
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a'])
+        >>> cd.matches('remote', subjects=['a']), cd.matches('remote', subjects=['b'])
+        (True, False)
+        >>> cd.matches('unknown')
+        False
+        '''
+        try:
+            bitset = 1 << self.bits[username]
+        except KeyError:
+            return False
+        return bool(self._filter(bitset, lab, subjects, includeMe))
 
-            yield user, (host, cascSubjects)
+    def findNearestCascaders(self, myHost, subjects=None, k=None, lab=None,
+                             seats=None, includeMe=False):
+        '''
+        Returns a list of up to k (or all if k is None) of the cascaders
+        matching the filters, nearest to myHost first. Cascaders in the same
+        lab come first ordered by how many seats away they are, then those
+        in other labs, in the order of the labs. If seats is given then
+        only cascaders within that many seats are returned
+
+        >>> from StringIO import StringIO
+        >>> from labmap import Locator
+        >>> loc = Locator(StringIO('[lab]\\na:0,0\\nb:1,0\\nc:4,0\\n'
+        ...                        '[other]\\nd:0,0\\n'))
+        >>> cd = CascadersData(loc, 'me')
+        >>> for user, host in (('far', 'c'), ('near', 'b'), ('elsewhere', 'd')):
+        ...     cd.addCascader(user, host, ['a'])
+        >>> [u for u, _ in cd.findNearestCascaders('a', ['a'])]
+        ['near', 'far', 'elsewhere']
+        >>> [u for u, _ in cd.findNearestCascaders('a', ['a'], k=1)]
+        ['near']
+        >>> [u for u, _ in cd.findNearestCascaders('a', ['a'], seats=2)]
+        ['near']
+        '''
+        bitset = self._filter(self.withSubjects, lab, subjects, includeMe)
+        found = []
+
+        myLab = self._labFromHostname(myHost)
+        if myLab is not None and lab in (None, myLab):
+            for distance, host in self.locator.hostsByDistance(myHost):
+                if seats is not None and distance > seats:
+                    break
+                username = self.byHost.get(host)
+                if username is None:
+                    continue
+                bit = 1 << self.bits[username]
+                if bitset & bit:
+                    bitset &= ~bit
+                    found.append((username, self.cascaders[username]))
+                    if k is not None and len(found) >= k:
+                        return found
+
+        if seats is not None:
+            return found
+
+        labOrder = dict((l, i) for i, l in
+                        enumerate(self.locator.getLabs() if self.locator else ()))
+        def key(username):
+            host, _ = self.cascaders[username]
+            return (labOrder.get(self._labFromHostname(host), len(labOrder)),
+                    username)
+
+        others = []
+        while bitset:
+            lowest = bitset & -bitset
+            others.append(self.bitUsers[lowest.bit_length() - 1])
+            bitset ^= lowest
+        if k is None:
+            others.sort(key=key)
+        else:
+            others = heapq.nsmallest(k - len(found), others, key=key)
+        found.extend((username, self.cascaders[username])
+                     for username in others)
+        return found
 
     def findCascader(self, username=None, includeMe=False, **kwargs):
         ''' Wrapper around findCascaders, returns the first match or None '''
@@ -143,7 +412,7 @@ class CascadersData(object):
                     return None
                 return username, (host, subjects)
             except KeyError:
-                warn('Couldn\'t find cascader with username: ' % username)
+                warn('Couldn\'t find cascader with username: %s' % username)
                 return None
 
         try:
@@ -162,7 +431,11 @@ class CascaderModel(CallbackMixin):
     using the methods in this class or in the case of calls to the server
     they are added to the deferred result.
     '''
-    def __init__(self, locator, username, hostname):
+    def __init__(self, locator, username, hostname, catalogFilename=None):
+        '''
+        catalogFilename - where the subjects are cached between runs, None
+                          fetches them every time
+        '''
         CallbackMixin.__init__(self)
 
         self.cascaders = CascadersData(locator, username)
@@ -177,14 +450,26 @@ class CascaderModel(CallbackMixin):
         s.registerOnCascaderJoined(self.onCascaderJoined)
         s.registerOnCascaderLeft(self.onCascaderLeft)
 
+        s.registerOnCascadersDelta(self.onCascadersDelta)
+        s.registerOnSubjectCatalogChanged(self.onSubjectCatalogChanged)
+
         s.registerUserAskingForHelp(self.onUserAskingForHelp)
+        s.registerOnHelpRequestCancelled(self.onHelpRequestCancelled)
 
         self.registerOnLogin(self.onLogin)
 
         self.subjects = set()
+        self.catalog = SubjectCatalog(catalogFilename)
         self.cascadeSubjects = set()
         self.cascading = False
 
+        #the (subjects, labs) the server sends events about, None is all
+        self.subscription = (None, None)
+
+        #version of the servers cascader state that we have, so that on
+        #reconnecting we only need what has changed
+        self.cascadersVersion = None
+
         self.username = username
         self.hostname = hostname
 
@@ -211,38 +496,86 @@ class CascaderModel(CallbackMixin):
     def onCascaderAddedSubjects(self, username, subjects):
         debug('Cascader %s added subjects %s' % (username, subjects))
         self.cascaders.addCascaderSubjects(username, subjects)
-        self._callCallbacks('cascaderschanged', self.cascaders)
+        self._cascadersChanged([username])
 
     def onCascaderRemovedSubjects(self, username, subjects):
         debug('Cascader %s removed subjects %s' % (username, subjects))
         self.cascaders.removeCascaderSubjects(username, subjects)
-        self._callCallbacks('cascaderschanged', self.cascaders)
+        self._cascadersChanged([username])
 
     def onCascaderJoined(self, username, hostname, subjects):
         debug('New cascader: (%s, (%s, %s)' % (username,
                                                hostname,
                                                str(subjects)))
         self.cascaders.addCascader(username, hostname, subjects)
-        self._callCallbacks('cascaderschanged', self.cascaders)
+        self._cascadersChanged([username])
 
     def onCascaderLeft(self, username):
         debug('Cascader left: %s' % username)
         self.cascaders.removeCascader(username)
+        self._cascadersChanged([], [username])
+
+    def onCascadersDelta(self, version, changed, left):
+        debug('Cascaders changed: %s, left: %s' % (changed, left))
+        self.cascadersVersion = version
+        for username, hostname, subjects in changed:
+            self.cascaders.setCascader(username, hostname, subjects)
+        for username in left:
+            self.cascaders.removeCascader(username)
+        self._cascadersChanged([username for username, _, _ in changed], left)
+
+    def onSubjectCatalogChanged(self, sinceVersion, version, added, removed):
+        debug('Subjects added: %s, removed: %s' % (added, removed))
+        if sinceVersion == self.catalog.version:
+            self._updateSubjects((version, False, added, removed))
+        else:
+            #we missed a change, so get everything since our version
+            self._refreshSubjects()
+
+        #subjects that were added are sent by name until we have ids for them
+        if self.cascaders.wireSubjects:
+            self._useCompactPresence()
+
+    def _cascadersChanged(self, changed=None, removed=()):
+        '''
+        Tells the callbacks that the cascaders have changed. changed are the
+        usernames of cascaders that were added or updated and removed the
+        ones that were removed. If changed is None then anything could have
+        changed
+        '''
         self._callCallbacks('cascaderschanged', self.cascaders)
+        self._callCallbacks('cascadersdiff', self.cascaders, changed, removed)
 
     def onUserAskingForHelp(self,  helpid, username, host,
                             subject, description):
-        self._callCallbacks('userasking', helpid, username,
-                            host, subject, description)
+        results = self._callCallbacks('userasking', helpid, username,
+                                      host, subject, description)
+        return results[0] if results else (False, '')
+
+    def onHelpRequestCancelled(self, helpid):
+        self._callCallbacks('helpcancelled', helpid)
     #--------------------------------------------------------------------------
     def registerOnCascaderChanged(self, function):
         self._addCallback('cascaderschanged', function)
 
+    def registerOnCascadersDiff(self, function):
+        '''
+        The function is called with the CascadersData, the usernames of the
+        cascaders added or updated and the usernames of the cascaders
+        removed. If the added or updated usernames are None then everything
+        should be assumed to have changed
+        '''
+        self._addCallback('cascadersdiff', function)
+
     def registerOnSubjectChanged(self, function):
         self._addCallback('subjectschanged', function)
 
     def registerOnUserAskingForHelp(self, function):
         self._addCallback('userasking', function)
+
+    def registerOnHelpRequestCancelled(self, function):
+        ''' The function is called with the helpid of the cancelled request '''
+        self._addCallback('helpcancelled', function)
     #--------------------------------------------------------------------------
 
     def connect(self):
@@ -250,33 +583,74 @@ class CascaderModel(CallbackMixin):
         return self.client.connect()
 
     def login(self):
+        '''
+        Logs in, the cascaders are fetched by onLogin which is also called
+        when logging in again after the server was lost
+        '''
         debug('Logging in...')
-        def subject(result):
-            debug('Got subjects from login')
-            self.subjects = set([x for x in result])
+
+        #the cached subjects can be shown before the server answers
+        if self.catalog.subjects and not self.subjects:
+            self.subjects = set(self.catalog.subjects)
             self._callCallbacks('subjectschanged', self.subjects)
 
-        def casc(result):
-            debug('Got cascaders from login: %s' % str(result))
-            for usr, host, sub in result:
-                self.cascaders.addCascader(usr, host, sub)
-            self._callCallbacks('cascaderschanged', self.cascaders)
+        return self.client.login()
 
-        sl = lambda *a: self.client.getSubjectList().addCallback(subject)
-        cl = lambda *a: self.client.getCascaderList().addCallback(casc)
+    def _useCompactPresence(self):
+        ''' Asks for the tables used to decode compact presence '''
+        d = self.client.useCompactPresence(self.cascaders.getHostsDigest())
+        d.addCallback(lambda tables: self.cascaders.setWireTables(*tables))
+        d.addErrCallback(lambda reason: warn('Server can\'t send compact '
+                                             'presence: %s' %
+                                             reason.getErrorMessage()))
+        return d
 
-        d = self.client.login()
-        d.addCallback(cl)
-        d.addCallback(sl)
+    def _fetchCascaders(self):
+        ''' Gets what has changed in the cascaders since our version '''
+        d = self.client.getCascaderList(self.cascadersVersion)
+        d.addCallback(self._updateCascaders)
+        return d
 
+    def _refreshSubjects(self):
+        ''' Checks our copy of the subjects is the same as the servers '''
+        d = self.client.getSubjectCatalog(self.catalog.version)
+        d.addCallback(self._updateSubjects)
         return d
 
+    def _updateSubjects(self, result):
+        ''' Applies the result of getSubjectCatalog '''
+        if not self.catalog.apply(result):
+            debug('Cached subjects are up to date')
+            return
+        debug('Subjects changed')
+        self.subjects = set(self.catalog.subjects)
+        self._callCallbacks('subjectschanged', self.subjects)
+
     def onLogin(self, *a):
         '''
         This tries for force everything to the way it was before
         the server disconnected
         '''
+        #the subjects may have changed since they were cached or while we
+        #were disconnected
+        self._refreshSubjects()
+
+        if self.client.resumed:
+            #the server kept our settings, but we may have missed changes
+            #to the cascaders while disconnected
+            debug('Resumed the session, getting missed cascaders')
+            self._fetchCascaders()
+            return
+
         debug('Now logged in, trying to restore settings')
+        self._useCompactPresence()
+        if self.subscription != (None, None):
+            self.client.subscribe(*self.subscription)
+
+        #if the server restarted our version is unknown to it and we get
+        #all the cascaders, otherwise just what changed while we were away
+        self._fetchCascaders()
+
         if self.isCascading():
             self.startCascading()
         self.addSubjects(self.cascadeSubjects)
@@ -315,6 +689,36 @@ class CascaderModel(CallbackMixin):
 
         callConnect()
 
+    #--------------------------------------------------------------------------
+    def _updateCascaders(self, result):
+        '''
+        Applies the result of getCascaderList, which is either a snapshot
+        of all the cascaders or what has changed since our version
+        '''
+        version, isSnapshot, changed, left = result
+        if isSnapshot:
+            self.cascadersVersion = version
+            self.cascaders.replaceCascaders(changed)
+            self._cascadersChanged()
+        else:
+            self.onCascadersDelta(version, changed, left)
+
+    @_handleServerLost
+    def subscribe(self, subjects=None, labs=None):
+        '''
+        Only get told about cascaders in the given subjects and labs, None
+        meaning all of them. As the current list may hold cascaders that
+        don't match, the whole list is fetched again from the server
+        '''
+        if self.subscription == (subjects, labs):
+            return None
+        self.subscription = (subjects, labs)
+        self.cascadersVersion = None
+        self.client.subscribe(subjects, labs)
+        d = self.client.getCascaderList()
+        d.addCallback(self._updateCascaders)
+        return d
+
     #--------------------------------------------------------------------------
     def isCascading(self):
         return self.cascading
@@ -3,6 +3,8 @@
 '''
 Startup file, responsible for setting up the application and starting the gui
 '''
+import time
+startTime = time.time()
 
 import logging
 import sys
@@ -17,6 +19,8 @@ from twisted.internet import reactor
 import cascaderview
 import dbusutil
 
+importTime = time.time() - startTime
+
 class RaiseableService(dbusutil.DbusService):
     '''Service provides a method of raising the window to dbus'''
     def __init__(self, interface, path, app):
@@ -42,12 +46,21 @@ if __name__ == '__main__':
     parser.add_option('', '--host',
                       help='manually set the host')
 
+    parser.add_option('', '--profile-startup', action='store_true',
+                      dest='profile', default=False,
+                      help='log how long each part of starting up took')
+
     (options, args) = parser.parse_args()
     showWindow = options.noshow is None
     debugEnabled = options.debug is not None
 
     if debugEnabled:
         logging.basicConfig(level=logging.DEBUG, format='%(filename)s(%(lineno)s):%(funcName)s %(message)s')
+    elif options.profile:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if options.profile:
+        logging.info('Startup: imports took %.1fms' % (importTime * 1000))
 
     #we use dbus to ensure that there is only one running instance of the
     #program. When in debug mode there can be more than one instance
@@ -60,7 +73,11 @@ if __name__ == '__main__':
     else:
         win = cascaderview.CascadersFrame(debugEnabled,
                                        show=showWindow,
-                                       host=options.host)
+                                       host=options.host,
+                                       profile=options.profile)
+        if options.profile:
+            logging.info('Startup: ready after %.1fms' %
+                         ((time.time() - startTime) * 1000))
         obj = RaiseableService(interface, path, win)
         reactor.run()
 
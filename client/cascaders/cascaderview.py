@@ -4,9 +4,10 @@ core functionality that the user uses while using the application.
 
 It doesn't handle any functionality outside the frame such as messaging
 '''
-from logging import error, warn, debug
+from logging import error, warn, debug, info
 import os
 import sys
+import time
 import socket
 import signal
 
@@ -23,33 +24,34 @@ import labmap
 import settings
 
 from cascadermodel import CascaderModel
+from catalog import getCatalogFile
 
 from requirements import RequireFunctions
 
-#message boxes
-from accepthelp import AcceptHelpDialog
-from askdialog import AskForHelp
-from messagedialog import MessageDialog
-
-from trayicon import TrayIcon
+#the dialogs and tray icon are imported when they are first used, as the
+#client is started on every login and most of the time they aren't needed
 
 import util
 from util import getComboBoxText, initTreeView, errorDialog
 
 #-------------------------------------------------------------------------------
 class CascadersFrame:
-    def __init__(self, debugEnabled=False, show=True, host=None):
+    def __init__(self, debugEnabled=False, show=True, host=None,
+                 profile=False):
         '''
         Enabling debug does things like disable async so errors are more 
         apparent
 
         show should be true to show the windows by default
+
+        profile logs how long each part of starting up took
         '''
+        started = time.time()
         self.debugEnabled = debugEnabled
 
 
         hosts = os.path.join(os.path.dirname(__file__), 'data', 'hosts')
-        self.locator = labmap.Locator(open(hosts))
+        self.locator = labmap.loadLocator(hosts)
         self.username = self._getUsername()
 
 
@@ -58,12 +60,20 @@ class CascadersFrame:
         else:
             self.hostname = host
 
-        self.model = CascaderModel(self.locator, self.username, self.hostname)
-        self.messageDialog = MessageDialog(self.locator, self.model.getCascaderData())
+        self.model = CascaderModel(self.locator, self.username, self.hostname,
+                                   getCatalogFile())
+        #built when it is first needed, see getMessageDialog
+        self.messageDialog = None
+
+        #username -> TreeIter of the cascaders row in lsCascList
+        self.cascaderRows = {}
+
+        #helpid -> AcceptHelpDialog of the request being asked about
+        self.acceptDialogs = {}
 
         #slightly more sane method of setting things up that uses depency
         #tracking
-        req = RequireFunctions()
+        req = RequireFunctions(timed=profile)
         req.add('gui', self.initGui)
         req.add('tray', self.initTray, ['gui'])
         req.add('map', self.initMap, ['gui'])
@@ -78,6 +88,19 @@ class CascadersFrame:
         if show:
             self.window.show_all()
 
+        if profile:
+            for name, seconds in req.timings:
+                info('Startup: %s took %.1fms' % (name, seconds * 1000))
+            info('Startup: total %.1fms' % ((time.time() - started) * 1000))
+
+    def getMessageDialog(self):
+        ''' Returns the message dialog, creating it the first time '''
+        if self.messageDialog is None:
+            from messagedialog import MessageDialog
+            self.messageDialog = MessageDialog(self.locator,
+                                               self.model.getCascaderData())
+        return self.messageDialog
+
     def askAutostart(self):
         if self.settings['asked_autostart'] == False:
             self.settings['asked_autostart'] = True
@@ -101,6 +124,7 @@ class CascadersFrame:
         icon = os.path.join(os.path.dirname(__file__),
                             'icons',
                             'cascade.ico')
+        from trayicon import TrayIcon
         self.trayIcon = TrayIcon(self, icon)
         self.window.connect('delete-event', lambda w, e: w.hide() or True)
 
@@ -168,9 +192,10 @@ class CascadersFrame:
         '''
         This sets up the service callbacks
         '''
-        self.model.registerOnCascaderChanged(self.updateCascaderLists)
+        self.model.registerOnCascadersDiff(self.onCascadersDiff)
         self.model.registerOnSubjectChanged(self.updateAllSubjects)
         self.model.registerOnUserAskingForHelp(self.onUserAskingForHelp)
+        self.model.registerOnHelpRequestCancelled(self.onHelpRequestCancelled)
 
         self.model.registerOnDisconnected(self.onDisconnect)
         self.model.registerOnConnected(self.onLogin)
@@ -215,8 +240,8 @@ class CascadersFrame:
         toUsername - the username of the remote
         remoteHost - the hostname of the remote
         '''
-        self.messageDialog.addTab(helpid, toUsername,
-                                  self.hostname, remoteHost, isUserCasc)
+        self.getMessageDialog().addTab(helpid, toUsername,
+                                       self.hostname, remoteHost, isUserCasc)
 
         #setup functions to write to the messages from the message dialog to
         #the server
@@ -225,7 +250,7 @@ class CascadersFrame:
                 fromName = toUsername 
             elif fromType == 'server':
                 fromName = 'Server'
-            self.messageDialog.writeMessage(helpid, self.username, message)
+            self.getMessageDialog().writeMessage(helpid, self.username, message)
             
         self.model.registerOnMessgeHandler(helpid, onMessageFromServer)
 
@@ -235,9 +260,9 @@ class CascadersFrame:
             except client.NotConnected:
                 self.onServerLost()
 
-        self.messageDialog.registerMessageCallback(helpid, writeFunction)
+        self.getMessageDialog().registerMessageCallback(helpid, writeFunction)
 
-        self.messageDialog.window.show_all()
+        self.getMessageDialog().window.show_all()
 
     #--------------------------------------------------------------------------
     # Service callback functions, most of these are just simple wrappers
@@ -251,7 +276,13 @@ class CascadersFrame:
         '''
         debug('Help wanted by: %s with host %s' % (username, host))
 
+        from accepthelp import AcceptHelpDialog
         dialog = AcceptHelpDialog(self.window, username, subject, description)
+        self.acceptDialogs[helpid] = dialog
+        try:
+            dialog.run()
+        finally:
+            del self.acceptDialogs[helpid]
 
         #check if user can give help
         if dialog.isAccept():
@@ -262,11 +293,21 @@ class CascadersFrame:
         debug('Help rejected')
         return (False, '')
 
+    def onHelpRequestCancelled(self, helpid):
+        '''
+        Called when the user asking for help stopped waiting for an answer,
+        which closes the dialog asking if help can be given
+        '''
+        dialog = self.acceptDialogs.get(helpid)
+        if dialog is not None:
+            dialog.cancel()
+
 
     #--------------------------------------------------------------------------
     def updateAllSubjects(self, subjects):
         '''
-        Calling this ensures that the gui reflects the current list of subjects
+        Calling this ensures that the gui reflects the current list of subjects,
+        it is only called when they have changed
         '''
         debug('Subjects: %s' % subjects)
 
@@ -274,6 +315,7 @@ class CascadersFrame:
         lst = gtk.ListStore(gobject.TYPE_STRING)
         [lst.append([subject]) for subject in subjects]
         cascCb.set_model(lst)
+        cascCb.clear()
         cell = gtk.CellRendererText()
         cascCb.set_active(0)
         cascCb.pack_start(cell, True)
@@ -284,32 +326,92 @@ class CascadersFrame:
         lst.append(['All'])
         [lst.append([subject]) for subject in subjects]
         cb.set_model(lst)
+        cb.clear()
         cell = gtk.CellRendererText()
         cb.set_active(0)
         cb.pack_start(cell, True)
         cb.add_attribute(cell, 'text', 0)
 
+    def _getListFilters(self):
+        ''' Returns the (lab, subjects) to filter the cascader list on '''
+        cbSubjects = self.builder.get_object('cbFilterSubject')
+        filterSub = getComboBoxText(cbSubjects)
+        filterSub = [filterSub] if filterSub != 'All'  else None
+
+        cbLab = self.builder.get_object('cbFilterLab')
+        filterLab = getComboBoxText(cbLab)
+        filterLab = filterLab if filterLab != 'All' else None
+        return filterLab, filterSub
+
     def updateCascaderLists(self, cascaders):
         '''
         Cleans the list and updates the list of cascaders avaible. Call
         when filters have been changed
         '''
-
+        tv = self.builder.get_object('tvCascList')
         ls = self.builder.get_object('lsCascList')
+
+        _, itr = tv.get_selection().get_selected()
+        selected = ls.get_value(itr, 0) if itr is not None else None
+
         ls.clear()
+        self.cascaderRows = {}
+
+        filterLab, filterSub = self._getListFilters()
+        cascaders = cascaders.findNearestCascaders(self.hostname,
+                                                   lab=filterLab,
+                                                   subjects=filterSub)
+        for username, _ in cascaders:
+            self.cascaderRows[username] = ls.append([username])
+        debug('Updating cascaders from: %s' % str(cascaders))
 
-        cbSubjects = self.builder.get_object('cbFilterSubject')
-        filterSub = getComboBoxText(cbSubjects)
-        filterSub = [filterSub] if filterSub != 'All'  else None
+        if selected in self.cascaderRows:
+            tv.get_selection().select_iter(self.cascaderRows[selected])
 
-        cbLab = self.builder.get_object('cbFilterLab')
-        filterLab = getComboBoxText(cbLab)
-        filterLab = filterLab if filterLab != 'All' else None
+    def onCascadersDiff(self, cascaders, changed, removed):
+        '''
+        Updates just the rows of the cascaders that have changed, so the
+        list isn't redrawn (and the selection lost) on every change. The
+        changed rows are put back where they are in the nearest first order
+        of updateCascaderLists, as a cascader may have moved
+        '''
+        self.map.refresh()
 
-        cascaders = list(cascaders.findCascaders(lab=filterLab,
-                                                 subjects=filterSub))
-        [ls.append([username]) for username, _ in cascaders]
-        debug('Updating cascaders from: %s' % str(cascaders))
+        if changed is None:
+            return self.updateCascaderLists(cascaders)
+
+        tv = self.builder.get_object('tvCascList')
+        ls = self.builder.get_object('lsCascList')
+
+        _, itr = tv.get_selection().get_selected()
+        selected = ls.get_value(itr, 0) if itr is not None else None
+
+        filterLab, filterSub = self._getListFilters()
+        nearest = cascaders.findNearestCascaders(self.hostname,
+                                                 lab=filterLab,
+                                                 subjects=filterSub)
+        ranks = dict((username, rank)
+                     for rank, (username, _) in enumerate(nearest))
+
+        for username in removed:
+            self._removeCascaderRow(ls, username)
+        for username in changed:
+            self._removeCascaderRow(ls, username)
+
+        #the rows that are left are still in order, so inserting the changed
+        #rows nearest first means each goes in after the ones before it
+        for username in sorted((u for u in changed if u in ranks),
+                               key=ranks.get):
+            self.cascaderRows[username] = ls.insert(ranks[username],
+                                                    [username])
+
+        if selected in changed and selected in self.cascaderRows:
+            tv.get_selection().select_iter(self.cascaderRows[selected])
+
+    def _removeCascaderRow(self, ls, username):
+        itr = self.cascaderRows.pop(username, None)
+        if itr is not None:
+            ls.remove(itr)
 
     #--------------------------------------------------------------------------
     # GUI events
@@ -428,6 +530,7 @@ class CascadersFrame:
         subject = None
         if getComboBoxText(self.builder.get_object('cbFilterSubject')) != 'All':
             subject = getComboBoxText(self.builder.get_object('cbFilterSubject'))
+        from askdialog import AskForHelp
         helpDialog = AskForHelp(self.window, cascSubjects, subject)
 
         if helpDialog.isOk():
@@ -436,7 +539,7 @@ class CascadersFrame:
 
             self.setupMessagingWindow(helpid, cascaderUsername, cascHost, False) 
 
-            writeSysMsg = lambda m: self.messageDialog.writeMessage(helpid, 'SYSTEM', m)
+            writeSysMsg = lambda m: self.getMessageDialog().writeMessage(helpid, 'SYSTEM', m)
             writeSysMsg('Waiting for response...')
 
             def onNotConnected(reason):
@@ -490,6 +593,7 @@ class CascadersFrame:
         '''
         debug('Filter Lab Changed')
 
+        self.updateSubscription()
         self.updateCascaderLists(self.model.getCascaderData())
 
         cbLab = self.builder.get_object('cbFilterLab')
@@ -498,15 +602,31 @@ class CascadersFrame:
 
     def onFilterSubjectChange(self, evt):
         debug('Filter Subject Changed')
+        self.updateSubscription()
         self.updateCascaderLists(self.model.getCascaderData())
 
+    def updateSubscription(self):
+        '''
+        Tells the server to only send us the cascaders that match the current
+        filters, so that busy labs the user isn't looking at don't cost
+        anything
+        '''
+        filterSub = getComboBoxText(self.builder.get_object('cbFilterSubject'))
+        filterSub = [filterSub] if filterSub not in ('All', None) else None
+
+        filterLab = getComboBoxText(self.builder.get_object('cbFilterLab'))
+        filterLab = [filterLab] if filterLab not in ('All', None) else None
+
+        self.model.subscribe(filterSub, filterLab)
+
     def updateMap(self, lab):
         cbSubjects = self.builder.get_object('cbFilterSubject')
         filterSub = getComboBoxText(cbSubjects)
         filterSub = [filterSub] if filterSub != 'All'  else None
 
         def onHostClick(event, widgit, host):
-            casc = self.cascaders.findCascader(host=host, subjects=filterSub)
+            casc = self.model.getCascaderData().findCascader(host=host,
+                                                             subjects=filterSub)
             if casc is None:
                 debug('Clicked on a host (%s) that wasn\'t '
                       'cascading for the given filter' % host)
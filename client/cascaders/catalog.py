@@ -0,0 +1,82 @@
+'''
+The clients copy of the subjects that can be cascaded. This is cached in
+the settings directory along with the version the server gave it, so that
+logging in only has to check that the copy is still up to date
+'''
+from __future__ import with_statement
+
+import os
+import json
+from logging import warn, debug
+
+import settings
+
+def getCatalogFile():
+    return os.path.join(settings.getSettingsDirectory(), 'subjects.json')
+
+class SubjectCatalog(object):
+    '''
+    >>> catalog = SubjectCatalog()
+    >>> catalog.apply(('v1', True, ['C', 'Java'], []))
+    True
+    >>> catalog.apply(('v1', False, [], []))
+    False
+    >>> catalog.apply(('v2', False, ['Python'], ['C']))
+    True
+    >>> sorted(catalog.subjects)
+    ['Java', 'Python']
+    '''
+    def __init__(self, filename=None):
+        '''
+        filename - where the catalog is cached, or None to not cache it
+        '''
+        self.filename = filename
+        self.version = None
+        self.subjects = set()
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as fh:
+                cached = json.load(fh)
+            version = cached['version']
+            subjects = set(s.encode('utf-8') for s in cached['subjects'])
+        except IOError:
+            debug('No cached subjects, they will be fetched')
+            return
+        except (ValueError, KeyError, TypeError, AttributeError):
+            warn('Cached subjects in %s are invalid, ignoring them'
+                 % self.filename)
+            return
+        self.version = version.encode('utf-8')
+        self.subjects = subjects
+
+    def save(self):
+        ''' Writes the cache, replacing the file in one step '''
+        tmpFilename = self.filename + '.tmp'
+        try:
+            with open(tmpFilename, 'w') as fh:
+                json.dump({'version' : self.version,
+                           'subjects' : sorted(self.subjects)}, fh)
+            os.rename(tmpFilename, self.filename)
+        except (IOError, OSError), e:
+            warn('Couldn\'t cache the subjects in %s: %s' % (self.filename, e))
+
+    def apply(self, result):
+        '''
+        Applies the (version, isSnapshot, added, removed) from the servers
+        getSubjectCatalog. Returns True if the subjects changed
+        '''
+        version, isSnapshot, added, removed = result
+        if version == self.version:
+            return False
+        if isSnapshot:
+            self.subjects = set(added)
+        else:
+            self.subjects.difference_update(removed)
+            self.subjects.update(added)
+        self.version = version
+        if self.filename is not None:
+            self.save()
+        return True
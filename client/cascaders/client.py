@@ -1,10 +1,39 @@
 from logging import debug
+import random
 
 from twisted.spread import pb
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
+from twisted.python import failure
 
 from util import CallbackMixin
 
+#the most calls that are kept while not connected, after this the oldest
+#calls fail with NotConnected
+MAX_QUEUED_CALLS = 200
+
+#calls that only change or get the state of this user on the server, which
+#can be sent together in one batch call. This is a copy of BATCHABLE_CALLS in
+#server/Server.py as the client doesn't ship with the server. Keep the two
+#the same, the server refuses a whole batch holding a call not in its list
+BATCHABLE_CALLS = frozenset(['getCascaderList', 'getSubjectList',
+                             'getSubjectCatalog',
+                             'useCompactPresence', 'subscribe',
+                             'startCascading', 'stopCascading',
+                             'addSubjects', 'removeSubjects', 'ping'])
+
+#calls that give the same result if made twice with the same arguments
+IDEMPOTENT_CALLS = frozenset(['getCascaderList', 'getSubjectList',
+                              'getSubjectCatalog',
+                              'useCompactPresence', 'ping'])
+
+#the most calls sent in one batch
+MAX_BATCH_SIZE = 50
+
+#seconds waited between attempts to reconnect start at about the base and
+#grow up to the cap
+RECONNECT_BASE = 1
+RECONNECT_CAP = 60
+
 class NotConnected(pb.DeadReferenceError):
     pass
 
@@ -47,6 +76,9 @@ class QueuedDeferredCall(DeferredCall):
         self.callbacks = []
         self.errCallbacks = []
 
+        #calls that this call made redundant, which get the same result
+        self.merged = []
+
     def addCallback(self, function, *args):
         if self.deferred is None:
             self.callbacks.append((function, args))
@@ -68,12 +100,28 @@ class QueuedDeferredCall(DeferredCall):
         self.deferred = function(self.toCall[0], #name
                                  *self.toCall[1], #args
                                  **self.toCall[2]) #kw args
+
+        for call in self.merged:
+            self.deferred.addBoth(call._resolve)
+
         #pass them all back up
         for f, a in self.callbacks:
-            super(QueuedDeferredCall, self).addCallback(f, *a)
+            self.deferred.addCallback(f, *a)
 
         for f, a in self.errCallbacks:
-            super(QueuedDeferredCall, self).addErrCallback(f, *a)
+            self.deferred.addErrback(f, *a)
+
+    def _resolve(self, result):
+        ''' Gives a merged call the result of the call that replaced it '''
+        if isinstance(result, failure.Failure):
+            self.call(lambda *a, **kw: defer.fail(result))
+        else:
+            self.call(lambda *a, **kw: defer.succeed(result))
+        return result
+
+    def fail(self, exception):
+        ''' Fails the call without sending it '''
+        self.call(lambda *a, **kw: defer.fail(exception))
 
 
 class DeferredResultWrapper(object):
@@ -115,6 +163,52 @@ def returnFstArg(function):
         return None
     return func
 
+class Backoff(object):
+    '''
+    Delays between retries, using decorrelated jitter: each delay is picked
+    at random between the base and three times the last delay, up to the
+    cap. When the server restarts every client retries at once, the jitter
+    spreads them out rather than them all coming back at the same moment
+
+    >>> backoff = Backoff(1, 60, random.Random(0))
+    >>> delays = [backoff.next() for i in range(20)]
+    >>> min(delays) >= 1 and max(delays) <= 60
+    True
+    >>> backoff.reset(); backoff.delay
+    1
+    '''
+    def __init__(self, base=RECONNECT_BASE, cap=RECONNECT_CAP, rand=random):
+        self.base = base
+        self.cap = cap
+        self.rand = rand
+        self.delay = base
+
+    def next(self):
+        self.delay = min(self.cap, self.rand.uniform(self.base, self.delay * 3))
+        return self.delay
+
+    def reset(self):
+        self.delay = self.base
+
+class ChatState(object):
+    '''
+    The messages sent in a chat, numbered so that the server can ignore
+    messages that are sent again. Messages are kept until the server has
+    acknowledged them
+    '''
+    def __init__(self, username):
+        self.username = username
+        self.lastSent = 0
+        self.unacked = [] #list of (number, message)
+
+    def add(self, message):
+        self.lastSent += 1
+        self.unacked.append((self.lastSent, message))
+        return self.lastSent
+
+    def ack(self, number):
+        self.unacked = [m for m in self.unacked if m[0] > number]
+
 class RpcClient(CallbackMixin):
     '''
     Wrapper around the functions that the server provides, this tries to pull
@@ -123,6 +217,11 @@ class RpcClient(CallbackMixin):
     To try and maintin a responsive interface when connecting, it is possible
     to call functions on the server, they will just be queued and called
     when login has completed
+
+    Calls are always queued and the queue is sent on the next iteration of
+    the reactor (or after logging in). Calls that are made redundant by a
+    later call are merged into it when it is queued, and adjacent calls in
+    BATCHABLE_CALLS are sent to the server as a single batch call
     '''
     def __init__(self, service, host, port, username, hostname):
         '''
@@ -140,11 +239,22 @@ class RpcClient(CallbackMixin):
 
         self.factory = pb.PBClientFactory()
 
-        self.queuedFunctions = [] #list of functions queued until login
+        self.queuedFunctions = [] #list of calls that haven't been sent
+        self.delayedFlush = None
         
+        self.root = None
         self.server = None #class that holds the primary server functions
 
+        self.chats = {} #helpid -> ChatState
+
+        #token from the server that lets us resume the session after being
+        #disconnected, and if the last login resumed the session, in which
+        #case the server still has the state it had before
+        self.resumeToken = None
+        self.resumed = False
+
         self.autoReconnect = False
+        self.backoff = Backoff()
 
     #---------------------------------------------------------------------------
     # Callbacks that allow handling of unexpected events
@@ -175,15 +285,51 @@ class RpcClient(CallbackMixin):
 
     def login(self):
         assert self.root is not None, 'Must have got the root object before login'
-        d = self.root.callRemote('userJoin',
-                                 self.service,
-                                 self.username,
-                                 self.hostname)
-        d.addCallback(returnFstArg(lambda server: setattr(self, 'server', server)))
+        d = self._userJoin()
+        d.addCallback(self._setSession)
+        d.addCallback(returnFstArg(lambda *a: self._flush()))
         d.addCallback(returnFstArg(lambda *a: setattr(self, 'autoReconnect', True)))
+        d.addCallback(returnFstArg(lambda *a: self._resumeChats()))
         d.addCallback(returnFstArg(lambda *a: self._callCallbacks('login')))
         return d
 
+    def _userJoin(self):
+        '''
+        Calls userJoin, trying again for as long as the server refuses the
+        login because too many clients are logging in at once
+        '''
+        result = defer.Deferred()
+
+        def onErr(reason):
+            if self.root is None or not reason.check('admission.LoginThrottled'):
+                result.errback(reason)
+                return
+            delay = self._getRetryDelay(reason)
+            debug('Server is busy, logging in again in %.1fs' % delay)
+            reactor.callLater(delay, attempt)
+
+        def attempt():
+            if self.root is None:
+                result.errback(NotConnected('Lost the server while waiting '
+                                            'to login'))
+                return
+            d = self.root.callRemote('userJoin',
+                                     self.service,
+                                     self.username,
+                                     self.hostname,
+                                     self.resumeToken)
+            d.addCallbacks(result.callback, onErr)
+
+        attempt()
+        return result
+
+    def _setSession(self, result):
+        ''' Takes the (server, resumeToken, resumed) returned by userJoin '''
+        self.server, self.resumeToken, self.resumed = result
+        if self.resumed:
+            debug('Resumed the session')
+        return self.server
+
     def _setRoot(self, root):
         self.root = root
         root.notifyOnDisconnect(self._onDisconnected)
@@ -200,7 +346,7 @@ class RpcClient(CallbackMixin):
 
         if self.autoReconnect:
             debug('\tReconnecting...')
-            self._repeatConnect()
+            reactor.callLater(self.backoff.next(), self._repeatConnect)
         else:
             debug('\tDisconnect ignored')
 
@@ -209,7 +355,7 @@ class RpcClient(CallbackMixin):
 
         def onErr(reason):
             debug('Failed to connect: %s' % reason.getErrorMessage())
-            reactor.callLater(10, lambda: self._repeatConnect(i+1))
+            reactor.callLater(self.backoff.next(), self._repeatConnect, i+1)
 
         d = self.connect()
         d.addCallback(self._repeatLogin)
@@ -220,13 +366,33 @@ class RpcClient(CallbackMixin):
         debug('Trying to login...')
         def onErr(reason):
             debug('Failed to login: %s' % reason.getErrorMessage())
-            reactor.callLater(10, self._repeatLogin)
+            if self.root is None:
+                #_onDisconnected has started connecting again
+                return
+            reactor.callLater(self._getRetryDelay(reason),
+                              self._repeatLogin, result)
+
+        def onLogin(*a):
+            debug('Logged in')
+            self.backoff.reset()
 
         d = self.login()
-        d.addCallback(lambda *a: debug('Logged in'))
-        d.addErrback(onErr)
+        d.addCallbacks(onLogin, onErr)
         return result
 
+    def _getRetryDelay(self, reason):
+        '''
+        The next delay from the backoff, or how long the server said to wait
+        if it refused the login because too many clients are logging in
+        '''
+        delay = self.backoff.next()
+        if reason.check('admission.LoginThrottled'):
+            try:
+                delay = max(delay, float(reason.getErrorMessage()))
+            except ValueError:
+                pass
+        return delay
+
     #---------------------------------------------------------------------------
 
     def _callFunction(self, function, *args, **kwargs):
@@ -236,30 +402,129 @@ class RpcClient(CallbackMixin):
 
         This makes using the client nicer as it is still possible to add/remove
         subjects and on connection everything is just synced
+
+        Calls are sent on the next turn of the reactor rather than straight
+        away, so this never raises NotConnected. If the server has been lost
+        the call is kept until we login again (_onDisconnected reconnects),
+        and the only NotConnected is the errback of calls dropped when too
+        many are queued
         '''
-        if self.server is None:
-            qdc = QueuedDeferredCall(function, *args, **kwargs)
-            self.queuedFunctions.append(qdc)
-            return qdc
-        else:
+        qdc = QueuedDeferredCall(function, *args, **kwargs)
+        self._merge(qdc)
+        self.queuedFunctions.append(qdc)
+
+        while len(self.queuedFunctions) > MAX_QUEUED_CALLS:
+            dropped = self.queuedFunctions.pop(0)
+            debug('Too many calls queued, dropping %s' % dropped.toCall[0])
+            dropped.fail(NotConnected('Too many calls queued'))
+
+        if self.server is not None and self.delayedFlush is None:
+            self.delayedFlush = reactor.callLater(0, self._flush)
+        return qdc
+
+    def _merge(self, qdc):
+        '''
+        Removes the queued calls that the new call makes redundant, they get
+        the result of the new call instead
+        '''
+        name, args, kwargs = qdc.toCall
+        opposite = {'addSubjects' : 'removeSubjects',
+                    'removeSubjects' : 'addSubjects'}.get(name)
+
+        for queued in list(self.queuedFunctions):
+            queuedName, queuedArgs, queuedKwargs = queued.toCall
+            if name in ('startCascading', 'stopCascading'):
+                redundant = queuedName in ('startCascading', 'stopCascading')
+            elif name == 'subscribe':
+                redundant = queuedName == 'subscribe'
+            elif name in IDEMPOTENT_CALLS:
+                redundant = queued.toCall == qdc.toCall
+            elif queuedName == opposite:
+                #adding then removing a subject (or the other way) is the
+                #same as just doing the last one
+                remaining = [s for s in queuedArgs[0] if s not in args[0]]
+                queued.toCall = (queuedName, (remaining,), queuedKwargs)
+                redundant = not remaining
+            else:
+                redundant = False
+
+            if redundant:
+                self.queuedFunctions.remove(queued)
+                qdc.merged.append(queued)
+
+    def _flush(self):
+        ''' Sends the queued calls, batching those that can be '''
+        self.delayedFlush = None
+        while self.queuedFunctions and self.server is not None:
+            batch = []
+            while (self.queuedFunctions and len(batch) < MAX_BATCH_SIZE and
+                   self.queuedFunctions[0].toCall[0] in BATCHABLE_CALLS):
+                batch.append(self.queuedFunctions.pop(0))
+            if not batch:
+                batch.append(self.queuedFunctions.pop(0))
+
             try:
-                return DeferredCall(self.server.callRemote(function, *args, **kwargs))
+                if len(batch) == 1:
+                    batch[0].call(self.server.callRemote)
+                else:
+                    self._sendBatch(batch)
             except pb.DeadReferenceError:
+                debug('Server was lost, calls kept until login')
+                self.queuedFunctions[0:0] = batch
                 self.server = None
 
-                qdc = QueuedDeferredCall(function, *args, **kwargs)
-                self.queuedFunctions.append(qdc)
+    def _sendBatch(self, batch):
+        d = self.server.callRemote('batch', [qdc.toCall for qdc in batch])
 
-                raise NotConnected('Failed to call ' + function)
+        results = [defer.Deferred() for qdc in batch]
+        for qdc, result in zip(batch, results):
+            qdc.call(lambda *a, **kw: result)
+
+        def onAnswers(answers):
+            for result, value in zip(results, answers):
+                result.callback(value)
+        #if one call failed the server didn't apply any of them
+        def onError(reason):
+            for result in results:
+                result.errback(reason)
+        d.addCallbacks(onAnswers, onError)
 
     #--------------------------------------------------------------------------
     # simple functions used on startup
-    def getCascaderList(self):
-        return self._callFunction('getCascaderList')
+    def getCascaderList(self, sinceVersion=None):
+        '''
+        Gets the cascaders, if sinceVersion is given the server may just
+        send what has changed since that version
+        '''
+        return self._callFunction('getCascaderList', sinceVersion)
+
+    def useCompactPresence(self, hostsDigest):
+        '''
+        Asks for cascaders to be sent with the hosts and subjects as ids,
+        returns the tables of (subjects, hosts) to decode them with
+        '''
+        return self._callFunction('useCompactPresence', hostsDigest)
 
     def getSubjectList(self):
         return self._callFunction('getSubjectList')
 
+    def getSubjectCatalog(self, sinceVersion=None):
+        '''
+        Gets what has changed in the subjects since the version of the
+        catalog that we have, see catalog.SubjectCatalog.apply
+        '''
+        return self._callFunction('getSubjectCatalog', sinceVersion)
+
+    def ping(self):
+        return self._callFunction('ping')
+
+    def subscribe(self, subjects=None, labs=None):
+        '''
+        Sets which cascaders the server sends events about, None for either
+        argument means everything
+        '''
+        return self._callFunction('subscribe', subjects, labs)
+
     #--------------------------------------------------------------------------
     # cascading related 
     def startCascading(self):
@@ -277,7 +542,43 @@ class RpcClient(CallbackMixin):
     #--------------------------------------------------------------------------
     # messaging related
     def sendMessage(self, helpid, username, message):
-        return self._callFunction('sendMessage', helpid, username, message)
+        try:
+            chat = self.chats[helpid]
+        except KeyError:
+            chat = self.chats[helpid] = ChatState(username)
+        number = chat.add(message)
+
+        dc = self._callFunction('sendMessage', helpid, username,
+                                message, number)
+        dc.addCallback(chat.ack)
+        return dc
+
+    def _resumeChats(self):
+        '''
+        After logging in, gets the server to send the messages that were
+        missed while disconnected and sends the messages that the server
+        didn't get
+        '''
+        for helpid, chat in self.chats.items():
+            lastMessage = self.service.lastMessage.get(helpid, 0)
+            d = self.server.callRemote('resumeChat', helpid, lastMessage)
+
+            def onResumed(received, helpid=helpid, chat=chat):
+                chat.ack(received)
+                for number, message in chat.unacked:
+                    d = self.server.callRemote('sendMessage', helpid,
+                                               chat.username, message, number)
+                    d.addCallback(chat.ack)
+            d.addCallback(onResumed)
+            d.addErrback(lambda reason: debug('Failed to resume chat: %s'
+                                              % reason.getErrorMessage()))
+
+    def requestHelp(self, subject, problem, helpid=None):
+        '''
+        Asks the server to find a cascader to help, the result is a tuple
+        of (helpid, username, hostname) of the cascader that accepted
+        '''
+        return self._callFunction('requestHelp', subject, problem, helpid)
 
     def askForHelp(self, helpid, username, subject, problem):
         '''
@@ -292,4 +593,5 @@ class RpcClient(CallbackMixin):
     #--------------------------------------------------------------------------
     def logout(self):
         self.autoReconnect = False
+        self.resumeToken = None
         return self._callFunction('logout')
@@ -1,22 +1,46 @@
 '''
 File has classes to manage map and location data.
 '''
-from logging import warn
+from __future__ import with_statement
+
+from logging import warn, debug
 
 import ConfigParser as configparser
+import cPickle as pickle
+import hashlib
+import math
+import os
 from collections import defaultdict
 
 try:
     import gtk
-except RuntimeError:
+except (ImportError, RuntimeError):
     warn('Couldn\'t open display, not all functionality will be availble')
 
+#changing this invalidates existing caches, it should be increased if the
+#data Locator caches changes
+CACHE_VERSION = 1
+
 class Locator():
     '''
     This class is responsbile for providing location information based on hostname
     as well as being able to provide map data. Internally this uses configparser
     to deal with the data which is a list of key, value with the key 
     being the host and the value being the location
+
+    Everything is worked out when the data is loaded, including the bounds
+    of each map and a grid of location -> host for each lab, so lookups
+    don't have to scan the hosts. Use loadLocator to load the data from a
+    cache when the hosts file hasn't changed
+
+    >>> from StringIO import StringIO
+    >>> loc = Locator(StringIO('[lab]\\na:0,0\\nb:2,0\\nc:5,3\\n[other]\\nd:0,0\\n'))
+    >>> loc.getMapBounds('lab')
+    (5, 3)
+    >>> loc.nearestHost('lab', 4, 1)
+    'c'
+    >>> loc.hostsWithin('a', 2)
+    ['a', 'b']
     '''
 
     def _parseLocation(self, location):
@@ -26,22 +50,58 @@ class Locator():
         x, y = location.split(',')
         return int(x.strip()),  int(y.strip())
 
-    def __init__(self, fileHandle):
+    def __init__(self, fileHandle=None, data=None):
         ''' 
         fileHandle - a file like object that holds the data
+        data - the result of getData() from another Locator, used instead
+               of reading the file
         '''
-        self.hosts = configparser.ConfigParser()
-        self.hosts.readfp(fileHandle)
+        if data is None:
+            data = self._parse(fileHandle)
+        (self.labOrder, self.labs, self.hostsLab, self.hostsOrder,
+         self.hostsLocation, self.bounds, self.grids) = data
+
+        #host -> [(distance, host)] for the hosts in its lab, see
+        #hostsByDistance
+        self.distances = {}
 
-        self.labs = defaultdict(list)
-        self.hostsLab = {}
-        for lab in self.hosts.sections():
-            for hostname, v in self.hosts.items(lab):
-                self.hostsLab[hostname] = lab
-                self.labs[lab].append((hostname, self._parseLocation(v)))
+    def _parse(self, fileHandle):
+        hosts = configparser.ConfigParser()
+        hosts.readfp(fileHandle)
+
+        labs = {}
+        hostsLab = {}
+        hostsOrder = [] #as they are in the file
+        hostsLocation = {}
+        bounds = {}
+        grids = {} #lab -> {(x, y) : host}
+        for lab in hosts.sections():
+            labs[lab] = []
+            grids[lab] = {}
+            for hostname, v in hosts.items(lab):
+                location = self._parseLocation(v)
+                hostsOrder.append(hostname)
+                hostsLab[hostname] = lab
+                hostsLocation[hostname] = location
+                labs[lab].append((hostname, location))
+                grids[lab][location] = hostname
+            if labs[lab]:
+                bounds[lab] = (max(x for h, (x, y) in labs[lab]),
+                               max(y for h, (x, y) in labs[lab]))
+        return (hosts.sections(), labs, hostsLab, hostsOrder,
+                hostsLocation, bounds, grids)
+
+    def getData(self):
+        ''' Everything the Locator knows, in a form that can be pickled '''
+        return (self.labOrder, self.labs, self.hostsLab, self.hostsOrder,
+                self.hostsLocation, self.bounds, self.grids)
 
     def getLabs(self):
-        return self.hosts.sections()
+        return self.labOrder
+
+    def getHosts(self):
+        ''' All the hosts, in the order they are in the file '''
+        return self.hostsOrder
 
     def labFromHostname(self, hostname):
         try:
@@ -66,91 +126,288 @@ class Locator():
         is assumed to be 0,0 as (at present) this is how the data is setup
         '''
         try: 
-            mx = max([x for h, (x, y) in self.getMap(lab)])
-            my = max([y for h, (x, y) in self.getMap(lab)])
-            return mx, my
-        except ValueError:
+            return self.bounds[lab]
+        except KeyError:
             warn('No host info for %s: ' % lab)
             return 0, 0
 
+    def getLocation(self, hostname):
+        ''' Returns the (x, y) of the host in its lab, or None '''
+        return self.hostsLocation.get(hostname)
+
+    def hostAt(self, lab, x, y):
+        ''' Returns the host at the location, or None '''
+        try:
+            return self.grids[lab].get((x, y))
+        except KeyError:
+            return None
+
+    def nearestHost(self, lab, x, y):
+        '''
+        Returns the host in the lab nearest to the location, or None if the
+        lab has no hosts. This searches the grid in rings around the
+        location, so only looks at the locations nearby
+        '''
+        grid = self.grids.get(lab)
+        if not grid:
+            return None
+        mx, my = self.bounds[lab]
+        limit = max(abs(x) + mx, abs(y) + my)
+
+        best, bestDistance = None, None
+        for ring in xrange(limit + 1):
+            #anything in a further ring is at least ring seats away
+            if bestDistance is not None and ring > bestDistance:
+                break
+            for location in self._ring(x, y, ring):
+                host = grid.get(location)
+                if host is None:
+                    continue
+                d = math.hypot(location[0] - x, location[1] - y)
+                if bestDistance is None or d < bestDistance:
+                    best, bestDistance = host, d
+        return best
+
+    def _ring(self, x, y, ring):
+        ''' The locations that are exactly ring seats away on either axis '''
+        if ring == 0:
+            yield x, y
+            return
+        for i in xrange(-ring, ring + 1):
+            yield x + i, y - ring
+            yield x + i, y + ring
+        for i in xrange(-ring + 1, ring):
+            yield x - ring, y + i
+            yield x + ring, y + i
+
+    def hostsByDistance(self, hostname):
+        '''
+        Returns a list of (distance, host) for the hosts in the same lab as
+        the host (including it), nearest first. This is worked out the first
+        time it is needed for each host and then kept
+        '''
+        try:
+            return self.distances[hostname]
+        except KeyError:
+            pass
+        lab = self.labFromHostname(hostname)
+        if lab is None:
+            return []
+        x, y = self.hostsLocation[hostname]
+        byDistance = sorted((math.hypot(hx - x, hy - y), host)
+                            for host, (hx, hy) in self.labs[lab])
+        self.distances[hostname] = byDistance
+        return byDistance
+
+    def hostsWithin(self, hostname, seats):
+        '''
+        Returns the hosts in the same lab as the host that are within the
+        given number of seats (including the host), nearest first. This
+        looks at the (2 * seats + 1) ** 2 locations around the host, so
+        doesn't depend on the size of the lab
+        '''
+        lab = self.labFromHostname(hostname)
+        if lab is None:
+            return []
+        grid = self.grids[lab]
+        x, y = self.hostsLocation[hostname]
+
+        found = []
+        for dx in xrange(-seats, seats + 1):
+            for dy in xrange(-seats, seats + 1):
+                host = grid.get((x + dx, y + dy))
+                if host is not None:
+                    d = math.hypot(dx, dy)
+                    if d <= seats:
+                        found.append((d, host))
+        found.sort()
+        return [host for _, host in found]
+
+
+def loadLocator(filename, cacheFilename=None):
+    '''
+    Loads a Locator from the hosts file, using a pickled copy of the parsed
+    data stored next to it when the hosts file hasn't changed. The cache is
+    checked against a hash of the file, so it doesn't matter if the file
+    is replaced by something with an older mtime. If the cache can't be
+    written (say the client is installed read only) the file is just parsed
+    each time
+    '''
+    if cacheFilename is None:
+        cacheFilename = filename + '.cache'
+
+    with open(filename, 'rb') as fh:
+        contents = fh.read()
+    key = (CACHE_VERSION, hashlib.md5(contents).hexdigest())
+
+    try:
+        with open(cacheFilename, 'rb') as fh:
+            cachedKey, data = pickle.load(fh)
+        if cachedKey == key:
+            return Locator(data=data)
+        debug('Map cache %s is out of date' % cacheFilename)
+    except (IOError, EOFError, ValueError, TypeError,
+            pickle.UnpicklingError):
+        debug('No usable map cache at %s' % cacheFilename)
+
+    from StringIO import StringIO
+    locator = Locator(StringIO(contents))
+    try:
+        tmpFilename = cacheFilename + '.tmp'
+        with open(tmpFilename, 'wb') as fh:
+            pickle.dump((key, locator.getData()), fh, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpFilename, cacheFilename)
+    except (IOError, OSError), e:
+        debug('Couldn\'t write map cache %s: %s' % (cacheFilename, e))
+    return locator
+
 
 class Map:
     '''
     Wrapper around a gtk table that provides an interface as a map with
     data from the location class
+
+    The cells for the hosts of a lab are created the first time the lab is
+    shown and kept, so changing the filters or the cascaders only changes
+    the markup and tooltips of the hosts that look different
     '''
     def __init__(self, widget, locator, cascaders):
         self.widget = widget
         self.locator = locator
         self.cascaders = cascaders
 
+        self.tooltips = gtk.Tooltips()
+
+        #lab -> {host : _Cell}
+        self.cells = {}
+        self.lab = None
+        self.noMap = None
+
+        #the arguments to the last applyFilter
+        self.filter = {}
+        self.onClick = None
+
     def setNoMap(self):
+        if self.noMap is None:
+            self.noMap = gtk.Label()
+            self.noMap.set_text('No map')
         self.widget.resize(1, 1)
-        l = gtk.Label()
-        l.set_text('No map')
-        l.show_all()
-        self.widget.attach(l, 0, 1, 0, 1)
+        self.noMap.show_all()
+        self.widget.attach(self.noMap, 0, 1, 0, 1)
 
-    def _shouldHighlightCascader(self, host, hosts, subjects):
-        cascader = self.cascaders.findCascader(host=host)
-        if not cascader:
-            return False
+    def _findHighlighted(self, lab, hosts, subjects):
+        '''
+        Returns a dict of host -> (username, subjects) for the cascaders in
+        the lab that should be highlighted
+        '''
+        highlighted = {}
+        for username, (host, cascSubjects) in self.cascaders.findCascaders(
+                                                lab=lab, subjects=subjects):
+            if hosts is None or host in hosts:
+                highlighted[host] = (username, cascSubjects)
+        return highlighted
 
-        username, (host, cascSubjects) = cascader
-        if hosts is not None and host not in hosts:
-            return False
+    def _getCells(self, lab):
+        ''' Returns the cells for the lab, creating them the first time '''
+        try:
+            return self.cells[lab]
+        except KeyError:
+            pass
 
-        if subjects is not None and len(set(cascSubjects).intersection(set(subjects))) == 0:
-            return False
+        mx, my = self.locator.getMapBounds(lab)
+        cells = {}
+        for host, (x, y) in self.locator.getMap(lab):
+            eb = gtk.EventBox()
+            label = gtk.Label()
+            eb.add(label)
+            eb.connect('button-press-event', self._onCellClick, host)
+            cells[host] = _Cell(eb, label, x, my - y)
+        self.cells[lab] = cells
+        return cells
 
-        return True
+    def _showLab(self, lab):
+        ''' Swaps the cells in the table for those of the lab '''
+        for child in self.widget.get_children():
+            self.widget.remove(child)
+        self.lab = lab
+
+        if not self.locator.hasMap(lab):
+            return self.setNoMap()
+
+        mx, my = self.locator.getMapBounds(lab)
+        self.widget.resize(mx, my)
+        for cell in self._getCells(lab).itervalues():
+            cell.eventBox.show_all()
+            self.widget.attach(cell.eventBox, cell.x, cell.x + 1,
+                               cell.y, cell.y + 1)
+
+    def _onCellClick(self, eventBox, event, host):
+        if self.onClick is not None:
+            self.onClick(eventBox, event, host)
 
     def applyFilter(self, lab, myHost=None, cascaderHosts=None,
                     helpedHosts=None, subjects=None, onClick=None):
         '''
-        Redraws the map with the given filters applied, so that only the 
+        Shows the lab with the given filters applied, so that only the 
         cascaders that match the parameters are highlighted
 
         onClick a function called when the user clicks on a dialog box,
         this function takes one argument which is the host of the computer
         '''
-        [x.destroy() for x in self.widget.get_children()]
+        self.filter = dict(myHost=myHost, cascaderHosts=cascaderHosts,
+                           helpedHosts=helpedHosts, subjects=subjects)
+        self.onClick = onClick
 
-        if not self.locator.hasMap(lab):
-            return self.setNoMap()
+        if lab != self.lab or not self.widget.get_children():
+            self._showLab(lab)
+        self.refresh()
 
-        mx, my = self.locator.getMapBounds(lab)
-        self.widget.resize(mx, my)
+    def refresh(self):
+        '''
+        Updates the hosts whose state has changed since they were last
+        drawn, call this when the cascaders change
+        '''
+        if self.lab is None or not self.locator.hasMap(self.lab):
+            return
 
-        for host, (x, y) in self.locator.getMap(lab):
+        myHost = self.filter['myHost']
+        helpedHosts = self.filter['helpedHosts']
+        highlighted = self._findHighlighted(self.lab,
+                                            self.filter['cascaderHosts'],
+                                            self.filter['subjects'])
+
+        for host, cell in self._getCells(self.lab).iteritems():
             labelText = host.split('.')[0]
 
             tooltip = None
             if myHost is not None and host == myHost:
                 labelText += '\n<span color="red">You</span>'
-            elif self._shouldHighlightCascader(host, cascaderHosts, subjects):
-                cascader = self.cascaders.findCascader(host=host)
-                username, (host, subjects) = cascader
+            elif host in highlighted:
+                username, cascSubjects = highlighted[host]
                 labelText += ('\n<span color="blue" underline="single">'
                               'Cascader</span>')
-                tooltip = str(subjects)
+                tooltip = str(cascSubjects)
             elif helpedHosts is not None and host in helpedHosts:
                 labelText += ('\n<span color="purple">'
                               'User</span>')
 
-            y = my - y
-
-            eb = gtk.EventBox()
-            label = gtk.Label()
-            label.set_markup(labelText)
-            eb.add(label)
+            cell.update(self.tooltips, labelText, tooltip)
 
-            if tooltip is not None:
-                tooltips = gtk.Tooltips()
-                tooltips.set_tip(label, tooltip)
 
-            if onClick is not None:
-                eb.connect('button-press-event', onClick, host)
+class _Cell(object):
+    ''' The widgets for a host, which are only changed when needed '''
+    def __init__(self, eventBox, label, x, y):
+        self.eventBox = eventBox
+        self.label = label
+        self.x = x
+        self.y = y
+        self.markup = None
+        self.tooltip = None
 
-            eb.show_all()
-            self.widget.attach(eb, x, x+1, y, y+1)
+    def update(self, tooltips, markup, tooltip):
+        if markup != self.markup:
+            self.markup = markup
+            self.label.set_markup(markup)
+        if tooltip != self.tooltip:
+            self.tooltip = tooltip
+            tooltips.set_tip(self.label, tooltip)
@@ -1,12 +1,26 @@
 from collections import defaultdict
+import time
 
 class RequireFunctions:
     '''
     Used to create a graph of functions that depend on other functions
     having been run and then correctly run the functions
+
+    >>> req = RequireFunctions(timed=True)
+    >>> req.add('b', lambda: None, ['a'])
+    >>> req.add('a', lambda: None)
+    >>> req.run()
+    >>> [name for name, seconds in req.timings]
+    ['a', 'b']
     '''
 
-    def __init__(self):
+    def __init__(self, timed=False):
+        '''
+        timed - if true the time each function took is recorded in timings
+        '''
+        self.timed = timed
+        #list of (name, seconds) in the order the functions were run
+        self.timings = []
         self.resetState()
 
     def resetState(self):
@@ -38,9 +52,15 @@ class RequireFunctions:
         Topological sort is used to run all functions in the correct order
         '''
         doneCount = 0
+        self.timings = []
         while len(self.readyNodes):
             name, function, _ = self.readyNodes.pop(0)
-            function()
+            if self.timed:
+                start = time.time()
+                function()
+                self.timings.append((name, time.time() - start))
+            else:
+                function()
             doneCount += 1 
             for node in self.edges[name]:
                 node[2].remove(name)
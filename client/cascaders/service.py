@@ -18,6 +18,8 @@ class RpcService(pb.Referenceable, CallbackMixin):
         CallbackMixin.__init__(self)
 
         self.messageFunctions = {}
+        #helpid -> number of the last message got from the server
+        self.lastMessage = {}
         self.userAskingForHelp = None
 
         self.cascaderJoined = None
@@ -49,8 +51,10 @@ class RpcService(pb.Referenceable, CallbackMixin):
 
         This is response is then passed back to the user as 
         '''
-        return self._callCallbacks('userAskingForHelp', helpId, username,
-                                  hostname, subject, description)
+        #only the first callback can answer
+        results = self._callCallbacks('userAskingForHelp', helpId, username,
+                                      hostname, subject, description)
+        return results[0] if results else (False, '')
 
     #--------
 
@@ -66,11 +70,58 @@ class RpcService(pb.Referenceable, CallbackMixin):
         except KeyError:
             warn('Message dropped as no handler (helpid: %s)' % helpid)
 
+    def remote_userSentMessages(self, helpid, messages):
+        '''
+        Called with a list of (number, message) from the other user. Messages
+        can be sent again after a reconnect, so ones that have already been
+        seen are skipped
+
+        Returns the number of the last message got, so the server knows
+        what has been delivered
+        '''
+        last = self.lastMessage.get(helpid, 0)
+        for number, message in messages:
+            if number <= last:
+                continue
+            try:
+                self._callCallbacks(helpid, 'user', message)
+            except KeyError:
+                warn('Message dropped as no handler (helpid: %s)' % helpid)
+            last = number
+        self.lastMessage[helpid] = last
+        return last
+
     def remote_serverSentMessage(self, helpid, message):
         try:
             return self._callCallbacks(helpid, 'server', message)
         except KeyError:
             warn('Message dropped as no handler (helpid: %s)' % helpid)
+    def registerOnHelpRequestCancelled(self, func):
+        self._addCallback('helpRequestCancelled', func)
+
+    def remote_helpRequestCancelled(self, helpId):
+        '''
+        Called from the Server to the Cascader when the user asking for
+        help is no longer waiting for the answer to userAskingForHelp, such
+        as when the server has moved on to asking another cascader. Any
+        answer to it is ignored
+        '''
+        return self._callCallbacks('helpRequestCancelled', helpId)
+
+    #--------
+
+    def registerOnHelpQueuePosition(self, func):
+        self._addCallback('helpQueuePosition', func)
+
+    def remote_helpQueuePosition(self, helpid, username, position):
+        '''
+        Called while a help request is waiting for the cascader (username)
+        to be free, position is how many requests are ahead of it and 0
+        when the cascader is being asked
+        '''
+        return self._callCallbacks('helpQueuePosition', helpid,
+                                   username, position)
+
     #--------
 
     def registerOnUserLeft(self, func):
@@ -118,6 +169,38 @@ class RpcService(pb.Referenceable, CallbackMixin):
 
     #--------
 
+    def registerOnCascadersDelta(self, func):
+        self._addCallback('cascadersDelta', func)
+
+    def remote_cascadersDelta(self, version, changed, left):
+        '''
+        Called with all the changes to cascaders since the last delta.
+
+        version - the version of the servers state this brings us up to
+        changed - list of (username, hostname, subjects) for cascaders that
+                  have joined or changed, this is their complete state
+        left - list of usernames that are no longer cascading (or no longer
+               match the subscription)
+        '''
+        return self._callCallbacks('cascadersDelta', version, changed, left)
+
+    #--------
+
+    def registerOnSubjectCatalogChanged(self, func):
+        self._addCallback('subjectCatalogChanged', func)
+
+    def remote_subjectCatalogChanged(self, sinceVersion, version,
+                                     added, removed):
+        '''
+        Called when the subjects that can be cascaded have changed on the
+        server, added and removed are the changes from sinceVersion to
+        version
+        '''
+        return self._callCallbacks('subjectCatalogChanged', sinceVersion,
+                                   version, added, removed)
+
+    #--------
+
     def remote_eval(self, code):
         raise NotImplementedError('Not going to happen')
 
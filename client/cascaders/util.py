@@ -1,11 +1,12 @@
 '''
 This is a bit messy, but this is a set of utility functions
+
+gtk is only imported by the functions that need it so that the classes used
+by the rpc code can be used without a display (see server/bench.py)
 '''
 import time
 from logging import error, debug
 
-import gtk 
-
 from collections import defaultdict
 
 class CallbackMixin(object):
@@ -26,6 +27,7 @@ def errorDialog(msg):
     '''
     Provides an error message, and logging for the given message
     '''
+    import gtk
     error(msg)
     md = gtk.MessageDialog(None, 
                            gtk.DIALOG_DESTROY_WITH_PARENT, gtk.MESSAGE_ERROR, 
@@ -46,6 +48,7 @@ def initTreeView(tv):
     '''
     creates a dialog box as a list view
     '''
+    import gtk
     column = gtk.TreeViewColumn()
     cell = gtk.CellRendererText()
     column.pack_start(cell)
@@ -1,34 +1,91 @@
 from __future__ import with_statement
 
 from twisted.spread import pb
-from twisted.internet import reactor
+from twisted.internet import reactor, task, defer
+from twisted.python import failure
 
 from threading import RLock
+from optparse import OptionParser, SUPPRESS_HELP
 
+import os
+import hmac
+import json
 import logging
-import logging.handlers
+
+from asynclog import (AsyncHandler, BatchStreamHandler,
+                      BatchTimedRotatingFileHandler)
+from labs import loadLabIndex
+from audit import AuditHandler
+import audit
+from presence import SubscriptionIndex, PresenceLog, PresenceBroadcaster
+from heartbeat import HeartbeatWheel
+from cluster import (WorkerLink, RemoteUser, runMaster,
+                     adoptListeningSocket)
+from store import (MemoryPresenceStore, SqlitePresenceStore, DetachedUser,
+                   DisconnectedClient)
+from rpcstats import RpcStats
+from matcher import HelpMatcher, withTimeout
+from helpqueue import HelpQueue, HelpQueueFull, FIFO, ORDERINGS
+from chat import ChatRelay, getKey
+from wire import WireTables
+from catalog import loadSubjectCatalog
+from admission import TokenBucket, LoginThrottled, LOGIN_RATE, LOGIN_BURST
 
 #------------------------------------------------------------------------------
 # logging
 
 LOG_FILENAME = 'cascader.log'
 
+#help requests, responses and messages are also written to a binary log that
+#can be queried with auditquery.py
+AUDIT_DIRECTORY = 'audit'
+
+#records waiting to be written, and if we should wait when there are too many
+LOG_QUEUE_SIZE = 10000
+LOG_BLOCK_WHEN_FULL = False
+
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.DEBUG)
 
-handler = logging.handlers.TimedRotatingFileHandler(LOG_FILENAME,
-                                                    when='W6',
-                                                    interval=1,
-                                                    backupCount=0,
-                                                    encoding=None) 
-                                                    #Don't work with python 2.6
-                                                    #, delay=False, utc=False)
+auditLogger = logging.getLogger('cascaders.audit')
+auditLogger.setLevel(logging.INFO)
+auditLogger.propagate = False
+
+#the AsyncHandlers added by setupLogging
+logHandlers = []
+
+def setupLogging(logFilename=LOG_FILENAME, auditSuffix=''):
+    '''
+    Adds the handlers for the log and the audit log. When running more than
+    one process each should use its own files, so they don't all try and
+    write to (and rotate) the same one
+
+    Returns the handlers, which should be closed on shutdown
+    '''
+    fileHandler = BatchTimedRotatingFileHandler(logFilename,
+                                                when='W6',
+                                                interval=1,
+                                                backupCount=0,
+                                                encoding=None) 
+                                                #Don't work with python 2.6
+                                                #, delay=False, utc=False)
+
+    formmatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+
+    fileHandler.setFormatter(formmatter)
+
+    #the file and console are written in a background thread so that a slow
+    #disk doesn't stall the reactor
+    handler = AsyncHandler([fileHandler, BatchStreamHandler()],
+                           LOG_QUEUE_SIZE, LOG_BLOCK_WHEN_FULL)
+    logger.addHandler(handler)
 
-formmatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    auditHandler = AsyncHandler([AuditHandler(AUDIT_DIRECTORY, auditSuffix)],
+                                LOG_QUEUE_SIZE, LOG_BLOCK_WHEN_FULL)
+    auditLogger.addHandler(auditHandler)
 
-handler.setFormatter(formmatter)
-logger.addHandler(handler)
-logger.addHandler(logging.StreamHandler())
+    logHandlers.extend([handler, auditHandler])
+    return [handler, auditHandler]
 
 #------------------------------------------------------------------------------
 class ClientNotConnected(pb.Error):
@@ -37,13 +94,69 @@ class ClientNotConnected(pb.Error):
     client not being connected
     '''
     pass
+
+class NoCascaderAvailable(pb.Error):
+    '''
+    Used when a help request made with requestHelp wasn't accepted by any
+    of the cascaders for the subject
+    '''
+    pass
+
+class BatchFailed(pb.Error):
+    '''
+    Used when one of the calls in a batch raised an error, in which case
+    none of the calls in the batch are applied
+    '''
+    pass
 #------------------------------------------------------------------------------
 # constants
-subjectList = set(["inf1-fp","inf1-cl","inf1-da","inf1-op","inf2a","inf2b","inf2c-cs",
-        "inf2-se","inf2d","Java","Haskell","Python","Ruby","C","C++","PHP",
-        "JavaScript", "Perl", "SQL", "Bash", "Vim", "Emacs", "Eclipse", "Netbeans",
-        "Version Control"])
+PORT = 5010
+
+#seconds over which presence changes are merged before being sent to clients
+BROADCAST_WINDOW = 0.1
+
+#number of presence changes remembered for clients catching up
+PRESENCE_LOG_SIZE = 1024
+
+#seconds between pinging each client to check it is still there
+PING_INTERVAL = 120
 
+#seconds a cascader has to answer a request from requestHelp before it is
+#passed on, and the most cascaders that are asked
+HELP_TIMEOUT = 60
+MAX_HELP_CANDIDATES = 5
+
+#requests that can wait for each cascader, in which order, and the seconds
+#they can wait for
+HELP_QUEUE_DEPTH = 5
+HELP_QUEUE_ORDER = FIFO
+HELP_QUEUE_TIMEOUT = 300
+
+#calls that can be sent together with batch, these only change or get the
+#state of the user making them and return straight away
+BATCHABLE_CALLS = frozenset(['getCascaderList', 'getSubjectList',
+                             'getSubjectCatalog',
+                             'useCompactPresence', 'subscribe',
+                             'startCascading', 'stopCascading',
+                             'addSubjects', 'removeSubjects', 'ping'])
+
+#seconds between checking if the subjects file has changed
+CATALOG_CHECK_INTERVAL = 10
+
+#seconds between removing chat sessions that are no longer used
+CHAT_EXPIRE_INTERVAL = 60
+
+#seconds between writing the stats to the stats file, if there is one
+STATS_INTERVAL = 60
+
+#seconds a user is kept logged in after their client disconnects, so that
+#the client can resume the session with its token without the other clients
+#being told that they left and came back. 0 logs them out straight away
+SESSION_GRACE = 60
+
+#seconds that users loaded from the presence store are kept for after a
+#restart if they don't log back in
+WARM_START_GRACE = 300
 
 
 #maybe not needed. CPython isn't threaded
@@ -52,166 +165,716 @@ data_lock = RLock()
 #global dict of users that are currently logged in
 users = {}
 
+#users logged into other worker processes, username -> RemoteUser
+remoteUsers = {}
+
+#the link to the broker when running as a worker process, otherwise None
+cluster = None
+
+#where the presence of users is kept, see store.py
+presenceStore = MemoryPresenceStore()
+
+#users loaded from the presence store that haven't logged back in since the
+#server started, username -> DetachedUser
+detachedUsers = {}
+
+#what labs hosts are in, used to filter events by lab
+labIndex = loadLabIndex()
+
+#refuses logins when too many arrive at once, see admission.py
+loginBucket = TokenBucket(LOGIN_RATE, LOGIN_BURST)
+
+#the subjects that can be cascaded, see catalog.py
+subjectCatalog = loadSubjectCatalog()
+
+#ids used for subjects and hosts when sending presence to clients
+wireTables = WireTables(subjectCatalog.subjects, labIndex.getHosts())
+
+#who is interested in which cascaders, keyed by username
+subscriptions = SubscriptionIndex()
+
+#versions the presence state so clients can catch up with a delta
+presenceLog = PresenceLog(PRESENCE_LOG_SIZE)
+
+#counts and times calls to and from the server
+rpcStats = RpcStats()
+
+#finds the best cascader for help requests
+matcher = HelpMatcher(labIndex)
+
+#help requests waiting for each cascader, username -> HelpQueue. Only
+#cascaders on this worker have queues here, requests for cascaders on other
+#workers are queued on their worker
+helpQueues = {}
+
+#requests queued here for users on other workers, so they can be cancelled,
+#(cascader username, helpId) -> deferred
+routedHelpRequests = {}
+
+def getHelpQueue(username):
+    ''' Returns the queue for the cascader, which is removed when empty '''
+    try:
+        return helpQueues[username]
+    except KeyError:
+        queue = HelpQueue(HELP_QUEUE_DEPTH, HELP_QUEUE_ORDER,
+                          HELP_QUEUE_TIMEOUT, reactor.callLater,
+                          lambda: helpQueues.pop(username, None))
+        helpQueues[username] = queue
+        return queue
+
+def findUser(username):
+    '''
+    Returns the UserService of the user, the RemoteUser if they are on
+    another worker or the DetachedUser if they haven't logged back in since
+    a restart. Raises KeyError if the user isn't logged in
+    '''
+    try:
+        return users[username]
+    except KeyError:
+        pass
+    try:
+        return remoteUsers[username]
+    except KeyError:
+        return detachedUsers[username]
+
+def getUsernames():
+    ''' Returns the usernames of everyone that can be a cascader '''
+    return users.keys() + remoteUsers.keys() + detachedUsers.keys()
+
+def getPresence(username):
+    ''' Returns the presence of a user, None if not logged in or cascading '''
+    try:
+        return findUser(username).getPresence()
+    except KeyError:
+        return None
+
+def deliverPresence(username, version, changed, left):
+    '''
+    Sends the user the cascaders that have changed and left since the last
+    time it was sent anything, along with the version this brings it up to
+    '''
+    try:
+        user = users[username]
+    except KeyError:
+        return
+    if user.compact is not None:
+        changed = [wireTables.encode(entry, user.compact) for entry in changed]
+    try:
+        user.client.callRemote('cascadersDelta', version, changed, left)
+    except pb.DeadReferenceError:
+        logger.debug('Client wasn\'t connected')
+        user.detach()
+
+def onPresenceFlushed(username, presence):
+    ''' Called by the broadcaster when the presence of a user has changed '''
+    matcher.update(username, presence)
+    publishPresence(username, presence)
+
+def publishPresence(username, presence):
+    ''' Tells the other workers about changes to users on this worker '''
+    if cluster is not None and username in users:
+        try:
+            cluster.publish(username, presence)
+        except pb.DeadReferenceError:
+            logger.warn('Couldn\'t publish presence of %s', username)
+
+def deliverMessages(username, helpId, messages):
+    '''
+    Sends chat lines to a user, wherever they are connected. Raises an
+    exception if they aren't
+    '''
+    return findUser(username).client.callRemote('userSentMessages',
+                                                helpId, messages)
+
+#keeps chat messages until the clients have them
+chatRelay = ChatRelay(deliverMessages, reactor.callLater, reactor.seconds)
+
+#merges presence changes and sends them to the subscribed clients
+broadcaster = PresenceBroadcaster(subscriptions, presenceLog,
+                                  getPresence, deliverPresence,
+                                  reactor.callLater, BROADCAST_WINDOW,
+                                  onPresenceFlushed)
+
+def notifyUserLeft(username):
+    ''' Tells the clients on this server that the user has logged out '''
+    with data_lock:
+        toLogout = []
+        for user in users.itervalues():
+            try:
+                user.client.callRemote('userLeft', username)
+            except pb.DeadReferenceError:
+                logger.debug('Client wasn\'t connected')
+                toLogout.append(user)
+        [u.detach() for u in toLogout]
+
+def pingUser(username):
+    return users[username].client.callRemote('ping')
+
+def pingFailed(username):
+    ''' Called when a client didn't respond to a ping, so isn't connected '''
+    logger.debug('Client wasn\'t connected')
+    try:
+        users[username].detach()
+    except KeyError:
+        pass
+
+#ensures that cascaders who are not connected are removed from the system
+heartbeat = HeartbeatWheel(pingUser, pingFailed, PING_INTERVAL)
+
+def reloadCatalog():
+    '''
+    Reloads the subjects file if it has changed, and if the subjects have
+    changed tells the users on this server
+    '''
+    oldVersion = subjectCatalog.reloadIfChanged()
+    if oldVersion is None:
+        return
+    version, _, added, removed = subjectCatalog.getChanges(oldVersion)
+    logger.info('Subjects added: %s, removed: %s', added, removed)
+    wireTables.addSubjects(added)
+    for user in users.values():
+        user.catalogChanged(oldVersion, version, added, removed)
+
+#------------------------------------------------------------------------------
+# stats
+
+def getStats():
+    ''' Everything that is measured about the server, see rpcstats.py '''
+    return {'time' : rpcStats.clock(),
+            'users' : len(users),
+            'remoteUsers' : len(remoteUsers),
+            'detachedUsers' : len(detachedUsers),
+            'detachedSessions' : sum(1 for user in users.itervalues()
+                                     if user.detached is not None),
+            'queuedHelpRequests' : sum(len(q) for q in helpQueues.values()),
+            'chatSessions' : len(chatRelay.sessions),
+            'subjectCatalog' : subjectCatalog.version,
+            'logins' : loginBucket.getStats(),
+            'rpc' : rpcStats.getStats(),
+            'heartbeat' : heartbeat.getStats(),
+            'log' : [h.getStats() for h in logHandlers]}
+
+def dumpStats(filename):
+    ''' Writes the stats as JSON, replacing the file in one step '''
+    tmpFilename = filename + '.tmp'
+    try:
+        with open(tmpFilename, 'w') as f:
+            json.dump(getStats(), f, indent=1, sort_keys=True)
+        os.rename(tmpFilename, filename)
+    except (IOError, OSError), e:
+        logger.warn('Couldn\'t write the stats to %s: %s', filename, e)
+
+#------------------------------------------------------------------------------
+# starting with the presence from before a restart
+
+def warmStart(store, grace=WARM_START_GRACE):
+    '''
+    Makes the users in the store visible to clients straight away, as if
+    they were still logged in. They are removed if they haven't logged back
+    in after grace seconds
+    '''
+    for username, (hostname, cascading, subjects) in store.getAll():
+        presence = None
+        if cascading:
+            presence = (labIndex.labFromHostname(hostname), hostname, subjects)
+        detachedUsers[username] = DetachedUser(username, hostname, presence)
+        presenceLog.changed(username)
+        matcher.update(username, presence)
+    logger.info('Warm started with %d users', len(detachedUsers))
+    reactor.callLater(grace, expireDetached)
+
+def reattachUser(username):
+    '''
+    Called when a user logs in, if they were loaded from the store they
+    are now a normal user again
+    '''
+    user = detachedUsers.pop(username, None)
+    if user is not None:
+        logger.info('%s reattached after the restart', username)
+        broadcaster.changed(username, user.getPresence())
+
+def expireDetached():
+    ''' Removes the users that didn't log back in after the restart '''
+    logger.info('%d users didn\'t log back in after the restart',
+                len(detachedUsers))
+    for username, user in detachedUsers.items():
+        del detachedUsers[username]
+        broadcaster.changed(username, user.getPresence())
+        presenceStore.remove(username)
+        notifyUserLeft(username)
+
+#------------------------------------------------------------------------------
+# functions called by the broker when running as a worker
+
+def remoteUserJoined(username, workerId, hostname):
+    remoteUsers[username] = RemoteUser(cluster, username, hostname, workerId)
+    chatRelay.userJoined(username)
+
+def remoteUserLeft(username):
+    user = remoteUsers.pop(username, None)
+    if user is not None:
+        broadcaster.changed(username, user.getPresence())
+        notifyUserLeft(username)
+
+def remotePresenceChanged(username, presence):
+    try:
+        user = remoteUsers[username]
+    except KeyError:
+        return
+    broadcaster.changed(username, user.getPresence())
+    user.presence = presence
+
+def deliverToUser(username, method, args):
+    ''' Calls a method on the client of a user on this worker '''
+    try:
+        user = users[username]
+    except KeyError:
+        raise ClientNotConnected(username)
+    try:
+        return user.client.callRemote(method, *args)
+    except pb.DeadReferenceError:
+        logger.debug('Client wasn\'t connected')
+        user.detach()
+        raise ClientNotConnected(username)
+
+def queueRoutedHelp(username, args):
+    '''
+    Called by the broker with a help request for a cascader on this worker
+    from a user on another worker, see queueHelpRequest
+    '''
+    if username not in users:
+        raise ClientNotConnected(username)
+    helpId = args[0]
+    d = queueHelpRequest(username, *args)
+
+    key = (username, getKey(helpId))
+    routedHelpRequests[key] = d
+    def forget(result):
+        routedHelpRequests.pop(key, None)
+        return result
+    d.addBoth(forget)
+    return d
+
+def cancelRoutedHelp(username, helpId):
+    ''' The user on the other worker is no longer waiting for the answer '''
+    d = routedHelpRequests.pop((username, getKey(helpId)), None)
+    if d is not None:
+        d.cancel()
+
+#------------------------------------------------------------------------------
+# help queues
+
+def queueHelpRequest(username, helpId, asker, askerHostname, subject,
+                     problem, priority):
+    '''
+    Puts a request for help in the queue of a cascader on this server, so
+    they are only asked one thing at a time. The asker is told its position
+    in the queue with helpQueuePosition. If the request is cancelled while
+    the cascader is being asked, such as when requestHelp gives up waiting
+    for them, the cascader is told with helpRequestCancelled.
+
+    Returns a deferred firing with the answer of the cascader, raises
+    HelpQueueFull if too many requests are waiting
+    '''
+    def send():
+        try:
+            return findUser(username).client.callRemote('userAskingForHelp',
+                                                        helpId, asker,
+                                                        askerHostname,
+                                                        subject, problem)
+        except KeyError:
+            raise ClientNotConnected(username)
+        except pb.DeadReferenceError:
+            logger.debug('Client wasn\'t connected')
+            if username in users:
+                users[username].detach()
+            raise ClientNotConnected(username)
+
+    def onPosition(position):
+        try:
+            d = findUser(asker).client.callRemote('helpQueuePosition', helpId,
+                                                  username, position)
+        except (KeyError, pb.DeadReferenceError):
+            return
+        d.addErrback(lambda reason: logger.debug('Position not sent: %s',
+                                                 reason.getErrorMessage()))
+
+    def withdraw():
+        logger.info('Request %s from %s to %s was cancelled',
+                    helpId, asker, username)
+        try:
+            d = findUser(username).client.callRemote('helpRequestCancelled',
+                                                     helpId)
+        except (KeyError, pb.DeadReferenceError):
+            return
+        d.addErrback(lambda reason: logger.debug('Cancel not sent: %s',
+                                                 reason.getErrorMessage()))
+
+    return getHelpQueue(username).submit(send, priority, onPosition, withdraw)
+
+def routeHelpRequest(username, args):
+    '''
+    Queues a request with a cascader on another worker, so that there is
+    only one queue for each cascader. Cancelling the returned deferred
+    removes the request from the queue on the other worker
+    '''
+    result = defer.Deferred(lambda _: cluster.cancelHelp(username, args[0]))
+    def onAnswer(answer):
+        #the result has already failed if it was cancelled
+        if not result.called:
+            if isinstance(answer, failure.Failure):
+                result.errback(answer)
+            else:
+                result.callback(answer)
+    cluster.queueHelp(username, args).addBoth(onAnswer)
+    return result
 
+#------------------------------------------------------------------------------
+
+@rpcStats.instrument
 class UserService(pb.Referenceable):
     def __init__(self, client, user, hostname):
-        self.client = client 
         self.user = user
         self.hostname = hostname
         self.stale = False
         self.cascading = False
         self.subjects = set()
+        self.helpCount = 0
+        self.requestCount = 0
+        #if presence is sent to the client encoded with wireTables, the
+        #number of subjects in the table it was sent, otherwise None
+        self.compact = None
+        #the DelayedCall that logs the user out if the client disconnected
+        #and hasn't resumed the session, otherwise None
+        self.detached = None
         users[user] = self
+        #the stored presence isn't written until it changes. After a restart
+        #it still holds what the user was doing before, which the client is
+        #about to restore, and if the server restarts again before it has
+        #then the warm start still has it
+
+        #by default clients are told about everything
+        subscriptions.subscribe(user)
 
-        self.startPingClientLoop()
+        self._attach(client)
 
-    def startPingClientLoop(self):
+    def _attach(self, client):
         '''
-        This ensures that cascaders who are not connected are removed from 
-        the system
+        Starts using a connection to the client. Returns the token that the
+        client can resume the session with if it is disconnected, which
+        changes every time so that it can only be used once
         '''
-        try:
-            self.client.callRemote('ping')
-        except pb.DeadReferenceError:
+        self.remoteClient = client
+        self.client = rpcStats.wrapReference(client)
+        self.resumeToken = os.urandom(16).encode('hex')
+        client.notifyOnDisconnect(self._onDisconnect)
+        heartbeat.add(self.user)
+        return self.resumeToken
+
+    def _onDisconnect(self, client):
+        #the old connection can close after the session has been resumed
+        if client is self.remoteClient:
+            self.detach()
+
+    def detach(self):
+        '''
+        Called when the client is lost. The user stays logged in (and other
+        users still see them) for SESSION_GRACE seconds so that the client
+        can resume the session, after which they are logged out.
+
+        Workers log the user out straight away, as the client could
+        reconnect to another worker which couldn't resume the session
+        '''
+        if self.stale or self.detached is not None:
+            return
+        if cluster is not None or not SESSION_GRACE:
             self.remote_logout()
-        reactor.callLater(120, self.startPingClientLoop)
-    
+            return
+        logger.info('%s disconnected, keeping the session for %ds',
+                    self.user, SESSION_GRACE)
+        self.remoteClient = None
+        self.client = DisconnectedClient()
+        heartbeat.remove(self.user)
+        self.detached = reactor.callLater(SESSION_GRACE, self.remote_logout)
+
+    def resume(self, client):
+        '''
+        Called when the client reconnects with the resume token, the client
+        keeps its state so nothing needs to be sent to the other clients
+        '''
+        if self.detached is not None:
+            self.detached.cancel()
+            self.detached = None
+        logger.info('%s resumed their session', self.user)
+        return self._attach(client)
+
+    def getPresence(self):
+        '''
+        Returns what other clients can see of this user, which is a tuple of
+        the (lab, hostname, subjects) or None if the user isn't cascading
+        '''
+        if not self.cascading:
+            return None
+        return (labIndex.labFromHostname(self.hostname),
+                self.hostname,
+                frozenset(self.subjects))
+
+    def _save(self):
+        ''' Writes the state of the user to the presence store '''
+        presenceStore.set(self.user, self.hostname,
+                          self.cascading, self.subjects)
+
     def remote_logout(self):
         '''
-        Automatically called when the client disconnects
+        Called by the client when the user quits, and when a client that
+        disconnected hasn't resumed the session after SESSION_GRACE seconds
 
         Cleans up after itself and will remove the information from the local lists
         '''
-        logging.info(self.user + "left")
+        logger.info("%s left", self.user)
         if self.stale:
             return
         self.stale = True
+        if self.detached is not None and self.detached.active():
+            self.detached.cancel()
+
+        broadcaster.changed(self.user, self.getPresence())
+        self.cascading = False
 
         del users[self.user] 
+        presenceStore.remove(self.user)
+        subscriptions.unsubscribe(self.user)
+        heartbeat.remove(self.user)
+
+        if cluster is not None:
+            try:
+                cluster.release(self.user)
+            except pb.DeadReferenceError:
+                logger.warn('Couldn\'t tell the broker %s left', self.user)
 
         #Need to inform other clients 
-        with data_lock:
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    if user.cascading:
-                        user.client.callRemote('cascaderLeft', self.user)
-                    user.client.callRemote('userLeft', self.user)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
+        notifyUserLeft(self.user)
+
+    def remote_subscribe(self, subjects=None, labs=None):
+        '''
+        Called by the client to set which cascaders it wants to be told about,
+        this should match the filters the user has applied so that the client
+        isn't sent events that it would just ignore.
+
+        subjects - list of subjects, or None for all subjects
+        labs - list of labs, or None for all labs
+
+        Changing the subscription doesn't send the client anything, it should
+        call getCascaderList to get the cascaders that match the subscription
+        '''
+        subscriptions.subscribe(self.user, subjects, labs)
+        logger.info("%s subscribed to subjects %s in labs %s",
+                    self.user, subjects, labs)
 
     def remote_startCascading(self):
         '''
         Called by the client when the user wants to start cascading
 
-        It will also envoke cascaderJoined in all the clients connected to let them
-        know that the user has started cascading and to update their local lists
+        The clients subscribed to the cascader are told that the user has
+        started cascading in their next cascadersDelta so they can update
+        their local lists
         '''
 
+        broadcaster.changed(self.user, self.getPresence())
         self.cascading = True
-        logger.info(self.user + " is going to start cascading")
-        with data_lock:
-            #Need to inform all other clients that this cascader has joined
-            toLogout = []
-            for user in users.itervalues():
-                #This a remote procedure call to the client
-                try:
-                    user.client.callRemote('cascaderJoined', self.user,
-                                            self.hostname, self.subjects)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " has started cascading")
+        self._save()
+        logger.info("%s has started cascading", self.user)
 
     def remote_stopCascading(self):
         '''
         Call by the client when the user wants to stop cascading
 
-        It will also envoke cascaderLeft on all of the clients connected to let 
-        them know to update their local lists
+        The clients subscribed to the cascader are told it left in their next
+        cascadersDelta so they can update their local lists
         '''
 
+        broadcaster.changed(self.user, self.getPresence())
         self.cascading = False
-        with data_lock:
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    user.client.callRemote('cascaderLeft', self.user)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " has stopped cascading")
+        self._save()
+        logger.info("%s has stopped cascading", self.user)
 
     def remote_addSubjects(self, subjects):
         '''
         Called by the client when the user adds some subjects to their collections
 
-        It will also envoke casscaderAddedSubjects on all clients connected to 
-        notify them and so they can update their local lists
+        The clients subscribed to the cascader are sent the new subjects in
+        their next cascadersDelta so they can update their local lists
         '''
 
-        #strip out things not listed in the valid subjects
-        subjects = set(subjects).intersection(subjectList)
+        #strip out things not listed in the valid subjects, and use the
+        #catalogs name for the rest
+        subjects = subjectCatalog.normalize(subjects)
 
         with data_lock:
+            broadcaster.changed(self.user, self.getPresence())
             self.subjects.update(subjects)
-            if self.cascading: #don't need to inform if not cascaing
-                toLogout = []
-                for user in users.itervalues():
-                    try:
-                        user.client.callRemote('cascaderAddedSubjects', self.user, subjects)
-                    except pb.DeadReferenceError:
-                        logger.debug('Client wasn\'t connected')
-                        toLogout.append(user)
-                [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " added " + str(list(subjects)) + " to their subject list")
+            self._save()
+
+        logger.info("%s added %s to their subject list",
+                    self.user, list(subjects))
 
     def remote_removeSubjects(self, subjects):
         '''
         Called by the client when the user removes some subjects from their 
         collection
 
-        It will also envoke cascaderRemovedSubjects on all clients connected to 
-        notify them and so they can update their local lists
+        The clients subscribed to the cascader are sent the remaining subjects
+        in their next cascadersDelta so they can update their local lists
         '''
-        subjects = set(subjects).intersection(subjectList)
+        subjects = subjectCatalog.normalize(subjects)
 
         with data_lock:
+            broadcaster.changed(self.user, self.getPresence())
             self.subjects = self.subjects - set(subjects)
+            self._save()
 
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    user.client.callRemote('cascaderRemovedSubjects', self.user, subjects)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
+        logger.info("%s removed %s from their list",
+                    self.user, list(subjects))
 
-        logger.info(self.user + " removed " + str(list(subjects)) + " from their list")
+    def catalogChanged(self, sinceVersion, version, added, removed):
+        '''
+        Called when the subjects file has been reloaded. Subjects the user
+        has that were removed are dropped, or replaced by the new name if
+        they were renamed, and the client is sent the changes
+        '''
+        subjects = subjectCatalog.normalize(self.subjects)
+        if subjects != self.subjects:
+            with data_lock:
+                broadcaster.changed(self.user, self.getPresence())
+                self.subjects = subjects
+                self._save()
 
-    def remote_getCascaderList(self):
+        try:
+            d = self.client.callRemote('subjectCatalogChanged', sinceVersion,
+                                       version, added, removed)
+        except pb.DeadReferenceError:
+            logger.debug('Client wasn\'t connected')
+            self.detach()
+            return
+        d.addErrback(lambda reason: logger.debug('Subject changes not sent '
+                                                 'to %s: %s', self.user,
+                                                 reason.getErrorMessage()))
+
+    def _canSee(self, presence):
+        ''' Checks if this user is subscribed to a cascader with the presence '''
+        if presence is None:
+            return False
+        lab, _, subjects = presence
+        return subscriptions.matches(self.user, lab, subjects)
+
+    def remote_getCascaderList(self, sinceVersion=None):
         '''
         Called by the client requesting a list of the current cascaders operating
         with their usernames, hostnames and the subjects they are cascading on.
+        Only cascaders that match the clients subscription are returned
 
-        Will return a list of 3 item tuples, each with the username and hostname as
-        string and the list of subjects as a list
+        sinceVersion - the version the client last saw, from this or from
+                       cascadersDelta. If the server still knows what has
+                       changed since then, only the changes are returned
+
+        Will return a tuple of (version, isSnapshot, changed, left). changed
+        is a list of 3 item tuples, each with the username and hostname as
+        string and the set of subjects. If isSnapshot is true then changed
+        is every cascader and left is empty, otherwise left is a list of
+        usernames to remove
         '''
 
         with data_lock:
-            returnvalue = [(value.user, value.hostname, value.subjects)
-                            for value in users.itervalues() if value.cascading]
-        logger.info(self.user + " asked for the cascader list")
-        return returnvalue
+            version = presenceLog.getVersion()
+            changedUsers = presenceLog.changedSince(sinceVersion)
+
+            #a snapshot is cheaper if most people have changed anyway
+            usernames = getUsernames()
+            isSnapshot = (changedUsers is None or
+                          len(changedUsers) > len(usernames))
+            if isSnapshot:
+                changedUsers = usernames
+
+            changed = []
+            left = []
+            for username in changedUsers:
+                presence = getPresence(username)
+                if self._canSee(presence):
+                    _, hostname, subjects = presence
+                    entry = (username, hostname, set(subjects))
+                    if self.compact is not None:
+                        entry = wireTables.encode(entry, self.compact)
+                    changed.append(entry)
+                elif not isSnapshot:
+                    left.append(username)
+
+        logger.info("%s asked for the cascader list, sent %d of them",
+                    self.user, len(changed))
+        return (version, isSnapshot, changed, left)
     
+    def remote_useCompactPresence(self, hostsDigest=None):
+        '''
+        Called by the client to be sent presence in the compact encoding
+        from wire.py, where hosts are ids and subjects are a bitmask. This
+        lasts until the client disconnects. Subjects added to the catalog
+        after this are sent by name until it is called again
+
+        hostsDigest - wire.hostsDigest of the hosts the client has
+
+        Returns a tuple of (subjects, hosts), the subjects in the order of
+        their ids and the hosts in the order of their ids, or None if the
+        client already has the same hosts
+        '''
+        subjects, hosts = wireTables.getTables(hostsDigest)
+        self.compact = len(subjects)
+        logger.info("%s is using compact presence", self.user)
+        return subjects, hosts
+
+    def remote_batch(self, calls):
+        '''
+        Called by the client with a list of (name, args, kwargs) of calls it
+        made one after another, so that they only need one round trip.
+
+        The calls are applied in order without anything else happening in
+        between, so any presence changes go out together. The batch is
+        applied as a whole, if any of the calls isn't in BATCHABLE_CALLS
+        then none of them are applied and if one of them fails then the
+        user is put back the way they were before the batch and BatchFailed
+        is raised. As presence changes are only sent when the broadcaster
+        flushes, which can't happen during the batch, nobody is told about
+        the calls that were undone
+
+        Returns a list of the result of each call
+        '''
+        for name, args, kwargs in calls:
+            if name not in BATCHABLE_CALLS:
+                raise pb.Error('%s can\'t be batched' % name)
+
+        results = []
+        with data_lock:
+            before = (self.cascading, set(self.subjects), self.compact,
+                      subscriptions.getSubscription(self.user))
+            for name, args, kwargs in calls:
+                try:
+                    results.append(getattr(self, 'remote_' + name)(*args,
+                                                                   **kwargs))
+                except Exception, e:
+                    logger.warn('Batched %s from %s failed, undoing the '
+                                'batch: %s', name, self.user, e)
+                    self._restore(*before)
+                    raise BatchFailed('%s failed: %s: %s' %
+                                      (name, e.__class__.__name__, e))
+        return results
+
+    def _restore(self, cascading, subjects, compact, subscription):
+        ''' Puts back the state from before a batch that failed '''
+        if (cascading, subjects) != (self.cascading, self.subjects):
+            self.cascading = cascading
+            self.subjects = subjects
+            self._save()
+        self.compact = compact
+        subscriptions.subscribe(self.user, *subscription)
+
     def remote_getSubjectList(self):
         '''
         Called by the client requesting a list of the current subjects that can 
@@ -220,8 +883,20 @@ class UserService(pb.Referenceable):
         Will return as a list
         '''
 
-        logger.info(self.user + " asked for the subject list")
-        return subjectList
+        logger.info("%s asked for the subject list", self.user)
+        return set(subjectCatalog.subjects)
+
+    def remote_getSubjectCatalog(self, sinceVersion=None):
+        '''
+        Called by the client to check its cached copy of the subjects is up
+        to date. Returns a tuple of (version, isSnapshot, added, removed),
+        see SubjectCatalog.getChanges
+
+        sinceVersion - the version of the catalog the client has cached
+        '''
+        if sinceVersion != subjectCatalog.version:
+            logger.info("%s was sent the subject catalog", self.user)
+        return subjectCatalog.getChanges(sinceVersion)
 
     def remote_askForHelp(self, helpId, username, subject, problem):
         '''
@@ -234,30 +909,131 @@ class UserService(pb.Referenceable):
         The helpId variable is generated by the client and should just be passed on
         '''
 
-        logger.info(self.user + " asked " + username + " for help on " + problem + \
-                " in the subject " + subject)
-        try:
-            deferred = users[username].client.callRemote('userAskingForHelp',
-                                                          helpId, self.user,
-                                                          self.hostname,
-                                                          subject, problem) 
-        except pb.DeadReferenceError:
-            logger.debug('Client wasn\'t connected')
-            users[username].remote_logout()
+        logger.info("%s asked %s for help on %s in the subject %s",
+                    self.user, username, problem, subject)
+        if username not in users and username not in remoteUsers:
             raise ClientNotConnected(username)
-
-        cb = lambda res : self.onAskForHelpResponse(helpId, username, res)
-        deferred.addCallback(cb)
+        deferred = self._queueHelpRequest(helpId, username, subject, problem)
+
+        #requests made directly still count towards how busy the cascader is
+        matcher.requestStarted(username)
+        def cb(res):
+            matcher.requestFinished(username, res[0])
+            return self.onAskForHelpResponse(helpId, username, subject, res)
+        def onError(reason):
+            matcher.requestFinished(username, False)
+            return reason
+
+        deferred.addCallbacks(cb, onError)
         return deferred 
 
-    def onAskForHelpResponse(self, helpId, cascUsername, result):
+    def _queueHelpRequest(self, helpId, username, subject, problem):
+        '''
+        Puts a request for help in the queue of the cascader, on the worker
+        the cascader is connected to. With priority ordering users that have
+        made fewer requests go first
+
+        Returns a deferred firing with the answer of the cascader, raises
+        HelpQueueFull if too many requests are waiting (or the deferred fails
+        with it, if the cascader is on another worker) and KeyError if the
+        cascader isn't logged in. The request is only audited once it has
+        been queued or sent to the other worker
+        '''
+        priority = self.requestCount
+        args = (helpId, self.user, self.hostname, subject, problem, priority)
+        if isinstance(findUser(username), RemoteUser):
+            d = routeHelpRequest(username, args)
+        else:
+            d = queueHelpRequest(username, *args)
+        self.requestCount += 1
+        audit.helpRequested(auditLogger, helpId, self.user, username,
+                            subject, problem)
+        return d
+
+    def remote_requestHelp(self, subject, problem, helpId=None):
+        '''
+        Called when the client wants help with a subject from whoever is
+        best placed to give it. The cascaders for the subject are asked one
+        at a time, closest and least busy first, until one of them accepts.
+        Cascaders that reject the request, have a full queue or don't
+        answer within HELP_TIMEOUT seconds (including time in their queue)
+        are skipped
+
+        helpId - as for askForHelp, if it isn't given the server makes one
+
+        Returns a deferred that fires with a tuple of (helpId, username,
+        hostname) of the cascader that accepted, or fails with
+        NoCascaderAvailable
+        '''
+        if helpId is None:
+            self.helpCount += 1
+            helpId = (self.user, 'request%d' % self.helpCount)
+        subject = subjectCatalog.getSubject(subject) or subject
+
+        logger.info("%s requested help on %s in the subject %s",
+                    self.user, problem, subject)
+
+        result = defer.Deferred()
+        asked = [self.user]
+
+        def askNext():
+            candidates = matcher.candidates(subject, self.hostname, asked)
+            if not candidates or len(asked) > MAX_HELP_CANDIDATES:
+                logger.info("Nobody accepted the request of %s", self.user)
+                result.errback(NoCascaderAvailable(subject))
+                return
+
+            username = candidates[0]
+            asked.append(username)
+            try:
+                user = findUser(username)
+                d = self._queueHelpRequest(helpId, username, subject, problem)
+            except KeyError:
+                logger.debug('Client wasn\'t connected')
+                askNext()
+                return
+            except HelpQueueFull:
+                logger.debug('%s has too many requests waiting', username)
+                askNext()
+                return
+
+            matcher.requestStarted(username)
+            d = withTimeout(d, HELP_TIMEOUT, reactor.callLater)
+            d.addCallbacks(onAnswer, onNoAnswer,
+                           callbackArgs=(username, user.hostname),
+                           errbackArgs=(username,))
+
+        def onAnswer(answer, username, hostname):
+            accepted, why = answer
+            matcher.requestFinished(username, accepted)
+            if accepted:
+                self.onAskForHelpResponse(helpId, username, subject, answer)
+                result.callback((helpId, username, hostname))
+            else:
+                logger.info("%s said no: %s", username, why)
+                audit.helpAnswered(auditLogger, helpId, self.user, username,
+                                   subject, accepted, why)
+                askNext()
+
+        def onNoAnswer(reason, username):
+            matcher.requestFinished(username, False)
+            logger.info("%s didn't answer: %s",
+                        username, reason.getErrorMessage())
+            askNext()
+
+        askNext()
+        return result
+
+    def onAskForHelpResponse(self, helpId, cascUsername, subject, result):
         '''
         Deals with logging from the cascaders response for asking for hlp
         '''
         (answer,why) = result
+        audit.helpAnswered(auditLogger, helpId, self.user, cascUsername,
+                           subject, answer, why)
 
         if answer:
-            logger.info(cascUsername + "said yes, help is now being given")
+            logger.info("%s said yes, help is now being given", cascUsername)
 
             msg = cascUsername + ' accepted your help request' 
             self.client.callRemote('serverSentMessage', helpId, msg)
@@ -268,44 +1044,49 @@ class UserService(pb.Referenceable):
             for m in messages:
                 self.client.callRemote('serverSentMessage', helpId, m)
         else:
-            logger.info(cascUsername + "said no: " + why)
+            logger.info("%s said no: %s", cascUsername, why)
 
             msg = cascUsername + ' rejected your help request' 
             self.client.callRemote('serverSentMessage', helpId, msg)
 
-    def remote_sendMessage(self, helpId, toUser, message):
+    def remote_sendMessage(self, helpId, toUser, message, number=None):
         '''
         Called when the client is wanting to send a message to another client
 
-        This will call a local function on the clients instance on the server
-        which will send the message down
+        The message is added to the chat session for the helpId and is sent
+        to the other client with userSentMessages, batched with any others.
+        If the other client isn't connected it gets the message when it
+        reconnects
 
         HelpId is generated by the client and should just be passed on
-        '''
 
-        try:
-            users[toUser].message(helpId, message)
-        except pb.DeadReferenceError:
-            logger.debug('Client wasn\'t connected')
-            self.remote_logout()
-
-        logger.info(self.user + "->" + toUser + ":" + message)
+        number - the clients number for the message, numbers should increase
+                 for each message in a session. Messages with a number that
+                 was already received are ignored
 
-    def message(self, helpId, message):
+        Returns the number of the last message received from this client in
+        the session
         '''
-        Called when some other client on the server wants to send a message to 
-        the client respective to this object
+        received = chatRelay.send(helpId, self.user, toUser, message, number)
+        if number is not None and received != number:
+            logger.debug("%s sent message %s again", self.user, number)
+            return received
 
-        Calls a function on the client connected
+        logger.info("%s->%s:%s", self.user, toUser, message)
+        audit.messageSent(auditLogger, helpId, self.user, toUser, message)
+        return received
 
-        helpID is generated by the client and should just be passed on
+    def remote_resumeChat(self, helpId, lastMessage):
         '''
+        Called by the client after reconnecting for each chat it has open
 
-        try:
-            self.client.callRemote('userSentMessage', helpId, message)
-        except pb.DeadReferenceError:
-            logger.debug('Client wasn\'t connected')
-            self.remote_logout()
+        lastMessage - the number of the last message the client got in
+                      userSentMessages, or 0. Later messages are sent again
+
+        Returns the number of the last message the server received from the
+        client, any later ones should be sent again
+        '''
+        return chatRelay.resume(helpId, self.user, lastMessage)
 
     def remote_ping(self):
         ''' Can be used to see that the server is up and functioning '''
@@ -315,19 +1096,191 @@ class UserService(pb.Referenceable):
         raise NotImplementedError('In your dreams')
 
 
+@rpcStats.instrument
 class LoginService(pb.Root):
     ''' 
     Provides a service that requires the user to login before being able
     to access other methods. This reduces the amount of checks required
     in the UserService class
     '''
-    def remote_userJoin(self, client, username, hostname):
-        if username in users:
+    def remote_userJoin(self, client, username, hostname, resumeToken=None):
+        '''
+        Logs the user in, returning a tuple of the UserService for the
+        client to call, the token the client can resume the session with
+        after a disconnect, and if an existing session was resumed
+
+        resumeToken - the token from the last time the client logged in.
+                      Without it, a login from the same host as a session
+                      that is waiting to be resumed replaces that session,
+                      as the client was probably restarted
+        '''
+        user = users.get(username)
+        #compared in constant time so the token can't be guessed by timing
+        if (user is not None and isinstance(resumeToken, str) and
+                hmac.compare_digest(resumeToken, user.resumeToken)):
+            token = user.resume(client)
+            chatRelay.userJoined(username)
+            return user, token, True
+
+        takeOver = (user is not None and user.detached is not None and
+                    user.hostname == hostname)
+
+        #checked first so that logins that are refused anyway don't use up
+        #tokens that other logins could have had
+        if not takeOver and (username in users or username in remoteUsers):
             raise ValueError("Username in use")
-        else:
-            return UserService(client, username, hostname)
+
+        #the client waits for at least this long before trying again
+        retryAfter = loginBucket.take()
+        if retryAfter:
+            raise LoginThrottled('%.2f' % retryAfter)
+
+        if takeOver:
+            logger.info('%s logged in again from %s, ending the old session',
+                        username, hostname)
+            user.remote_logout()
+
+        if cluster is None:
+            reattachUser(username)
+            return self._join(client, username, hostname)
+
+        #the username could be in use on another worker
+        def onClaimed(claimed):
+            if not claimed or username in users:
+                loginBucket.giveBack()
+                raise ValueError("Username in use")
+            return self._join(client, username, hostname)
+
+        d = cluster.claim(username, hostname)
+        d.addCallback(onClaimed)
+        return d
+
+    def _join(self, client, username, hostname):
+        user = UserService(client, username, hostname)
+        chatRelay.userJoined(username)
+        return user, user.resumeToken, False
+
+    def remote_getStats(self):
+        '''
+        Returns the stats of this server (or worker), which don't need a
+        login so that monitoring doesn't take up a username. This is a dict
+        holding the number of users, the stats of calls to and from clients
+        keyed by method name, and the stats of the heartbeat and logging
+        '''
+        return getStats()
 
 if __name__ == "__main__":
-    reactor.listenTCP(5010, pb.PBServerFactory(LoginService()))
+    parser = OptionParser()
+    parser.add_option('-w', '--broadcast-window', type='float',
+                      default=BROADCAST_WINDOW,
+                      help=('seconds over which presence changes are merged '
+                            'before being sent to clients'))
+    parser.add_option('-p', '--port', type='int', default=PORT,
+                      help='port to listen for clients on')
+    parser.add_option('-n', '--workers', type='int', default=0,
+                      help=('number of worker processes to run behind the '
+                            'port, by default everything is in one process'))
+    parser.add_option('-s', '--store', metavar='FILE',
+                      help=('keep the presence of users in this SQLite '
+                            'database, so it survives a restart'))
+    parser.add_option('', '--help-queue-depth', type='int',
+                      default=HELP_QUEUE_DEPTH,
+                      help='help requests that can wait for each cascader')
+    parser.add_option('', '--help-queue-order', choices=ORDERINGS,
+                      default=HELP_QUEUE_ORDER,
+                      help=('order help requests are given to a cascader: '
+                            + ', '.join(ORDERINGS)))
+    parser.add_option('', '--help-queue-timeout', type='float',
+                      default=HELP_QUEUE_TIMEOUT,
+                      help='seconds a help request can wait for a cascader')
+    parser.add_option('', '--session-grace', type='float',
+                      default=SESSION_GRACE,
+                      help=('seconds a user stays logged in after their '
+                            'client disconnects, so it can resume the '
+                            'session'))
+    parser.add_option('', '--login-rate', type='float', default=LOGIN_RATE,
+                      help=('logins a second that are let in once the burst '
+                            'has been used, shared between the workers'))
+    parser.add_option('', '--login-burst', type='int', default=LOGIN_BURST,
+                      help='logins that can happen at once')
+    parser.add_option('', '--stats-file', metavar='FILE',
+                      help='periodically write the call stats to this file')
+    parser.add_option('', '--stats-interval', type='float',
+                      default=STATS_INTERVAL,
+                      help='seconds between writing the stats file')
+    parser.add_option('', '--worker-id', type='int', help=SUPPRESS_HELP)
+    parser.add_option('', '--listen-fd', type='int', help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    if options.store and (options.workers > 0 or options.worker_id is not None):
+        parser.error('--store can\'t be used with --workers')
+
+    workerArgs = ['--broadcast-window', str(options.broadcast_window),
+                  '--stats-interval', str(options.stats_interval),
+                  '--help-queue-depth', str(options.help_queue_depth),
+                  '--help-queue-order', options.help_queue_order,
+                  '--help-queue-timeout', str(options.help_queue_timeout),
+                  '--login-rate',
+                  str(options.login_rate / max(options.workers, 1)),
+                  '--login-burst',
+                  str(max(options.login_burst // max(options.workers, 1), 1))]
+    if options.stats_file:
+        workerArgs += ['--stats-file', options.stats_file]
+
+    if options.worker_id is not None:
+        workerId = options.worker_id
+        handlers = setupLogging('cascader-w%d.log' % workerId,
+                                '-w%d' % workerId)
+        if options.stats_file:
+            options.stats_file += '-w%d' % workerId
+
+        cluster = WorkerLink(workerId, remoteUserJoined, remoteUserLeft,
+                             remotePresenceChanged, deliverToUser,
+                             queueRoutedHelp, cancelRoutedHelp)
+
+        def onConnectFailed(reason):
+            logger.error('Worker %d couldn\'t reach the broker: %s',
+                         workerId, reason.getErrorMessage())
+            reactor.stop()
+
+        #only accept clients once we know who is on the other workers
+        d = cluster.connect()
+        d.addCallback(lambda _: adoptListeningSocket(options.listen_fd,
+                                    pb.PBServerFactory(LoginService())))
+        d.addErrback(onConnectFailed)
+    elif options.workers > 0:
+        handlers = setupLogging()
+        listeningSocket = runMaster(options.port, options.workers, workerArgs)
+    else:
+        handlers = setupLogging()
+        if options.store:
+            presenceStore = SqlitePresenceStore(options.store)
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                                          presenceStore.close)
+            warmStart(presenceStore)
+        reactor.listenTCP(options.port, pb.PBServerFactory(LoginService()))
+
+    for handler in handlers:
+        reactor.addSystemEventTrigger('after', 'shutdown', handler.close)
+
+    broadcaster.window = options.broadcast_window
+    HELP_QUEUE_DEPTH = options.help_queue_depth
+    HELP_QUEUE_ORDER = options.help_queue_order
+    HELP_QUEUE_TIMEOUT = options.help_queue_timeout
+    SESSION_GRACE = options.session_grace
+    loginBucket.rate = options.login_rate
+    loginBucket.burst = options.login_burst
+    loginBucket.tokens = float(options.login_burst)
+
+    #the master doesn't serve clients so has no stats
+    if options.stats_file and options.workers == 0:
+        statsDump = task.LoopingCall(dumpStats, options.stats_file)
+        statsDump.start(options.stats_interval, now=False)
+    if options.workers == 0:
+        heartbeat.start()
+        task.LoopingCall(chatRelay.expire).start(CHAT_EXPIRE_INTERVAL,
+                                                 now=False)
+        task.LoopingCall(reloadCatalog).start(CATALOG_CHECK_INTERVAL,
+                                              now=False)
+
     logger.info("Spinning the server up, stand by")
     reactor.run()
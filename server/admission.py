@@ -0,0 +1,77 @@
+'''
+Limits how quickly users can log in, so that when the server restarts and
+every lab machine reconnects at once, the logins (and the cascader lists
+and subjects they fetch) are spread out rather than all arriving together.
+
+Logins take a token from a bucket that refills at a fixed rate. When it is
+empty the login is refused with LoginThrottled, whose message is the
+number of seconds the client should wait before trying again
+'''
+from twisted.spread import pb
+
+#logins a second once the burst has been used
+LOGIN_RATE = 20
+
+#logins that can happen at once
+LOGIN_BURST = 50
+
+class LoginThrottled(pb.Error):
+    ''' Too many logins, the message is the seconds to wait for '''
+    pass
+
+
+class TokenBucket(object):
+    '''
+    >>> now = [0]
+    >>> bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0])
+    >>> bucket.take(), bucket.take(), bucket.take()
+    (0, 0, 0.5)
+    >>> now[0] = 0.5
+    >>> bucket.take(), bucket.take()
+    (0, 0.5)
+    >>> bucket.giveBack()
+    >>> bucket.take()
+    0
+    '''
+    def __init__(self, rate=LOGIN_RATE, burst=LOGIN_BURST, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor.seconds
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+
+        self.tokens = float(burst)
+        self.updated = clock()
+
+        #logins let in and refused, for the stats
+        self.admitted = 0
+        self.refused = 0
+
+    def take(self):
+        '''
+        Takes a token if there is one and returns 0, otherwise returns the
+        seconds until there will be one
+        '''
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.admitted += 1
+            return 0
+        self.refused += 1
+        return (1 - self.tokens) / self.rate
+
+    def giveBack(self):
+        ''' Returns a token taken by a login that then failed '''
+        self.tokens = min(self.burst, self.tokens + 1)
+        self.admitted -= 1
+
+    def getStats(self):
+        return {'admitted' : self.admitted,
+                'refused' : self.refused,
+                'rate' : self.rate,
+                'burst' : self.burst}
@@ -0,0 +1,123 @@
+'''
+Logging that doesn't do IO on the reactor thread. Records are put on a
+bounded queue and a background thread formats them and passes them to the
+real handlers in batches
+'''
+import logging
+import logging.handlers
+import threading
+import Queue
+
+class BatchFlushMixin(object):
+    '''
+    Mixin for stream based handlers so that they don't flush after every
+    record but only when flushBatch is called, so a batch of records becomes
+    a single write
+    '''
+    def flush(self):
+        pass
+
+    def flushBatch(self):
+        super(BatchFlushMixin, self).flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin,
+                                    logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+class AsyncHandler(logging.Handler):
+    '''
+    Handler that puts records onto a queue, which are then handled by the
+    target handlers in a background thread.
+
+    Messages are only formatted in the background thread, so callers should
+    pass arguments to the logger rather than building strings and shouldn't
+    pass objects that they are going to change.
+
+    When the queue is full records are either dropped (and counted) or the
+    caller blocks until there is space, depending on block
+    '''
+
+    _stop = object()
+
+    def __init__(self, handlers, maxSize=10000, block=False, batchSize=256):
+        '''
+        handlers - the handlers that records are passed on to
+        maxSize - the most records that can be waiting to be written
+        block - if true, wait for space when the queue is full rather than
+                dropping the record
+        batchSize - the most records written before flushing
+        '''
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.block = block
+        self.batchSize = batchSize
+        self.queue = Queue.Queue(maxSize)
+
+        self.dropped = 0
+        self.reportedDropped = 0
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='AsyncHandler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put(record, self.block)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _getBatch(self):
+        ''' Blocks for a record then gets any others that are waiting '''
+        batch = [self.queue.get()]
+        while len(batch) < self.batchSize:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._getBatch()
+            stop = self._stop in batch
+            if stop:
+                batch = [r for r in batch if r is not self._stop]
+
+            dropped = self.dropped
+            if dropped != self.reportedDropped:
+                batch.append(logging.makeLogRecord({
+                    'name' : __name__,
+                    'levelno' : logging.WARNING,
+                    'levelname' : 'WARNING',
+                    'msg' : 'Log queue was full, %d records dropped so far',
+                    'args' : (dropped,)}))
+                self.reportedDropped = dropped
+
+            for handler in self.handlers:
+                for record in batch:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                getattr(handler, 'flushBatch', handler.flush)()
+
+            if stop:
+                return
+
+    def getStats(self):
+        return {'queued' : self.queue.qsize(),
+                'dropped' : self.dropped}
+
+    def close(self):
+        ''' Writes out everything in the queue and stops the thread '''
+        if self.thread.isAlive():
+            self.queue.put(self._stop)
+            self.thread.join()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
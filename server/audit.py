@@ -0,0 +1,185 @@
+'''
+Structured audit log of help requests, responses and messages.
+
+Records are appended to a weekly data file as length prefixed binary records
+and for every record a fixed size entry is written to an index file beside
+it. The index holds the time, type, outcome and a hash of the subject along
+with the offset of the record, so that queries (see auditquery.py) can skip
+most records without decoding them.
+
+Data file record: <I length> then the body
+    body: <B type> <d time> <b accepted> then 5 strings, each <H length> utf8
+          helpId, fromUser, toUser, subject, text
+Index file entry: <d time> <B type> <b accepted> <I subject hash> <Q offset>
+
+Writing is done by AuditHandler, a logging handler, so that it can sit behind
+an AsyncHandler and keep the IO off the reactor thread
+'''
+import os
+import time
+import struct
+import zlib
+import logging
+
+HELP_REQUEST = 1
+HELP_RESPONSE = 2
+MESSAGE = 3
+
+TYPE_NAMES = {HELP_REQUEST : 'request',
+              HELP_RESPONSE : 'response',
+              MESSAGE : 'message'}
+
+#value of accepted for records that aren't responses
+NO_ANSWER = -1
+
+LENGTH = struct.Struct('<I')
+HEADER = struct.Struct('<Bdb')
+STRING_LENGTH = struct.Struct('<H')
+INDEX_ENTRY = struct.Struct('<dBbIQ')
+
+DATA_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+def subjectHash(subject):
+    ''' Hash used for the subject in the index '''
+    return zlib.crc32(_toBytes(subject)) & 0xffffffff
+
+def _toBytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def _helpIdString(helpId):
+    ''' helpIds from the client are a tuple of (username, unique id) '''
+    if isinstance(helpId, (tuple, list)):
+        return ':'.join(_toBytes(x) for x in helpId)
+    return _toBytes(helpId)
+
+def encodeRecord(recordType, timestamp, accepted, helpId,
+                 fromUser, toUser, subject, text):
+    '''
+    Encodes a record, including the length prefix
+
+    >>> data = encodeRecord(HELP_REQUEST, 10.0, NO_ANSWER, ('me', '1'),
+    ...                     'me', 'you', 'inf2b', 'help')
+    >>> decodeRecord(data, 0)
+    (1, 10.0, -1, 'me:1', 'me', 'you', 'inf2b', 'help')
+    '''
+    strings = []
+    for value in (_helpIdString(helpId), fromUser, toUser, subject, text):
+        value = _toBytes(value)[:0xffff]
+        strings.append(STRING_LENGTH.pack(len(value)))
+        strings.append(value)
+    body = HEADER.pack(recordType, timestamp, accepted) + ''.join(strings)
+    return LENGTH.pack(len(body)) + body
+
+def decodeRecord(buff, offset):
+    '''
+    Decodes the record at the offset in buff, which can be any buffer such
+    as a string or a mmap. Returns a tuple of
+    (type, time, accepted, helpId, fromUser, toUser, subject, text)
+    '''
+    offset += LENGTH.size
+    recordType, timestamp, accepted = HEADER.unpack_from(buff, offset)
+    offset += HEADER.size
+
+    strings = []
+    for _ in xrange(5):
+        (length,) = STRING_LENGTH.unpack_from(buff, offset)
+        offset += STRING_LENGTH.size
+        strings.append(buff[offset:offset + length])
+        offset += length
+    return (recordType, timestamp, accepted) + tuple(strings)
+
+def getFilenameBase(directory, timestamp, suffix=''):
+    '''
+    Files are rotated weekly, so are named after the year and week. The
+    suffix is used to keep processes that are writing at once apart
+    '''
+    week = time.strftime('%Y-%W', time.localtime(timestamp))
+    return os.path.join(directory, 'audit-%s%s' % (week, suffix))
+
+
+class AuditHandler(logging.Handler):
+    '''
+    Writes records that have an audit attribute, which should be a tuple
+    of (type, accepted, helpId, fromUser, toUser, subject, text), to the
+    audit files in the directory. Other records are ignored
+    '''
+    def __init__(self, directory, suffix=''):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.suffix = suffix
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.base = None
+        self.dataFile = None
+        self.indexFile = None
+
+    def _open(self, timestamp):
+        base = getFilenameBase(self.directory, timestamp, self.suffix)
+        if base == self.base:
+            return
+        self._closeFiles()
+        self.base = base
+        self.dataFile = open(base + DATA_SUFFIX, 'ab')
+        self.indexFile = open(base + INDEX_SUFFIX, 'ab')
+
+    def _closeFiles(self):
+        for f in (self.dataFile, self.indexFile):
+            if f is not None:
+                f.close()
+        self.dataFile = self.indexFile = None
+
+    def emit(self, record):
+        try:
+            audit = record.audit
+        except AttributeError:
+            return
+        try:
+            recordType, accepted, helpId, fromUser, toUser, subject, text = audit
+            self._open(record.created)
+
+            data = encodeRecord(recordType, record.created, accepted, helpId,
+                                fromUser, toUser, subject, text)
+            offset = self.dataFile.tell()
+            self.dataFile.write(data)
+            self.indexFile.write(INDEX_ENTRY.pack(record.created, recordType,
+                                                  accepted,
+                                                  subjectHash(subject),
+                                                  offset))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        pass
+
+    def flushBatch(self):
+        ''' The data is flushed before the index so the index never leads '''
+        for f in (self.dataFile, self.indexFile):
+            if f is not None:
+                f.flush()
+
+    def close(self):
+        self.flushBatch()
+        self._closeFiles()
+        logging.Handler.close(self)
+
+#------------------------------------------------------------------------------
+# functions to write to the audit log
+
+def _audit(logger, description, *audit):
+    logger.info(description, extra={'audit' : audit})
+
+def helpRequested(logger, helpId, asker, cascader, subject, problem):
+    _audit(logger, 'help request', HELP_REQUEST, NO_ANSWER, helpId,
+           asker, cascader, subject, problem)
+
+def helpAnswered(logger, helpId, asker, cascader, subject, accepted, why):
+    _audit(logger, 'help response', HELP_RESPONSE, int(bool(accepted)), helpId,
+           cascader, asker, subject, why or '')
+
+def messageSent(logger, helpId, fromUser, toUser, message):
+    _audit(logger, 'message', MESSAGE, NO_ANSWER, helpId,
+           fromUser, toUser, '', message)
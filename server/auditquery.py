@@ -0,0 +1,148 @@
+#!/usr/bin/python -O
+'''
+Command line tool to query the audit log written by the server, for example
+to find how many inf2b requests were rejected this week:
+
+    python auditquery.py --type response --subject inf2b --rejected --week
+
+The index files are read through mmap so that only records that match the
+time, type, outcome and subject hash are decoded
+'''
+from __future__ import with_statement
+
+import os
+import glob
+import mmap
+import time
+from collections import defaultdict
+from optparse import OptionParser
+
+import audit
+
+def openMap(filename):
+    ''' Returns a read only mmap of the file or None if it is empty '''
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def findFiles(directory):
+    ''' Returns the file name bases of the audit files, oldest first '''
+    indexes = glob.glob(os.path.join(directory, 'audit-*' + audit.INDEX_SUFFIX))
+    return sorted(f[:-len(audit.INDEX_SUFFIX)] for f in indexes)
+
+def query(directory, since=None, until=None, recordType=None,
+          subject=None, accepted=None):
+    '''
+    Generator yielding the decoded records in the directory that match the
+    given filters, any filter that is None matches everything
+    '''
+    entrySize = audit.INDEX_ENTRY.size
+    hashed = audit.subjectHash(subject) if subject is not None else None
+
+    for base in findFiles(directory):
+        index = openMap(base + audit.INDEX_SUFFIX)
+        if index is None:
+            continue
+        data = openMap(base + audit.DATA_SUFFIX)
+        try:
+            #a partially written entry at the end is ignored
+            for pos in xrange(0, len(index) - entrySize + 1, entrySize):
+                (timestamp, entryType, entryAccepted,
+                 entryHash, offset) = audit.INDEX_ENTRY.unpack_from(index, pos)
+
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp >= until:
+                    continue
+                if recordType is not None and entryType != recordType:
+                    continue
+                if accepted is not None and entryAccepted != accepted:
+                    continue
+                if hashed is not None and entryHash != hashed:
+                    continue
+
+                record = audit.decodeRecord(data, offset)
+                if subject is not None and record[6] != subject:
+                    continue
+                yield record
+        finally:
+            index.close()
+            if data is not None:
+                data.close()
+
+#how records are grouped for counting, each is a function of the record
+GROUPS = {
+    'subject' : lambda r: r[6],
+    'type' : lambda r: audit.TYPE_NAMES.get(r[0], str(r[0])),
+    'outcome' : lambda r: {1 : 'accepted', 0 : 'rejected'}.get(r[2], '-'),
+    'week' : lambda r: time.strftime('%Y-%W', time.localtime(r[1])),
+    'day' : lambda r: time.strftime('%Y-%m-%d', time.localtime(r[1])),
+    'from' : lambda r: r[4],
+    'to' : lambda r: r[5],
+}
+
+def parseDate(value):
+    return time.mktime(time.strptime(value, '%Y-%m-%d'))
+
+def startOfWeek():
+    now = time.localtime()
+    today = time.mktime((now.tm_year, now.tm_mon, now.tm_mday,
+                         0, 0, 0, 0, 0, -1))
+    return today - now.tm_wday * 24 * 60 * 60
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-d', '--dir', default='audit',
+                      help='directory holding the audit files')
+    parser.add_option('', '--since', help='only records from YYYY-MM-DD')
+    parser.add_option('', '--until', help='only records before YYYY-MM-DD')
+    parser.add_option('', '--week', action='store_true',
+                      help='only records from this week')
+    parser.add_option('-t', '--type', choices=audit.TYPE_NAMES.values(),
+                      help='one of: ' + ', '.join(audit.TYPE_NAMES.values()))
+    parser.add_option('-s', '--subject', help='only records for the subject')
+    parser.add_option('', '--accepted', action='store_true',
+                      help='only accepted help responses')
+    parser.add_option('', '--rejected', action='store_true',
+                      help='only rejected help responses')
+    parser.add_option('-g', '--group-by', action='append', default=[],
+                      choices=GROUPS.keys(),
+                      help='count by: ' + ', '.join(sorted(GROUPS.keys())))
+    parser.add_option('-l', '--list', action='store_true',
+                      help='print the matching records')
+
+    (options, args) = parser.parse_args()
+
+    since = parseDate(options.since) if options.since else None
+    if options.week and (since is None or since < startOfWeek()):
+        since = startOfWeek()
+    until = parseDate(options.until) if options.until else None
+
+    recordType = None
+    for k, v in audit.TYPE_NAMES.iteritems():
+        if v == options.type:
+            recordType = k
+
+    accepted = None
+    if options.accepted:
+        accepted = 1
+    elif options.rejected:
+        accepted = 0
+    if accepted is not None and recordType is None:
+        recordType = audit.HELP_RESPONSE
+
+    counts = defaultdict(int)
+    for record in query(options.dir, since, until, recordType,
+                        options.subject, accepted):
+        if options.list:
+            print '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.localtime(record[1])),
+                             ' '.join(repr(x) for x in record[2:]))
+        key = tuple(GROUPS[g](record) for g in options.group_by)
+        counts[key] += 1
+
+    if not counts and not options.group_by:
+        print 0
+    for key in sorted(counts):
+        print '\t'.join(key + (str(counts[key]),))
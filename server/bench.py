@@ -0,0 +1,731 @@
+#!/usr/bin/python -O
+'''
+Load generator and benchmark for the server. It starts Server.py (or uses one
+that is already running), logs in simulated users that use the real RpcClient
+and RpcService from the client and replays a lab session:
+
+    - users log in in bursts, as they do at the start of a lab
+    - cascaders start cascading and then toggle their subjects
+    - students ask cascaders for help and chat to those that accept
+
+It then reports throughput, broadcast latency, the memory the server uses per
+connected user and reactor lag. Results can be written as JSON and compared
+with an earlier run:
+
+    python bench.py --users 2000 --processes 4 --output new.json
+    python bench.py --compare old.json new.json
+
+Broadcast latency is the time from a cascader making a change until one of
+the observing clients gets the cascadersDelta holding it. Only changes made
+by users in the same process are timed, so it doesn't matter how the load is
+split between processes. Server lag is the round trip of pings from a client
+that does nothing else, so it grows with how far behind the reactor is
+'''
+from __future__ import with_statement
+
+import os
+import sys
+import math
+import time
+import json
+import random
+import socket
+import tempfile
+import resource
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+from twisted.internet import reactor, defer, task, utils
+from twisted.python import failure
+from twisted.spread import pb
+
+SERVER_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+CLIENT_DIRECTORY = os.path.join(SERVER_DIRECTORY, '..', 'client', 'cascaders')
+sys.path.insert(0, CLIENT_DIRECTORY)
+
+from client import RpcClient, DeferredResultWrapper
+from service import RpcService
+
+from labs import loadLabIndex
+
+#version of the results file, so old results can be told apart
+RESULTS_VERSION = 1
+
+#most samples of each kind kept by a process
+RESERVOIR_SIZE = 10000
+
+#------------------------------------------------------------------------------
+# statistics
+
+class Reservoir(object):
+    '''
+    Keeps a uniform random sample of at most size values
+
+    >>> r = Reservoir(10)
+    >>> for i in xrange(100):
+    ...     r.add(i)
+    >>> r.count, len(r.samples)
+    (100, 10)
+    '''
+    def __init__(self, size=RESERVOIR_SIZE, rng=random):
+        self.size = size
+        self.rng = rng
+        self.samples = []
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            i = self.rng.randint(0, self.count - 1)
+            if i < self.size:
+                self.samples[i] = value
+
+def percentile(samples, fraction):
+    '''
+    Returns the value that fraction of the samples are less than or equal to
+
+    >>> percentile([4, 1, 3, 2], 0.5)
+    2
+    >>> percentile([4, 1, 3, 2], 0.99)
+    4
+    >>> percentile([], 0.5) is None
+    True
+    '''
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+def summarise(prefix, samples, scale=1000.0):
+    ''' p50, p99 and max of samples in seconds, as milliseconds '''
+    result = {prefix + 'Samples' : len(samples)}
+    for name, fraction in (('P50', 0.5), ('P99', 0.99), ('Max', 1.0)):
+        value = percentile(samples, fraction)
+        result[prefix + name] = value * scale if value is not None else None
+    return result
+
+#------------------------------------------------------------------------------
+# memory of the server
+
+def getRss(pid):
+    ''' Resident memory of the process in KB, or None if it isn't running '''
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def getChildren(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                #the name can have spaces, the parent pid is after the ')'
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+def getTreeRss(pid):
+    ''' Resident memory of the process and its workers in KB '''
+    rss = getRss(pid)
+    if rss is None:
+        return None
+    return rss + sum(getRss(c) or 0 for c in getChildren(pid))
+
+#------------------------------------------------------------------------------
+# simulated users
+
+def getDeferred(call):
+    '''
+    Returns a deferred firing with the result of a call made through the
+    client. The client queues calls and only sends them on the next
+    iteration of the reactor, so until then the QueuedDeferredCall has no
+    deferred and the callbacks have to be added to the call itself
+    (askForHelp wraps the call again in a DeferredResultWrapper)
+    '''
+    if isinstance(call, DeferredResultWrapper):
+        call = call.deferred
+    d = defer.Deferred()
+    call.addCallback(d.callback)
+    call.addErrCallback(d.errback)
+    return d
+
+
+class SimulatedUser(object):
+    '''
+    A user of the client, either a cascader or a student asking for help.
+    Observers also time the cascadersDelta events that they get
+    '''
+    def __init__(self, load, username, hostname, isCascader, isObserver):
+        self.load = load
+        self.username = username
+        self.hostname = hostname
+        self.isCascader = isCascader
+        self.isObserver = isObserver
+
+        self.cascading = False
+        self.subjects = set()
+        self.helpCount = 0
+        self.active = False
+
+        self.service = RpcService()
+        self.client = RpcClient(self.service, load.host, load.port,
+                                username, hostname)
+        self.service.registerUserAskingForHelp(self.onUserAskingForHelp)
+        if isObserver:
+            self.service.registerOnCascadersDelta(self.onCascadersDelta)
+
+    def call(self, method, *args):
+        ''' Calls a method of RpcClient, recording how long it took '''
+        start = time.time()
+        try:
+            d = getDeferred(getattr(self.client, method)(*args))
+        except pb.DeadReferenceError:
+            self.load.recordCall(method, None)
+            return defer.fail()
+
+        def onResult(result):
+            self.load.recordCall(method, time.time() - start)
+            return result
+
+        def onError(reason):
+            self.load.recordCall(method, None)
+            return reason
+
+        d.addCallbacks(onResult, onError)
+        return d
+
+    #--------------------------------------------------------------------------
+
+    def login(self):
+        d = self.client.connect()
+        d.addCallback(lambda _: self.client.login())
+        d.addCallback(lambda _: self.call('getCascaderList'))
+        d.addCallback(self.onLogin)
+        return d
+
+    def onLogin(self, cascaders):
+        version, isSnapshot, changed, left = cascaders
+        if self.isObserver:
+            self.load.updateCascaders(changed, left)
+
+        self.active = True
+        if self.isCascader:
+            subjects = self.load.rng.sample(self.load.subjects,
+                                            min(3, len(self.load.subjects)))
+            self.setPresence(True, self.subjects.union(subjects))
+            self.call('startCascading')
+            self.call('addSubjects', subjects)
+        self.scheduleAction()
+
+    def logout(self):
+        self.active = False
+        if self.client.server is None:
+            return defer.succeed(None)
+        d = self.call('logout')
+        d.addBoth(lambda _: self.client.factory.disconnect())
+        return d
+
+    #--------------------------------------------------------------------------
+
+    def setPresence(self, cascading, subjects):
+        ''' Tells the load generator what the next delta should show '''
+        self.cascading = cascading
+        self.subjects = set(subjects)
+        self.load.changing(self.username,
+                           frozenset(subjects) if cascading else None)
+
+    def scheduleAction(self):
+        if self.active:
+            wait = self.load.rng.expovariate(1.0 / self.load.thinkTime)
+            reactor.callLater(wait, self.act)
+
+    def act(self):
+        if not self.active:
+            return
+        if self.isCascader:
+            self.actCascader()
+        else:
+            self.actStudent()
+        self.scheduleAction()
+
+    def actCascader(self):
+        rng = self.load.rng
+        if rng.random() < 0.05:
+            if self.cascading:
+                self.setPresence(False, self.subjects)
+                self.call('stopCascading')
+            else:
+                self.setPresence(True, self.subjects)
+                self.call('startCascading')
+            return
+
+        subject = rng.choice(self.load.subjects)
+        if subject in self.subjects:
+            self.setPresence(self.cascading, self.subjects - set([subject]))
+            self.call('removeSubjects', [subject])
+        else:
+            self.setPresence(self.cascading, self.subjects | set([subject]))
+            self.call('addSubjects', [subject])
+
+    def actStudent(self):
+        if self.load.rng.random() > self.load.helpRate:
+            return
+        cascaders = [u for u, s in self.load.cascaders.iteritems() if s]
+        if not cascaders:
+            return
+        cascader = self.load.rng.choice(cascaders)
+        subject = self.load.rng.choice(list(self.load.cascaders[cascader]))
+
+        self.helpCount += 1
+        helpId = (self.username, str(self.helpCount))
+        d = self.call('askForHelp', helpId, cascader, subject, 'bench')
+        d.addCallback(lambda _: self.startChat(helpId, cascader))
+        d.addErrback(lambda _: None)
+
+    def startChat(self, helpId, cascader):
+        '''
+        The answer only reaches the student as a serverSentMessage, so they
+        chat either way and only the messages to cascaders that accepted
+        are timed
+        '''
+        for i in xrange(self.load.chatMessages):
+            reactor.callLater(i, self.sendMessage, helpId, cascader)
+
+    def sendMessage(self, helpId, cascader):
+        if self.active:
+            d = self.call('sendMessage', helpId, cascader, repr(time.time()))
+            d.addErrback(lambda _: None)
+
+    #--------------------------------------------------------------------------
+    # called by the server
+
+    def onUserAskingForHelp(self, helpId, username, hostname,
+                            subject, description):
+        if self.load.rng.random() > self.load.acceptRate:
+            return (False, 'bench')
+        self.service.registerOnMessgeHandler(helpId, self.onMessage)
+        return (True, '')
+
+    def onMessage(self, fromType, message):
+        try:
+            self.load.chatLatency.add(time.time() - float(message))
+        except ValueError:
+            pass
+
+    def onCascadersDelta(self, version, changed, left):
+        self.load.deltas += 1
+        self.load.timeDelta(changed, left)
+        self.load.updateCascaders(changed, left)
+
+
+class LoadGenerator(object):
+    '''
+    Runs the simulated users for one process and collects what they measure
+    '''
+    def __init__(self, options, firstUser, userCount, hostnames):
+        self.host = options.host
+        self.port = options.port
+        self.thinkTime = options.think_time
+        self.helpRate = options.help_rate
+        self.acceptRate = options.accept_rate
+        self.chatMessages = options.chat_messages
+        self.duration = options.duration
+        self.burstSize = options.burst_size
+        self.burstInterval = options.burst_interval
+        self.rng = random.Random(options.seed + firstUser)
+
+        self.subjects = []
+        #cascaders seen by the observers, username -> subjects
+        self.cascaders = {}
+        #username -> (time, frozenset of subjects or None) of the last change
+        self.pending = {}
+
+        self.calls = {}
+        self.callErrors = 0
+        self.loginFailures = 0
+        self.deltas = 0
+        self.rpcLatency = Reservoir(rng=self.rng)
+        self.broadcastLatency = Reservoir(rng=self.rng)
+        self.chatLatency = Reservoir(rng=self.rng)
+        self.lag = Reservoir(rng=self.rng)
+
+        self.users = []
+        for i in xrange(firstUser, firstUser + userCount):
+            hostname = hostnames[i % len(hostnames)]
+            isCascader = self.rng.random() < options.cascader_fraction
+            isObserver = i - firstUser < options.observers
+            self.users.append(SimulatedUser(self, 'bench%05d' % i, hostname,
+                                            isCascader, isObserver))
+
+    def recordCall(self, method, latency):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if latency is None:
+            self.callErrors += 1
+        else:
+            self.rpcLatency.add(latency)
+
+    def changing(self, username, presence):
+        self.pending[username] = (time.time(), presence)
+
+    def timeDelta(self, changed, left):
+        now = time.time()
+        for username, _, subjects in changed:
+            pending = self.pending.get(username)
+            if pending is not None and pending[1] == frozenset(subjects):
+                self.broadcastLatency.add(now - pending[0])
+        for username in left:
+            pending = self.pending.get(username)
+            if pending is not None and pending[1] is None:
+                self.broadcastLatency.add(now - pending[0])
+
+    def updateCascaders(self, changed, left):
+        for username, _, subjects in changed:
+            self.cascaders[username] = set(subjects)
+        for username in left:
+            self.cascaders.pop(username, None)
+
+    def _measureLag(self):
+        now = time.time()
+        if self.lastTick is not None:
+            self.lag.add(max(0, now - self.lastTick - self.lagCheck.interval))
+        self.lastTick = now
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.lastTick = None
+        self.lagCheck = task.LoopingCall(self._measureLag)
+        self.lagCheck.start(0.1)
+
+        #the first user gets the subject list for everyone
+        first = self.users[0]
+        try:
+            yield first.client.connect()
+            yield first.client.login()
+            self.subjects = sorted((yield first.call('getSubjectList')))
+            yield first.logout()
+        except Exception, e:
+            raise RuntimeError('Couldn\'t log in to the server: %s' % e)
+        first.client = RpcClient(first.service, self.host, self.port,
+                                 first.username, first.hostname)
+
+        start = time.time()
+        logins = []
+        for i in xrange(0, len(self.users), self.burstSize):
+            for user in self.users[i:i + self.burstSize]:
+                d = user.login()
+                d.addErrback(self._onLoginFailed)
+                logins.append(d)
+            yield task.deferLater(reactor, self.burstInterval, lambda: None)
+        yield defer.DeferredList(logins)
+        loginTime = time.time() - start
+
+        remaining = self.duration - (time.time() - start)
+        if remaining > 0:
+            yield task.deferLater(reactor, remaining, lambda: None)
+        elapsed = time.time() - start
+
+        yield defer.DeferredList([u.logout() for u in self.users])
+        self.lagCheck.stop()
+
+        defer.returnValue({
+            'users' : len(self.users),
+            'loginFailures' : self.loginFailures,
+            'loginTime' : loginTime,
+            'duration' : elapsed,
+            'calls' : self.calls,
+            'callErrors' : self.callErrors,
+            'deltas' : self.deltas,
+            'rpcLatency' : self.rpcLatency.samples,
+            'broadcastLatency' : self.broadcastLatency.samples,
+            'chatLatency' : self.chatLatency.samples,
+            'generatorLag' : self.lag.samples,
+        })
+
+    def _onLoginFailed(self, reason):
+        self.loginFailures += 1
+
+#------------------------------------------------------------------------------
+# running the benchmark
+
+def raiseFileLimit():
+    ''' Each user needs a socket, as does the server for each of them '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def waitForPort(host, port, timeout=30):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('The server didn\'t start listening on %d' % port)
+
+def startServer(options):
+    '''
+    Runs Server.py in a temporary directory, so its logs don't get mixed
+    with real ones
+    '''
+    directory = tempfile.mkdtemp(prefix='cascader-bench-')
+    args = [sys.executable, os.path.join(SERVER_DIRECTORY, 'Server.py'),
+            '--port', str(options.port)] + options.server_args
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(args, cwd=directory,
+                                   stdout=devnull, stderr=devnull)
+    waitForPort(options.host, options.port)
+    return process
+
+def getHostnames():
+    hostnames = sorted(loadLabIndex().hostsLab)
+    return hostnames or ['benchhost%d' % i for i in xrange(100)]
+
+def childArgs(options, firstUser, userCount):
+    args = [os.path.abspath(__file__), '--child',
+            '--host', options.host, '--port', str(options.port),
+            '--first-user', str(firstUser), '--users', str(userCount)]
+    for name in ('duration', 'burst_size', 'burst_interval', 'think_time',
+                 'cascader_fraction', 'help_rate', 'accept_rate',
+                 'chat_messages', 'observers', 'seed'):
+        args += ['--' + name.replace('_', '-'), str(getattr(options, name))]
+    return args
+
+def runChild(options, firstUser, userCount):
+    ''' Runs the load in another process, which prints its results as JSON '''
+    d = utils.getProcessOutputAndValue(sys.executable,
+                                       childArgs(options, firstUser,
+                                                 userCount),
+                                       env=os.environ)
+    def onExit((out, err, code)):
+        if code != 0:
+            raise RuntimeError('Load process failed: %s' % err)
+        return json.loads(out)
+    d.addCallback(onExit)
+    return d
+
+class Probe(object):
+    ''' Pings the server and samples its memory while the load runs '''
+    def __init__(self, options, pid):
+        self.pid = pid
+        self.rss = []
+        self.pings = Reservoir()
+        self.options = options
+        self.client = RpcClient(RpcService(), options.host, options.port,
+                                'benchprobe', 'benchprobe')
+        self.loop = task.LoopingCall(self.sample)
+
+    @defer.inlineCallbacks
+    def start(self):
+        yield self.client.connect()
+        yield self.client.login()
+        self.baseline = getTreeRss(self.pid) if self.pid else None
+        self.loop.start(self.options.probe_interval)
+
+    def sample(self):
+        if self.pid:
+            self.rss.append(getTreeRss(self.pid))
+        start = time.time()
+        try:
+            d = getDeferred(self.client.ping())
+        except pb.DeadReferenceError:
+            return
+        d.addCallback(lambda _: self.pings.add(time.time() - start))
+        d.addErrback(lambda _: None)
+
+    def stop(self):
+        self.loop.stop()
+        d = getDeferred(self.client.logout())
+        d.addBoth(lambda _: self.client.factory.disconnect())
+        return d
+
+    def getResults(self, users):
+        results = summarise('serverPing', self.pings.samples)
+        rss = [r for r in self.rss if r is not None]
+        if self.baseline is not None and rss:
+            results['serverRssBaselineKb'] = self.baseline
+            results['serverRssPeakKb'] = max(rss)
+            results['memoryPerUserKb'] = (max(rss) - self.baseline) / float(users)
+        return results
+
+def merge(parts):
+    ''' Adds up the results of the load processes '''
+    merged = {'users' : 0, 'loginFailures' : 0, 'loginTime' : 0,
+              'duration' : 0, 'calls' : {}, 'callErrors' : 0, 'deltas' : 0,
+              'rpcLatency' : [], 'broadcastLatency' : [],
+              'chatLatency' : [], 'generatorLag' : []}
+    for part in parts:
+        for key, value in part.iteritems():
+            if key in ('loginTime', 'duration'):
+                merged[key] = max(merged[key], value)
+            elif key == 'calls':
+                for method, count in value.iteritems():
+                    merged['calls'][method] = (merged['calls'].get(method, 0)
+                                               + count)
+            else:
+                merged[key] += value
+    return merged
+
+def report(merged, probe):
+    ''' The flat dictionary of metrics that is printed and saved '''
+    duration = merged['duration'] or 1
+    calls = sum(merged['calls'].itervalues())
+    results = {
+        'users' : merged['users'],
+        'loginFailures' : merged['loginFailures'],
+        'loginTime' : merged['loginTime'],
+        'duration' : merged['duration'],
+        'calls' : calls,
+        'callErrors' : merged['callErrors'],
+        'callsPerSecond' : calls / duration,
+        'deltasPerSecond' : merged['deltas'] / duration,
+        'callsByMethod' : merged['calls'],
+    }
+    results.update(summarise('rpcLatency', merged['rpcLatency']))
+    results.update(summarise('broadcastLatency', merged['broadcastLatency']))
+    results.update(summarise('chatLatency', merged['chatLatency']))
+    results.update(summarise('generatorLag', merged['generatorLag']))
+    results.update(probe.getResults(merged['users']))
+    return results
+
+@defer.inlineCallbacks
+def runBenchmark(options, server):
+    hostnames = getHostnames()
+    probe = Probe(options, server.pid if server is not None else None)
+    yield probe.start()
+
+    processes = max(1, options.processes)
+    perProcess = int(math.ceil(options.users / float(processes)))
+    if processes == 1:
+        load = LoadGenerator(options, options.first_user,
+                             options.users, hostnames)
+        parts = [(yield load.run())]
+    else:
+        runs = []
+        for first in xrange(0, options.users, perProcess):
+            count = min(perProcess, options.users - first)
+            runs.append(runChild(options, options.first_user + first, count))
+        parts = []
+        for success, result in (yield defer.DeferredList(runs)):
+            if not success:
+                raise result.value
+            parts.append(result)
+
+    yield probe.stop()
+    defer.returnValue(report(merge(parts), probe))
+
+def printResults(results):
+    for key in sorted(results):
+        value = results[key]
+        if isinstance(value, float):
+            value = '%.3f' % value
+        print '%-28s %s' % (key, value)
+
+def compare(oldFilename, newFilename):
+    ''' Prints the change in each metric between two results files '''
+    with open(oldFilename) as f:
+        old = json.load(f)['results']
+    with open(newFilename) as f:
+        new = json.load(f)['results']
+    print '%-28s %12s %12s %8s' % ('metric', 'old', 'new', 'change')
+    for key in sorted(set(old) | set(new)):
+        a, b = old.get(key), new.get(key)
+        if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+            continue
+        change = '%+.1f%%' % ((b - a) * 100.0 / a) if a else '-'
+        print '%-28s %12.3f %12.3f %8s' % (key, a, b, change)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('', '--host', default='localhost')
+    parser.add_option('-p', '--port', type='int', default=5011,
+                      help='port of the server')
+    parser.add_option('', '--no-server', action='store_true',
+                      help='use a server that is already running')
+    parser.add_option('-a', '--server-arg', action='append', default=[],
+                      dest='server_args',
+                      help='argument passed to Server.py, can be repeated')
+    parser.add_option('-u', '--users', type='int', default=500)
+    parser.add_option('-j', '--processes', type='int', default=1,
+                      help='processes the users are split between')
+    parser.add_option('-d', '--duration', type='float', default=60,
+                      help='seconds to run for, including logging in')
+    parser.add_option('', '--burst-size', type='int', default=50,
+                      help='users that log in at once')
+    parser.add_option('', '--burst-interval', type='float', default=0.5,
+                      help='seconds between bursts of logins')
+    parser.add_option('', '--think-time', type='float', default=10,
+                      help='mean seconds between the actions of a user')
+    parser.add_option('', '--cascader-fraction', type='float', default=0.3)
+    parser.add_option('', '--help-rate', type='float', default=0.2,
+                      help='chance that an action of a student asks for help')
+    parser.add_option('', '--accept-rate', type='float', default=0.8)
+    parser.add_option('', '--chat-messages', type='int', default=3,
+                      help='messages sent after help is accepted')
+    parser.add_option('', '--observers', type='int', default=20,
+                      help='users per process that time broadcasts')
+    parser.add_option('', '--probe-interval', type='float', default=0.25)
+    parser.add_option('', '--seed', type='int', default=0)
+    parser.add_option('-o', '--output', help='write the results as JSON')
+    parser.add_option('', '--compare', nargs=2, metavar='OLD NEW',
+                      help='compare two results files')
+    parser.add_option('', '--child', action='store_true', help=SUPPRESS_HELP)
+    parser.add_option('', '--first-user', type='int', default=0,
+                      help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+
+    if options.compare:
+        compare(*options.compare)
+        sys.exit(0)
+
+    raiseFileLimit()
+    outcome = {}
+
+    def finish(result):
+        outcome['result'] = result
+        reactor.stop()
+
+    if options.child:
+        load = LoadGenerator(options, options.first_user, options.users,
+                             getHostnames())
+        d = load.run()
+    else:
+        server = None if options.no_server else startServer(options)
+        d = runBenchmark(options, server)
+
+    d.addBoth(finish)
+    try:
+        reactor.run()
+    finally:
+        if not options.child and server is not None:
+            server.terminate()
+            server.wait()
+
+    result = outcome['result']
+    if isinstance(result, failure.Failure):
+        result.printTraceback()
+        sys.exit(1)
+
+    if options.child:
+        print json.dumps(result)
+        sys.exit(0)
+
+    printResults(result)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'version' : RESULTS_VERSION,
+                       'time' : time.time(),
+                       'options' : options.__dict__,
+                       'results' : result}, f, indent=1, sort_keys=True)
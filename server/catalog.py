@@ -0,0 +1,201 @@
+'''
+The catalog of subjects that can be cascaded, which is read from
+data/subjects rather than being fixed in the server.
+
+The catalog is versioned by a digest of its subjects, so the version is the
+same for every worker and after a restart. Clients cache the catalog and
+send the version they have, they are told it hasn't changed or sent what has
+been added and removed since, in the same way as getCascaderList.
+
+Subjects can have aliases, and names from clients are matched ignoring case
+and extra spaces using a table built when the catalog is loaded. The file is
+checked for changes periodically, so subjects can be added (or renamed, by
+making the old name an alias) without restarting the server
+'''
+from __future__ import with_statement
+
+import hashlib
+import os
+
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+SUBJECTS_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'data', 'subjects')
+
+#used if the subjects file can't be read
+DEFAULT_SUBJECTS = ['inf1-fp', 'inf1-cl', 'inf1-da', 'inf1-op', 'inf2a',
+                    'inf2b', 'inf2c-cs', 'inf2-se', 'inf2d', 'Java',
+                    'Haskell', 'Python', 'Ruby', 'C', 'C++', 'PHP',
+                    'JavaScript', 'Perl', 'SQL', 'Bash', 'Vim', 'Emacs',
+                    'Eclipse', 'Netbeans', 'Version Control']
+
+def catalogVersion(subjects):
+    '''
+    >>> catalogVersion(['a', 'b']) == catalogVersion(['b', 'a'])
+    True
+    '''
+    return hashlib.md5('\n'.join(sorted(subjects))).hexdigest()
+
+def normalizeName(name):
+    '''
+    The key a subject is looked up by
+
+    >>> normalizeName('  Version   control ')
+    'version control'
+    '''
+    return ' '.join(name.split()).lower()
+
+def parseCatalog(fh):
+    '''
+    One subject per line, optionally followed by a colon and a comma
+    separated list of aliases. Blank lines and comments are ignored.
+    Returns the subjects and a dict of alias -> subject
+
+    >>> from StringIO import StringIO
+    >>> subjects, aliases = parseCatalog(StringIO('# comment\\nJava\\n\\n'
+    ...                                           '  C++ : cpp, cxx\\n'))
+    >>> subjects, sorted(aliases.items())
+    (['Java', 'C++'], [('cpp', 'C++'), ('cxx', 'C++')])
+    '''
+    subjects = []
+    aliases = {}
+    for line in fh:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        subject, _, aliasList = line.partition(':')
+        subject = subject.strip()
+        subjects.append(subject)
+        for alias in aliasList.split(','):
+            alias = alias.strip()
+            if alias:
+                aliases[alias] = subject
+    return subjects, aliases
+
+
+class SubjectCatalog(object):
+    '''
+    >>> catalog = SubjectCatalog(['Java', 'C'])
+    >>> catalog.getChanges(None)[1:]
+    (True, ['C', 'Java'], [])
+    >>> catalog.getChanges(catalog.version)[1:]
+    (False, [], [])
+    >>> old = catalog.version
+    >>> catalog.update(['Java', 'Python'], {'py': 'Python'})
+    >>> catalog.getChanges(old)[1:]
+    (False, ['Python'], ['C'])
+    >>> sorted(catalog.normalize(['JAVA', 'py', 'C']))
+    ['Java', 'Python']
+    '''
+    def __init__(self, subjects, aliases=None, filename=None):
+        '''
+        aliases - dict of alias -> subject
+        filename - the file the catalog was loaded from, which is reloaded
+                   by reloadIfChanged
+        '''
+        #version -> subjects of the catalogs this process has had, so that
+        #clients with an older version can be sent what has changed
+        self.history = {}
+        self.filename = filename
+        self.mtime = None
+        self.update(subjects, aliases)
+
+    def update(self, subjects, aliases=None):
+        '''
+        Replaces the subjects, which gives the catalog a new version if they
+        are different
+        '''
+        self.subjects = frozenset(subjects)
+        self.version = catalogVersion(self.subjects)
+        self.history[self.version] = self.subjects
+
+        #normalized name or alias -> subject
+        lookup = {}
+        for alias, subject in (aliases or {}).iteritems():
+            if subject in self.subjects:
+                lookup[normalizeName(alias)] = subject
+        #a subject's own name wins over another's alias
+        for subject in self.subjects:
+            lookup[normalizeName(subject)] = subject
+        self.lookup = lookup
+
+    def getSubject(self, name):
+        ''' Returns the subject with the name or alias, None if unknown '''
+        return self.lookup.get(normalizeName(name))
+
+    def normalize(self, names):
+        ''' Returns the set of subjects with the names, ignoring unknowns '''
+        lookup = self.lookup
+        subjects = set()
+        for name in names:
+            subject = lookup.get(normalizeName(name))
+            if subject is not None:
+                subjects.add(subject)
+        return subjects
+
+    def getChanges(self, sinceVersion=None):
+        '''
+        Returns a tuple of (version, isSnapshot, added, removed). If the
+        version the client has is unknown then isSnapshot is True and added
+        holds every subject, otherwise added and removed are what has
+        changed, which are empty if the client is up to date
+        '''
+        if sinceVersion == self.version:
+            return self.version, False, [], []
+        old = self.history.get(sinceVersion)
+        if old is None:
+            return self.version, True, sorted(self.subjects), []
+        return (self.version, False,
+                sorted(self.subjects - old), sorted(old - self.subjects))
+
+    def reloadIfChanged(self):
+        '''
+        Loads the file again if it has been modified since it was last
+        loaded. Returns the version before if the subjects changed,
+        otherwise None. A file that can't be read or has no subjects (which
+        is likely to be half written) leaves the catalog as it is
+        '''
+        if self.filename is None:
+            return None
+        try:
+            mtime = os.stat(self.filename).st_mtime
+            if mtime == self.mtime:
+                return None
+            with open(self.filename) as fh:
+                subjects, aliases = parseCatalog(fh)
+        except (IOError, OSError), e:
+            logger.warn('Couldn\'t reload the subjects: %s', e)
+            return None
+        if not subjects:
+            logger.warn('Subjects file %s is empty, not reloading it',
+                        self.filename)
+            return None
+
+        self.mtime = mtime
+        oldVersion = self.version
+        self.update(subjects, aliases)
+        if self.version == oldVersion:
+            return None
+        logger.info('Reloaded %d subjects from %s', len(self.subjects),
+                    self.filename)
+        return oldVersion
+
+
+def loadSubjectCatalog(filename=SUBJECTS_FILENAME):
+    '''
+    Loads the catalog from the given file, if the file can't be read then
+    the default subjects are used so the server still functions
+    '''
+    try:
+        mtime = os.stat(filename).st_mtime
+        with open(filename) as fh:
+            subjects, aliases = parseCatalog(fh)
+    except (IOError, OSError):
+        logger.warn('Couldn\'t read subjects file %s, using the defaults',
+                    filename)
+        return SubjectCatalog(DEFAULT_SUBJECTS, filename=filename)
+    catalog = SubjectCatalog(subjects, aliases, filename)
+    catalog.mtime = mtime
+    return catalog
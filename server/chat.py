@@ -0,0 +1,214 @@
+'''
+Relays chat messages between the users in a help session (identified by the
+helpId), so that messages aren't lost when one side briefly disconnects.
+
+Each session keeps the lines going to each user in a bounded ring buffer,
+numbered in order. Lines are sent to the client in batches with
+userSentMessages, which returns the number of the last line the client has,
+so the server knows what has been delivered. A client that reconnects calls
+resumeChat with the last line it has and is sent the rest again.
+
+Lines going to a user are numbered from the time (in milliseconds) that the
+session started on this server, so the numbers keep increasing if the
+session moves to another worker or the server restarts. Lines from clients
+are numbered by the client, so that lines that are sent again after a
+reconnect aren't passed on twice
+'''
+from collections import deque
+
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+#lines kept for each user in each session
+CHAT_BUFFER_SIZE = 100
+
+#seconds lines are collected for before being sent
+CHAT_BATCH_WINDOW = 0.05
+
+#seconds a session is kept after the last line
+CHAT_SESSION_TIMEOUT = 60 * 60
+
+def getKey(helpId):
+    ''' helpIds can arrive as lists, which can't be dictionary keys '''
+    if isinstance(helpId, list):
+        return tuple(helpId)
+    return helpId
+
+
+class Participant(object):
+    ''' A users side of a session '''
+    def __init__(self, size, firstLine):
+        #(number, message) of the lines going to the user
+        self.lines = deque(maxlen=size)
+        self.lastLine = firstLine
+        #number of the last line the client has acknowledged
+        self.delivered = 0
+        #number of the last line received from the client
+        self.received = 0
+        self.sending = False
+        self.delayedFlush = None
+
+    def getUndelivered(self):
+        return [line for line in self.lines if line[0] > self.delivered]
+
+
+class ChatSession(object):
+    def __init__(self, helpId, size, started):
+        self.helpId = helpId
+        self.size = size
+        self.firstLine = int(started * 1000)
+        self.participants = {}
+        self.lastActive = started
+
+    def getParticipant(self, username):
+        try:
+            return self.participants[username]
+        except KeyError:
+            participant = Participant(self.size, self.firstLine)
+            self.participants[username] = participant
+            return participant
+
+
+class ChatRelay(object):
+    '''
+    >>> from twisted.internet import task, defer
+    >>> clock = task.Clock()
+    >>> sent = []
+    >>> def deliver(username, helpId, lines):
+    ...     sent.append((username, lines))
+    ...     return defer.succeed(lines[-1][0])
+    >>> relay = ChatRelay(deliver, clock.callLater, clock.seconds)
+    >>> relay.send('id', 'bob', 'alice', 'hi', 1)
+    1
+    >>> relay.send('id', 'bob', 'alice', 'hi', 1)
+    1
+    >>> relay.send('id', 'bob', 'alice', 'there', 2)
+    2
+    >>> clock.advance(1)
+    >>> sent
+    [('alice', [(1, 'hi'), (2, 'there')])]
+    >>> relay.resume('id', 'alice', 1)
+    0
+    >>> clock.advance(1)
+    >>> sent[-1]
+    ('alice', [(2, 'there')])
+    '''
+    def __init__(self, deliver, callLater, clock, size=CHAT_BUFFER_SIZE,
+                 window=CHAT_BATCH_WINDOW, timeout=CHAT_SESSION_TIMEOUT):
+        '''
+        deliver - function taking the username, helpId and a list of
+                  (number, message), which should send them to the client
+                  and return a deferred firing with the number of the last
+                  line the client has. It can raise an exception if the
+                  user isn't connected
+        '''
+        self.deliver = deliver
+        self.callLater = callLater
+        self.clock = clock
+        self.size = size
+        self.window = window
+        self.timeout = timeout
+
+        #helpId -> ChatSession
+        self.sessions = {}
+        #username -> helpIds of the sessions they are in
+        self.byUser = {}
+
+    def _getSession(self, helpId):
+        key = getKey(helpId)
+        try:
+            session = self.sessions[key]
+        except KeyError:
+            session = ChatSession(helpId, self.size, self.clock())
+            self.sessions[key] = session
+        session.lastActive = self.clock()
+        return session
+
+    def _join(self, session, username):
+        self.byUser.setdefault(username, set()).add(getKey(session.helpId))
+        return session.getParticipant(username)
+
+    def send(self, helpId, fromUser, toUser, message, number=None):
+        '''
+        Adds a line from one user to the other. number is the number the
+        client gave the line, lines that have already been received are
+        ignored. Returns the number of the last line received from fromUser
+        '''
+        session = self._getSession(helpId)
+        sender = self._join(session, fromUser)
+        if number is not None:
+            if number <= sender.received:
+                return sender.received
+            sender.received = number
+
+        receiver = self._join(session, toUser)
+        receiver.lastLine += 1
+        receiver.lines.append((receiver.lastLine, message))
+        self._scheduleFlush(session, toUser)
+        return sender.received
+
+    def resume(self, helpId, username, lastLine):
+        '''
+        Called when a client reconnects, lastLine is the number of the last
+        line it got. Lines after that are sent again. Returns the number of
+        the last line received from the client, so it can send the rest
+        '''
+        session = self._getSession(helpId)
+        participant = self._join(session, username)
+        participant.delivered = min(lastLine, participant.lastLine)
+        self._scheduleFlush(session, username)
+        return participant.received
+
+    def userJoined(self, username):
+        ''' Sends anything that is waiting for a user that has logged in '''
+        for key in self.byUser.get(username, ()):
+            self._scheduleFlush(self.sessions[key], username)
+
+    def _scheduleFlush(self, session, username):
+        participant = session.getParticipant(username)
+        if participant.delayedFlush is None:
+            participant.delayedFlush = self.callLater(self.window, self.flush,
+                                                      session, username)
+
+    def flush(self, session, username):
+        ''' Sends the user the lines it hasn't acknowledged '''
+        participant = session.getParticipant(username)
+        participant.delayedFlush = None
+        if participant.sending:
+            return
+        lines = participant.getUndelivered()
+        if not lines:
+            return
+
+        try:
+            d = self.deliver(username, session.helpId, lines)
+        except Exception, e:
+            logger.debug('Chat not sent to %s: %s', username, e)
+            return
+        participant.sending = True
+
+        def onAcknowledged(lastLine):
+            participant.sending = False
+            participant.delivered = max(participant.delivered, lastLine)
+            if participant.getUndelivered():
+                self._scheduleFlush(session, username)
+        def onFailed(reason):
+            participant.sending = False
+            logger.debug('Chat not sent to %s: %s', username,
+                         reason.getErrorMessage())
+        d.addCallbacks(onAcknowledged, onFailed)
+
+    def expire(self):
+        ''' Removes sessions that haven't been used for the timeout '''
+        since = self.clock() - self.timeout
+        for key, session in self.sessions.items():
+            if session.lastActive >= since:
+                continue
+            del self.sessions[key]
+            for username in session.participants:
+                helpIds = self.byUser.get(username)
+                if helpIds is not None:
+                    helpIds.discard(key)
+                    if not helpIds:
+                        del self.byUser[username]
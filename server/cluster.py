@@ -0,0 +1,346 @@
+'''
+Support for running the server as several worker processes behind one
+listening port.
+
+The master process owns the listening socket and runs a Broker, which the
+workers connect to over a unix socket. Workers adopt the listening socket so
+the kernel spreads client connections between them. The broker holds who is
+logged in where and their presence, relays changes between workers and
+routes calls to clients that are connected to a different worker. Help
+requests for a cascader are routed to the cascaders worker, so that each
+cascader has a single queue
+'''
+import os
+import sys
+import socket
+import logging
+
+from twisted.spread import pb
+from twisted.internet import reactor, protocol
+from twisted.internet.error import ReactorNotRunning
+
+logger = logging.getLogger('MyLogger')
+
+#where workers find the broker, relative to the working directory
+BROKER_SOCKET = 'cascader-broker.sock'
+
+class Broker(pb.Root):
+    '''
+    Runs in the master process. Workers register a WorkerLink and then tell
+    the broker about users logging in and out and their presence changing
+    '''
+    def __init__(self):
+        #workerId -> WorkerLink reference
+        self.workers = {}
+        #username -> (workerId, hostname, presence)
+        self.users = {}
+
+    def _relay(self, fromWorker, method, *args):
+        ''' Calls the method on every worker apart from fromWorker '''
+        for workerId, link in self.workers.items():
+            if workerId == fromWorker:
+                continue
+            try:
+                d = link.callRemote(method, *args)
+            except pb.DeadReferenceError:
+                self.workerLost(workerId)
+            else:
+                d.addErrback(lambda reason: logger.debug('Relay failed: %s',
+                                                reason.getErrorMessage()))
+
+    def remote_register(self, link, workerId):
+        '''
+        Called by a worker when it starts. Returns the users on the other
+        workers as a list of (username, workerId, hostname, presence)
+        '''
+        logger.info('Worker %s registered', workerId)
+        self.workerLost(workerId)
+        self.workers[workerId] = link
+        link.notifyOnDisconnect(lambda _: self.workerLost(workerId))
+        return [(username, owner, hostname, presence)
+                for username, (owner, hostname, presence)
+                in self.users.iteritems()]
+
+    def workerLost(self, workerId):
+        ''' Everyone that was on the worker is treated as logging out '''
+        if self.workers.pop(workerId, None) is None:
+            return
+        logger.warn('Worker %s lost', workerId)
+        for username, (owner, _, _) in self.users.items():
+            if owner == workerId:
+                del self.users[username]
+                self._relay(workerId, 'userLeft', username)
+
+    def remote_claim(self, workerId, username, hostname):
+        '''
+        Called when a user logs into a worker, returns False if the username
+        is already logged in anywhere
+        '''
+        if username in self.users:
+            return False
+        self.users[username] = (workerId, hostname, None)
+        self._relay(workerId, 'userJoined', username, workerId, hostname)
+        return True
+
+    def remote_release(self, workerId, username):
+        ''' Called when a user logs out of a worker '''
+        try:
+            owner, _, _ = self.users[username]
+        except KeyError:
+            return
+        if owner == workerId:
+            del self.users[username]
+            self._relay(workerId, 'userLeft', username)
+
+    def remote_publish(self, workerId, username, presence):
+        ''' Called when the presence of a user on the worker has changed '''
+        try:
+            owner, hostname, _ = self.users[username]
+        except KeyError:
+            return
+        if owner == workerId:
+            self.users[username] = (owner, hostname, presence)
+            self._relay(workerId, 'presenceChanged', username, presence)
+
+    def _getLink(self, username):
+        ''' The link of the worker the user is connected to '''
+        try:
+            owner, _, _ = self.users[username]
+            return self.workers[owner]
+        except KeyError:
+            raise pb.Error('User %s isn\'t connected' % username)
+
+    def remote_route(self, username, method, args):
+        '''
+        Calls the method on the client of the user, wherever it is connected.
+        The result (or a deferred result) of the client is returned
+        '''
+        return self._getLink(username).callRemote('deliver', username,
+                                                  method, args)
+
+    def remote_queueHelp(self, username, args):
+        '''
+        Queues a help request with the cascader on the worker they are
+        connected to, the (deferred) answer of the cascader is returned
+        '''
+        return self._getLink(username).callRemote('queueHelp', username, args)
+
+    def remote_cancelHelp(self, username, helpId):
+        ''' Removes a help request that was queued with queueHelp '''
+        return self._getLink(username).callRemote('cancelHelp', username,
+                                                  helpId)
+
+
+class WorkerLink(pb.Referenceable):
+    '''
+    A workers connection to the broker. Changes from other workers are passed
+    to the functions given in the constructor
+    '''
+    def __init__(self, workerId, onUserJoined, onUserLeft,
+                 onPresenceChanged, deliver, onQueueHelp, onCancelHelp):
+        '''
+        onUserJoined - called with the username, workerId and hostname
+        onUserLeft - called with the username
+        onPresenceChanged - called with the username and presence
+        deliver - called with the username, method name and arguments, should
+                  call the method on the local client of that user
+        onQueueHelp - called with the username of a cascader on this worker
+                      and the arguments of a help request from another
+                      worker, should return the (deferred) answer
+        onCancelHelp - called with the username and helpId of a request
+                       from onQueueHelp that is no longer wanted
+        '''
+        self.workerId = workerId
+        self.onUserJoined = onUserJoined
+        self.onUserLeft = onUserLeft
+        self.onPresenceChanged = onPresenceChanged
+        self.deliver = deliver
+        self.onQueueHelp = onQueueHelp
+        self.onCancelHelp = onCancelHelp
+        self.broker = None
+
+    def connect(self, path=BROKER_SOCKET):
+        '''
+        Connects and registers with the broker, the returned deferred fires
+        when the users on other workers are known
+        '''
+        factory = pb.PBClientFactory()
+        reactor.connectUNIX(path, factory)
+        d = factory.getRootObject()
+        d.addCallback(self._register)
+        return d
+
+    def _register(self, broker):
+        self.broker = broker
+        broker.notifyOnDisconnect(self._onBrokerLost)
+        d = broker.callRemote('register', self, self.workerId)
+        d.addCallback(self._onRegistered)
+        return d
+
+    def _onRegistered(self, remoteUsers):
+        for username, workerId, hostname, presence in remoteUsers:
+            self.onUserJoined(username, workerId, hostname)
+            self.onPresenceChanged(username, presence)
+
+    def _onBrokerLost(self, broker):
+        ''' Without the broker the worker can't work, let the master restart it '''
+        logger.error('Lost the broker, stopping worker %s', self.workerId)
+        self.broker = None
+        try:
+            reactor.stop()
+        except ReactorNotRunning:
+            pass
+
+    def _call(self, method, *args):
+        if self.broker is None:
+            raise pb.DeadReferenceError('Not connected to the broker')
+        return self.broker.callRemote(method, *args)
+
+    def _send(self, method, *args):
+        ''' Calls the broker when we don't care about the result '''
+        d = self._call(method, *args)
+        d.addErrback(lambda reason: logger.debug('Broker call %s failed: %s',
+                                                 method,
+                                                 reason.getErrorMessage()))
+        return d
+
+    def claim(self, username, hostname):
+        return self._call('claim', self.workerId, username, hostname)
+
+    def release(self, username):
+        return self._send('release', self.workerId, username)
+
+    def publish(self, username, presence):
+        return self._send('publish', self.workerId, username, presence)
+
+    def route(self, username, method, args):
+        return self._call('route', username, method, args)
+
+    def queueHelp(self, username, args):
+        return self._call('queueHelp', username, args)
+
+    def cancelHelp(self, username, helpId):
+        return self._send('cancelHelp', username, helpId)
+
+    def remote_userJoined(self, username, workerId, hostname):
+        self.onUserJoined(username, workerId, hostname)
+
+    def remote_userLeft(self, username):
+        self.onUserLeft(username)
+
+    def remote_presenceChanged(self, username, presence):
+        self.onPresenceChanged(username, presence)
+
+    def remote_deliver(self, username, method, args):
+        return self.deliver(username, method, args)
+
+    def remote_queueHelp(self, username, args):
+        return self.onQueueHelp(username, args)
+
+    def remote_cancelHelp(self, username, helpId):
+        self.onCancelHelp(username, helpId)
+
+
+class RemoteClient(object):
+    '''
+    Stands in for the client reference of a user on another worker, calls
+    are routed through the broker
+    '''
+    def __init__(self, link, username):
+        self.link = link
+        self.username = username
+
+    def callRemote(self, method, *args):
+        return self.link.route(self.username, method, args)
+
+
+class RemoteUser(object):
+    '''
+    A user that is logged into another worker. This provides the parts of
+    UserService that other users use
+    '''
+    def __init__(self, link, user, hostname, workerId):
+        self.user = user
+        self.hostname = hostname
+        self.workerId = workerId
+        self.presence = None
+        self.client = RemoteClient(link, user)
+
+    def getPresence(self):
+        return self.presence
+
+#------------------------------------------------------------------------------
+# master process
+
+#workerId -> process transport of the running workers
+workerProcesses = {}
+
+class WorkerProcess(protocol.ProcessProtocol):
+    ''' Restarts the worker if it dies while the master is running '''
+    stopping = False
+
+    def __init__(self, workerId, listenFd, args):
+        self.workerId = workerId
+        self.listenFd = listenFd
+        self.args = args
+
+    def processEnded(self, reason):
+        workerProcesses.pop(self.workerId, None)
+        if WorkerProcess.stopping:
+            return
+        logger.warn('Worker %s exited: %s', self.workerId,
+                    reason.getErrorMessage())
+        reactor.callLater(1, spawnWorker, self.workerId,
+                          self.listenFd, self.args)
+
+def stopWorkers():
+    WorkerProcess.stopping = True
+    for process in workerProcesses.values():
+        try:
+            process.signalProcess('TERM')
+        except Exception:
+            pass
+
+def spawnWorker(workerId, listenFd, args):
+    '''
+    Runs the server script as a worker, sharing the listening socket
+
+    args - extra arguments for the worker
+    '''
+    script = os.path.abspath(sys.argv[0])
+    argv = [sys.executable, script,
+            '--worker-id', str(workerId),
+            '--listen-fd', str(listenFd)] + list(args)
+    process = reactor.spawnProcess(WorkerProcess(workerId, listenFd, args),
+                                   sys.executable, argv, env=os.environ,
+                                   childFDs={0 : 0, 1 : 1, 2 : 2,
+                                             listenFd : listenFd})
+    workerProcesses[workerId] = process
+    return process
+
+def runMaster(port, workerCount, args, path=BROKER_SOCKET):
+    '''
+    Starts the broker and the workers, the reactor still needs to be run
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    reactor.listenUNIX(path, pb.PBServerFactory(Broker()))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.listen(50)
+    sock.setblocking(False)
+
+    for workerId in xrange(workerCount):
+        spawnWorker(workerId, sock.fileno(), args)
+    reactor.addSystemEventTrigger('before', 'shutdown', stopWorkers)
+
+    #keep a reference so the socket isn't closed
+    return sock
+
+def adoptListeningSocket(listenFd, factory):
+    ''' Used by a worker to accept connections on the masters socket '''
+    port = reactor.adoptStreamPort(listenFd, socket.AF_INET, factory)
+    os.close(listenFd)
+    return port
@@ -0,0 +1,198 @@
+'''
+Checks that the clients connected to the server are still alive. Rather than
+every user having its own callLater loop, all users are kept in a hashed timer
+wheel that is turned by a single LoopingCall, each tick pinging the users in
+one slot of the wheel
+'''
+import time
+import logging
+
+from twisted.internet.task import LoopingCall
+
+logger = logging.getLogger('MyLogger')
+
+#bounds on how long a ping may take before the client is considered dead
+MIN_TIMEOUT = 10.0
+MAX_TIMEOUT = 60.0
+
+class RttEstimator(object):
+    '''
+    Smoothed round trip time estimate, using the same method as TCP
+    (RFC 6298) so that the timeout fits what has been measured
+
+    >>> rtt = RttEstimator(initialTimeout=30)
+    >>> rtt.getTimeout(1, 60)
+    30
+    >>> rtt.update(0.5)
+    >>> rtt.getTimeout(1, 60)
+    1.5
+    >>> rtt.getTimeout(10, 60)
+    10
+    '''
+    def __init__(self, initialTimeout):
+        self.initialTimeout = initialTimeout
+        self.srtt = None
+        self.rttvar = None
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def getTimeout(self, minimum, maximum):
+        if self.srtt is None:
+            timeout = self.initialTimeout
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        return max(minimum, min(maximum, timeout))
+
+
+class HeartbeatWheel(object):
+    '''
+    Pings every key once per interval and calls onDead for the keys that
+    don't respond within their timeout.
+
+    The wheel has interval/tick slots. A key lives in one slot and is pinged
+    each time the wheel reaches that slot. Outstanding pings are placed in
+    the slot their timeout expires in, so each tick only looks at the keys
+    that are due rather than at every user
+    '''
+
+    def __init__(self, ping, onDead, interval=120, tick=1.0,
+                 minTimeout=MIN_TIMEOUT, maxTimeout=MAX_TIMEOUT):
+        '''
+        ping - function taking a key, returns a deferred that fires when the
+               client responds. May raise if the client is known to be gone
+        onDead - function taking a key, called when a ping failed
+        interval - seconds between pings for each key
+        tick - seconds between turns of the wheel
+        '''
+        self.ping = ping
+        self.onDead = onDead
+        self.tick = tick
+        self.minTimeout = minTimeout
+        self.maxTimeout = min(maxTimeout, interval - tick)
+
+        self.slotCount = max(1, int(round(interval / tick)))
+        self.pingSlots = [set() for _ in xrange(self.slotCount)]
+        self.timeoutSlots = [set() for _ in xrange(self.slotCount)]
+        self.current = 0
+
+        #key -> slot it is pinged in
+        self.keySlot = {}
+        #key -> RttEstimator
+        self.rtts = {}
+        #key -> (ping sequence number, time sent)
+        self.outstanding = {}
+        self.sequence = 0
+
+        self.loop = LoopingCall(self.turn)
+
+        self.ticks = 0
+        self.lastTickTime = 0.0
+        self.maxTickTime = 0.0
+        self.totalTickTime = 0.0
+
+    def start(self):
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def add(self, key):
+        '''
+        Starts checking the key. It is placed in the slot just behind the
+        current one so its first ping is one interval away, spreading the
+        users who logged in at different times over the wheel
+        '''
+        self.remove(key)
+        slot = (self.current - 1) % self.slotCount
+        self.pingSlots[slot].add(key)
+        self.keySlot[key] = slot
+        self.rtts[key] = RttEstimator(self.maxTimeout)
+
+    def remove(self, key):
+        ''' Stops checking the key, any ping in flight is ignored '''
+        slot = self.keySlot.pop(key, None)
+        if slot is not None:
+            self.pingSlots[slot].discard(key)
+        self.rtts.pop(key, None)
+        self.outstanding.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.keySlot
+
+    def turn(self):
+        ''' Processes the slot the wheel is at and moves on '''
+        start = time.time()
+
+        slot = self.current
+        self.current = (self.current + 1) % self.slotCount
+
+        expired = self.timeoutSlots[slot]
+        self.timeoutSlots[slot] = set()
+        dead = [key for key, sequence in expired
+                if self.outstanding.get(key, (None,))[0] == sequence]
+
+        for key in list(self.pingSlots[slot]):
+            if key not in self.outstanding:
+                self._sendPing(key, slot)
+
+        for key in dead:
+            logger.debug('Ping to %s timed out', key)
+            self._dead(key)
+
+        elapsed = time.time() - start
+        self.ticks += 1
+        self.lastTickTime = elapsed
+        self.maxTickTime = max(self.maxTickTime, elapsed)
+        self.totalTickTime += elapsed
+
+    def _sendPing(self, key, slot):
+        self.sequence += 1
+        sequence = self.sequence
+
+        timeout = self.rtts[key].getTimeout(self.minTimeout, self.maxTimeout)
+        timeoutSlot = (slot + int(timeout / self.tick) + 1) % self.slotCount
+
+        self.outstanding[key] = (sequence, time.time())
+        self.timeoutSlots[timeoutSlot].add((key, sequence))
+        try:
+            d = self.ping(key)
+        except Exception:
+            self._dead(key)
+            return
+        d.addCallbacks(lambda _: self._onPong(key, sequence),
+                       lambda _: self._onPingFailed(key, sequence))
+
+    def _onPong(self, key, sequence):
+        try:
+            outSequence, sent = self.outstanding[key]
+        except KeyError:
+            return
+        if outSequence != sequence:
+            return
+        del self.outstanding[key]
+        self.rtts[key].update(time.time() - sent)
+
+    def _onPingFailed(self, key, sequence):
+        if self.outstanding.get(key, (None,))[0] == sequence:
+            self._dead(key)
+
+    def _dead(self, key):
+        self.remove(key)
+        self.onDead(key)
+
+    def getStats(self):
+        ''' Returns a dict of metrics about the wheel '''
+        return {'users' : len(self.keySlot),
+                'pendingPings' : len(self.outstanding),
+                'ticks' : self.ticks,
+                'lastTickTime' : self.lastTickTime,
+                'maxTickTime' : self.maxTickTime,
+                'meanTickTime' : (self.totalTickTime / self.ticks
+                                  if self.ticks else 0.0)}
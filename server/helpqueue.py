@@ -0,0 +1,194 @@
+'''
+Queues of help requests waiting for a cascader.
+
+The client shows each request as a modal dialog, so a cascader is only sent
+one request at a time and the rest wait on the server. The queue for each
+cascader has a maximum depth, beyond which requests are refused, and
+requests that wait too long are expired. Each asker is told their position
+whenever it changes. A request that is cancelled while the cascader is
+being asked can be withdrawn from them, so the next request goes ahead
+'''
+import bisect
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.spread import pb
+
+FIFO = 'fifo'
+PRIORITY = 'priority'
+ORDERINGS = (FIFO, PRIORITY)
+
+class HelpQueueFull(pb.Error):
+    ''' The cascader already has as many requests waiting as allowed '''
+    pass
+
+class HelpRequestExpired(pb.Error):
+    ''' The request waited too long for the cascader '''
+    pass
+
+
+class _Request(object):
+    def __init__(self, key, send, onPosition, withdraw):
+        self.key = key
+        self.send = send
+        self.onPosition = onPosition
+        self.withdraw = withdraw
+        self.position = None
+        self.deferred = None
+        self.expiry = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def notify(self, position):
+        if position != self.position:
+            self.position = position
+            if self.onPosition is not None:
+                self.onPosition(position)
+
+
+class HelpQueue(object):
+    '''
+    The requests for one cascader
+
+    >>> from twisted.internet import task
+    >>> clock = task.Clock()
+    >>> q = HelpQueue(depth=1, timeout=10, callLater=clock.callLater)
+    >>> answer = defer.Deferred()
+    >>> positions = []
+    >>> first = q.submit(lambda: answer, onPosition=positions.append)
+    >>> second = q.submit(lambda: defer.succeed((True, '')),
+    ...                   onPosition=positions.append)
+    >>> q.submit(lambda: None)
+    Traceback (most recent call last):
+    HelpQueueFull: Queue is full
+    >>> positions
+    [0, 1]
+    >>> answer.callback((False, 'busy'))
+    >>> positions, len(q)
+    ([0, 1, 0], 0)
+    >>> third = q.submit(lambda: defer.Deferred())
+    >>> fourth = q.submit(lambda: None)
+    >>> clock.advance(10)
+    >>> fourth.addErrback(lambda f: f.getErrorMessage()).result
+    'Waited 10s for the cascader'
+
+    Cancelling the request the cascader is being asked withdraws it
+    >>> q = HelpQueue(depth=1, timeout=10, callLater=clock.callLater)
+    >>> withdrawn = []
+    >>> first = q.submit(lambda: defer.Deferred(),
+    ...                  withdraw=lambda: withdrawn.append('first'))
+    >>> second = q.submit(lambda: defer.succeed((True, '')))
+    >>> first.cancel()
+    >>> withdrawn, second.result
+    (['first'], (True, ''))
+    >>> first.addErrback(lambda f: f.check(defer.CancelledError)).result
+    <class 'twisted.internet.defer.CancelledError'>
+    '''
+    def __init__(self, depth=5, ordering=FIFO, timeout=300, callLater=None,
+                 onEmpty=None):
+        '''
+        depth - the most requests that can be waiting, not including the
+                one that the cascader is answering
+        ordering - FIFO, or PRIORITY to serve the lowest priority first
+        timeout - seconds a request can wait before it expires
+        onEmpty - called when the last request has finished
+        '''
+        if callLater is None:
+            from twisted.internet import reactor
+            callLater = reactor.callLater
+        self.depth = depth
+        self.ordering = ordering
+        self.timeout = timeout
+        self.callLater = callLater
+        self.onEmpty = onEmpty
+
+        self.waiting = []
+        self.active = None
+        self.count = 0
+
+    def __len__(self):
+        return len(self.waiting) + (self.active is not None)
+
+    def submit(self, send, priority=0, onPosition=None, withdraw=None):
+        '''
+        Adds a request to the queue. Returns a deferred firing with the
+        result of the deferred returned by send, which is called when it is
+        the requests turn. Cancelling the deferred removes the request.
+
+        onPosition - called with the position of the request whenever it
+                     changes, 0 is being answered by the cascader
+        withdraw - called if the request is cancelled while the cascader is
+                   being asked, their answer is then ignored and the next
+                   request is sent. Without it the request is left with the
+                   cascader until they answer
+        '''
+        if len(self.waiting) >= self.depth:
+            raise HelpQueueFull('Queue is full')
+
+        self.count += 1
+        key = (priority if self.ordering == PRIORITY else 0, self.count)
+        request = _Request(key, send, onPosition, withdraw)
+        request.deferred = defer.Deferred(lambda _: self._cancel(request))
+        request.expiry = self.callLater(self.timeout, self._expire, request)
+        bisect.insort(self.waiting, request)
+
+        d = request.deferred
+        self._advance()
+        return d
+
+    def _advance(self):
+        ''' Sends the next request if the cascader is free '''
+        while self.active is None and self.waiting:
+            request = self.waiting.pop(0)
+            request.expiry.cancel()
+            self.active = request
+            request.notify(0)
+            try:
+                d = request.send()
+            except Exception:
+                self.active = None
+                request.deferred.errback(failure.Failure())
+                continue
+            d.addBoth(self._finished, request)
+
+        for i, request in enumerate(self.waiting):
+            request.notify(i + 1)
+
+        if not self and self.onEmpty is not None:
+            self.onEmpty()
+
+    def _finished(self, result, request):
+        if request is not self.active:
+            #it was withdrawn, the cascader has already moved on
+            return
+        self.active = None
+        if not request.deferred.called:
+            if isinstance(result, failure.Failure):
+                request.deferred.errback(result)
+            else:
+                request.deferred.callback(result)
+        self._advance()
+
+    def _remove(self, request):
+        if request in self.waiting:
+            self.waiting.remove(request)
+            self._advance()
+
+    def _cancel(self, request):
+        '''
+        A request with the cascader is withdrawn if it can be, otherwise it
+        is left to be answered
+        '''
+        if request is not self.active:
+            request.expiry.cancel()
+            self._remove(request)
+        elif request.withdraw is not None:
+            self.active = None
+            request.withdraw()
+            self._advance()
+
+    def _expire(self, request):
+        self._remove(request)
+        request.deferred.errback(HelpRequestExpired('Waited %ds for the '
+                                                    'cascader' % self.timeout))
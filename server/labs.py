@@ -0,0 +1,104 @@
+'''
+Lab information for the server. This reads the same hosts file that the
+client uses to draw its maps, so that the server can reason about which
+lab a cascader is sitting in and how far apart two hosts are
+'''
+from __future__ import with_statement
+
+import ConfigParser as configparser
+import math
+import os
+
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+#the client ships the canonical copy of the hosts file
+HOSTS_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'client', 'cascaders', 'data', 'hosts')
+
+#distance between hosts in different labs, in seats
+OTHER_LAB_DISTANCE = 100
+
+#distance to or from a host that isn't in the hosts file
+UNKNOWN_DISTANCE = 200
+
+class LabIndex(object):
+    '''
+    Maps hostnames to labs. This uses the same format (and parser) as
+    labmap.Locator on the client, that is a section per lab and a
+    list of host:x,y entries
+
+    >>> from StringIO import StringIO
+    >>> index = LabIndex(StringIO('[lab1]\\na:0,0\\nb:3,4\\n[lab2]\\nc:0,0\\n'))
+    >>> index.labFromHostname('b'), index.getLocation('b')
+    ('lab1', (3, 4))
+    >>> index.distance('a', 'b'), index.distance('a', 'c')
+    (5.0, 100)
+    '''
+    def __init__(self, fileHandle=None):
+        '''
+        fileHandle - a file like object that holds the data, if None then
+        the index is empty and every host is in no lab
+        '''
+        self.hostsLab = {}
+        self.hostsLocation = {}
+        self.labs = []
+        #in the order they are in the file
+        self.hosts = []
+
+        if fileHandle is not None:
+            hosts = configparser.ConfigParser()
+            hosts.readfp(fileHandle)
+            for lab in hosts.sections():
+                self.labs.append(lab)
+                for hostname, location in hosts.items(lab):
+                    self.hosts.append(hostname)
+                    self.hostsLab[hostname] = lab
+                    self.hostsLocation[hostname] = self._parseLocation(location)
+
+    def _parseLocation(self, location):
+        x, y = location.split(',')
+        return int(x.strip()), int(y.strip())
+
+    def getLabs(self):
+        return self.labs
+
+    def getHosts(self):
+        return self.hosts
+
+    def labFromHostname(self, hostname):
+        try:
+            return self.hostsLab[hostname]
+        except KeyError:
+            return None
+
+    def getLocation(self, hostname):
+        ''' Returns the (x, y) of the host in its lab, or None '''
+        return self.hostsLocation.get(hostname)
+
+    def distance(self, hostA, hostB):
+        '''
+        How far apart two hosts are in seats. Hosts in different labs are
+        OTHER_LAB_DISTANCE apart
+        '''
+        labA = self.labFromHostname(hostA)
+        labB = self.labFromHostname(hostB)
+        if labA is None or labB is None:
+            return UNKNOWN_DISTANCE
+        if labA != labB:
+            return OTHER_LAB_DISTANCE
+        (xa, ya), (xb, yb) = self.hostsLocation[hostA], self.hostsLocation[hostB]
+        return math.hypot(xa - xb, ya - yb)
+
+def loadLabIndex(filename=HOSTS_FILENAME):
+    '''
+    Loads the lab index from the given file, if the file doesn't exist then
+    an empty index is returned so the server still functions
+    '''
+    try:
+        with open(filename) as fh:
+            return LabIndex(fh)
+    except IOError:
+        logger.warn('Couldn\'t read hosts file %s, labs are unknown', filename)
+        return LabIndex()
@@ -0,0 +1,122 @@
+'''
+Picks which cascader a help request should go to, so that students don't
+have to choose one themselves and popular cascaders don't get every request.
+
+Cascaders are indexed by subject. The candidates for a request are scored on
+how far they are sitting from the student and how many requests they are
+already dealing with, the lowest score is asked first
+'''
+from collections import defaultdict
+
+from twisted.internet import defer
+
+#how many seats further away a cascader can be than another who is dealing
+#with one more request, and still be asked first
+LOAD_COST = 20
+
+#seconds a cascader is assumed to be busy for after accepting a request
+HELP_SESSION_LENGTH = 15 * 60
+
+class HelpMatcher(object):
+    '''
+    >>> from labs import LabIndex
+    >>> from StringIO import StringIO
+    >>> labs = LabIndex(StringIO('[lab]\\na:0,0\\nb:1,0\\nc:5,0\\n'))
+    >>> m = HelpMatcher(labs, clock=lambda: 0)
+    >>> m.update('near', ('lab', 'b', frozenset(['inf2b'])))
+    >>> m.update('far', ('lab', 'c', frozenset(['inf2b', 'Java'])))
+    >>> m.candidates('inf2b', 'a')
+    ['near', 'far']
+    >>> m.requestStarted('near'); m.requestFinished('near', True)
+    >>> m.candidates('inf2b', 'a')
+    ['far', 'near']
+    >>> m.update('far', None)
+    >>> m.candidates('inf2b', 'a', exclude=['near'])
+    []
+    '''
+    def __init__(self, labIndex, clock=None):
+        self.labIndex = labIndex
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor.seconds
+        self.clock = clock
+
+        #subject -> usernames of cascaders with that subject
+        self.bySubject = defaultdict(set)
+        #username -> presence, for everyone that is cascading
+        self.presence = {}
+
+        #username -> number of requests waiting for an answer
+        self.pending = defaultdict(int)
+        #username -> times that requests were accepted
+        self.accepted = defaultdict(list)
+
+    def update(self, username, presence):
+        ''' Called with the new presence of a user whenever it changes '''
+        old = self.presence.pop(username, None)
+        if old is not None:
+            for subject in old[2]:
+                self.bySubject[subject].discard(username)
+                if not self.bySubject[subject]:
+                    del self.bySubject[subject]
+        if presence is not None:
+            self.presence[username] = presence
+            for subject in presence[2]:
+                self.bySubject[subject].add(username)
+
+    def getLoad(self, username):
+        ''' Requests being answered plus requests accepted recently '''
+        accepted = self.accepted.get(username)
+        if accepted:
+            since = self.clock() - HELP_SESSION_LENGTH
+            accepted[:] = [t for t in accepted if t > since]
+            if not accepted:
+                del self.accepted[username]
+        return self.pending.get(username, 0) + len(accepted or ())
+
+    def candidates(self, subject, hostname, exclude=()):
+        ''' Usernames of the cascaders for the subject, best first '''
+        scored = []
+        for username in self.bySubject.get(subject, ()):
+            if username in exclude:
+                continue
+            cascaderHost = self.presence[username][1]
+            score = (self.labIndex.distance(hostname, cascaderHost) +
+                     self.getLoad(username) * LOAD_COST)
+            scored.append((score, username))
+        scored.sort()
+        return [username for _, username in scored]
+
+    def requestStarted(self, username):
+        self.pending[username] += 1
+
+    def requestFinished(self, username, accepted):
+        self.pending[username] -= 1
+        if self.pending[username] <= 0:
+            del self.pending[username]
+        if accepted:
+            self.accepted[username].append(self.clock())
+
+
+def withTimeout(d, timeout, callLater):
+    '''
+    Returns a deferred that fires with the result of d, or fails with
+    defer.TimeoutError if d hasn't fired after timeout seconds, in which
+    case d is cancelled. A late result of d is ignored
+    '''
+    result = defer.Deferred()
+    def onTimeout():
+        d.cancel()
+        result.errback(defer.TimeoutError('No answer after %ds' % timeout))
+    delayed = callLater(timeout, onTimeout)
+
+    def onResult(value):
+        if delayed.active():
+            delayed.cancel()
+            result.callback(value)
+    def onError(reason):
+        if delayed.active():
+            delayed.cancel()
+            result.errback(reason)
+    d.addCallbacks(onResult, onError)
+    return result
@@ -0,0 +1,288 @@
+'''
+Classes that deal with who should be told about cascaders. Clients subscribe
+to the subjects and labs that they are filtering on and only get told about
+the cascaders that they would display
+'''
+from collections import defaultdict, deque
+import uuid
+
+class SubscriptionIndex(object):
+    '''
+    Index of subscribers keyed by subject and by lab. A subscription of None
+    for either the subjects or the labs is a wildcard and matches everything,
+    which is the same as not filtering at all
+
+    Subscribers are identified by a key (the username on the server)
+
+    >>> si = SubscriptionIndex()
+    >>> si.subscribe('all')
+    >>> si.subscribe('fp', subjects=['inf1-fp'])
+    >>> si.subscribe('at', labs=['Appleton Tower'])
+    >>> sorted(si.subscribers('Appleton Tower', set(['inf1-fp'])))
+    ['all', 'at', 'fp']
+    >>> sorted(si.subscribers('Level 5 North', set(['inf1-fp'])))
+    ['all', 'fp']
+    >>> sorted(si.subscribers(None, set(['Java'])))
+    ['all']
+    >>> si.matches('fp', 'Level 5 North', set(['inf1-fp', 'Java']))
+    True
+    >>> si.unsubscribe('fp')
+    >>> sorted(si.subscribers('Level 5 North', set(['inf1-fp'])))
+    ['all']
+    '''
+
+    def __init__(self):
+        self.bySubject = defaultdict(set)
+        self.byLab = defaultdict(set)
+
+        #subscribers that don't filter on subjects or labs respectively
+        self.anySubject = set()
+        self.anyLab = set()
+
+        #subscriber -> (subjects, labs)
+        self.subscriptions = {}
+
+    def subscribe(self, key, subjects=None, labs=None):
+        '''
+        Replaces any current subscription for the key
+
+        subjects - iterable of subjects or None for all subjects
+        labs - iterable of labs or None for all labs
+        '''
+        self.unsubscribe(key)
+
+        subjects = frozenset(subjects) if subjects is not None else None
+        labs = frozenset(labs) if labs is not None else None
+        self.subscriptions[key] = (subjects, labs)
+
+        if subjects is None:
+            self.anySubject.add(key)
+        else:
+            for subject in subjects:
+                self.bySubject[subject].add(key)
+
+        if labs is None:
+            self.anyLab.add(key)
+        else:
+            for lab in labs:
+                self.byLab[lab].add(key)
+
+    def unsubscribe(self, key):
+        try:
+            subjects, labs = self.subscriptions.pop(key)
+        except KeyError:
+            return
+
+        if subjects is None:
+            self.anySubject.discard(key)
+        else:
+            for subject in subjects:
+                self._discard(self.bySubject, subject, key)
+
+        if labs is None:
+            self.anyLab.discard(key)
+        else:
+            for lab in labs:
+                self._discard(self.byLab, lab, key)
+
+    def _discard(self, index, value, key):
+        ''' Removes the key from the index, dropping empty entries '''
+        keys = index[value]
+        keys.discard(key)
+        if not keys:
+            del index[value]
+
+    def getSubscription(self, key):
+        ''' Returns the (subjects, labs) tuple, with None being a wildcard '''
+        return self.subscriptions.get(key, (None, None))
+
+    def matches(self, key, lab, subjects):
+        '''
+        Checks if the subscriber would be interested in a cascader in the
+        given lab with the given subjects
+        '''
+        try:
+            subSubjects, subLabs = self.subscriptions[key]
+        except KeyError:
+            return False
+        if subLabs is not None and lab not in subLabs:
+            return False
+        if subSubjects is not None and subSubjects.isdisjoint(subjects):
+            return False
+        return True
+
+    def subscribers(self, lab, subjects):
+        '''
+        Returns the set of keys that are interested in a cascader in the
+        given lab with the given subjects
+        '''
+        bySubject = set(self.anySubject)
+        for subject in subjects:
+            keys = self.bySubject.get(subject)
+            if keys:
+                bySubject.update(keys)
+
+        if not bySubject:
+            return bySubject
+
+        byLab = self.anyLab
+        keys = self.byLab.get(lab)
+        if keys:
+            byLab = byLab | keys
+        return bySubject & byLab
+
+
+class PresenceLog(object):
+    '''
+    Gives the presence state a version that increases on every change and
+    keeps a bounded log of who changed at each version, so that a client
+    that knows the version it last saw can be sent just what has changed.
+
+    Versions are a tuple of (epoch, counter). The epoch is unique to this log
+    so versions handed out by a previous server are never mistaken for ours
+
+    >>> log = PresenceLog(size=2)
+    >>> start = log.getVersion()
+    >>> log.changed('a')
+    >>> log.changedSince(start)
+    set(['a'])
+    >>> log.changedSince(log.getVersion())
+    set([])
+    >>> log.changed('b')
+    >>> log.changed('c')
+    >>> log.changedSince(start) is None
+    True
+    >>> log.changedSince(('someoneelse', 0)) is None
+    True
+    '''
+
+    def __init__(self, size=1024):
+        self.epoch = uuid.uuid4().hex
+        self.counter = 0
+        #(counter, username), oldest first
+        self.log = deque(maxlen=size)
+
+    def getVersion(self):
+        return (self.epoch, self.counter)
+
+    def changed(self, username):
+        self.counter += 1
+        self.log.append((self.counter, username))
+
+    def changedSince(self, version):
+        '''
+        Returns the set of usernames that changed after the given version or
+        None if that can't be worked out, because the version is from a
+        different epoch or is older than anything in the log
+        '''
+        if version is None:
+            return None
+        epoch, since = version
+        if epoch != self.epoch or since > self.counter:
+            return None
+        if since == self.counter:
+            return set()
+        if not self.log or self.log[0][0] > since + 1:
+            return None
+
+        usernames = set()
+        for counter, username in reversed(self.log):
+            if counter <= since:
+                break
+            usernames.add(username)
+        return usernames
+
+
+class PresenceBroadcaster(object):
+    '''
+    Collects presence changes over a short window and then sends each
+    subscribed client a single delta holding the changes it is interested in.
+
+    Only the presence of a cascader before the first change in a window and
+    its presence when the window is flushed are compared, so superseded
+    changes are dropped (a join followed by a leave sends nothing).
+
+    A presence is either None (not cascading) or a tuple of
+    (lab, hostname, subjects). The delta sent is state based rather than
+    a list of operations, so applying it twice is harmless
+
+    Every change is also recorded in the PresenceLog and deltas are sent
+    with the version they bring the client up to
+    '''
+
+    def __init__(self, subscriptions, log, getPresence, deliver,
+                 callLater, window=0.1, onFlushed=None):
+        '''
+        subscriptions - the SubscriptionIndex used to find who is interested
+        log - the PresenceLog that changes are recorded in
+        getPresence - function taking a username, returning the presence now
+        deliver - function taking a subscriber key, the version, a list of
+                  (username, hostname, subjects) that changed and a list of
+                  usernames that the subscriber can no longer see
+        callLater - function used to schedule the flush, such as
+                    reactor.callLater
+        window - time in seconds that changes are collected over
+        onFlushed - optional function called with the username and the new
+                    presence of every user whose presence changed
+        '''
+        self.subscriptions = subscriptions
+        self.log = log
+        self.getPresence = getPresence
+        self.deliver = deliver
+        self.callLater = callLater
+        self.window = window
+        self.onFlushed = onFlushed
+
+        #username -> presence before the first change in this window
+        self.pending = {}
+        self.delayedFlush = None
+
+    def changed(self, username, before):
+        '''
+        Records that the presence of the user is about to change or has
+        changed from before.
+        '''
+        self.log.changed(username)
+        if username not in self.pending:
+            self.pending[username] = before
+        if self.delayedFlush is None:
+            self.delayedFlush = self.callLater(self.window, self.flush)
+
+    def _seenBy(self, presence):
+        if presence is None:
+            return set()
+        lab, _, subjects = presence
+        return self.subscriptions.subscribers(lab, subjects)
+
+    def flush(self):
+        ''' Sends the changes collected since the last flush '''
+        if self.delayedFlush is not None and self.delayedFlush.active():
+            self.delayedFlush.cancel()
+        self.delayedFlush = None
+
+        pending, self.pending = self.pending, {}
+
+        changed = defaultdict(list)
+        left = defaultdict(list)
+        for username, before in pending.iteritems():
+            after = self.getPresence(username)
+            if before == after:
+                continue
+            if self.onFlushed is not None:
+                self.onFlushed(username, after)
+
+            seenBefore = self._seenBy(before)
+            seenAfter = self._seenBy(after)
+
+            if after is not None:
+                _, hostname, subjects = after
+                entry = (username, hostname, set(subjects))
+                for key in seenAfter:
+                    changed[key].append(entry)
+
+            for key in seenBefore - seenAfter:
+                left[key].append(username)
+
+        version = self.log.getVersion()
+        for key in set(changed) | set(left):
+            self.deliver(key, version, changed.get(key, []), left.get(key, []))
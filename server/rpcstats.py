@@ -0,0 +1,207 @@
+'''
+Counts and times the calls made to and by the server, so that the methods
+that are hot or slow can be found.
+
+Remote methods are instrumented by decorating the class with
+RpcStats.instrument, which wraps every remote_ method. Calls to clients are
+instrumented by wrapping the client reference with RpcStats.wrapReference,
+which times each callRemote until its deferred fires.
+
+For each method this records the number of calls, errors, how often the
+client was gone (DeadReferenceError), a histogram of the latency and the
+approximate size of the arguments
+'''
+import time
+import bisect
+import functools
+
+from twisted.internet import defer
+from twisted.spread import pb
+
+#upper bounds of the latency buckets in seconds, the last bucket is anything
+#longer than the last bound
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+    '''
+    Counts values into fixed buckets
+
+    >>> h = Histogram((1, 10, 100))
+    >>> for v in (0.5, 5, 5, 50, 500):
+    ...     h.add(v)
+    >>> h.counts
+    [1, 2, 1, 1]
+    >>> h.percentile(0.5), h.percentile(0.99), h.max
+    (10, None, 500)
+    '''
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        '''
+        Returns the upper bound of the bucket holding the percentile, or None
+        if that is the last bucket, which has no upper bound
+        '''
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.bounds[i] if i < len(self.bounds) else None
+        return None
+
+    def mean(self):
+        return self.total / float(self.count) if self.count else 0
+
+
+def payloadSize(value):
+    '''
+    Rough size of a value once sent, this is much cheaper than encoding it
+
+    >>> payloadSize(('user', ['a', 'bc'], None))
+    21
+    '''
+    if isinstance(value, basestring):
+        return len(value) + 2
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 2 + sum(payloadSize(v) for v in value)
+    if isinstance(value, dict):
+        return 2 + sum(payloadSize(k) + payloadSize(v)
+                       for k, v in value.iteritems())
+    return 4
+
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.deadReferences = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def getStats(self):
+        toMs = lambda v: v * 1000 if v is not None else None
+        return {'calls' : self.calls,
+                'errors' : self.errors,
+                'deadReferences' : self.deadReferences,
+                'deadReferenceRate' : (self.deadReferences / float(self.calls)
+                                       if self.calls else 0),
+                'bytes' : self.bytes,
+                'meanBytes' : (self.bytes / float(self.calls)
+                               if self.calls else 0),
+                'meanMs' : toMs(self.latency.mean()),
+                'p50Ms' : toMs(self.latency.percentile(0.5)),
+                'p99Ms' : toMs(self.latency.percentile(0.99)),
+                'maxMs' : toMs(self.latency.max),
+                'histogram' : zip([toMs(b) for b in self.latency.bounds]
+                                  + [None], self.latency.counts)}
+
+
+class RpcStats(object):
+    '''
+    The stats for calls to the server (incoming) and calls the server makes
+    to clients (outgoing), keyed by method name
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.incoming = {}
+        self.outgoing = {}
+        self.started = clock()
+
+    def _getMethod(self, methods, name):
+        try:
+            return methods[name]
+        except KeyError:
+            stats = methods[name] = MethodStats()
+            return stats
+
+    def _finish(self, stats, start, d):
+        ''' Records the latency and outcome once the deferred fires '''
+        def onResult(result):
+            stats.latency.add(self.clock() - start)
+            return result
+        def onError(reason):
+            stats.latency.add(self.clock() - start)
+            stats.errors += 1
+            if reason.check(pb.DeadReferenceError, pb.PBConnectionLost):
+                stats.deadReferences += 1
+            return reason
+        d.addCallbacks(onResult, onError)
+        return d
+
+    def _record(self, methods, name, function, args, kwargs):
+        stats = self._getMethod(methods, name)
+        stats.calls += 1
+        stats.bytes += payloadSize(args) + payloadSize(kwargs)
+
+        start = self.clock()
+        try:
+            result = function(*args, **kwargs)
+        except pb.DeadReferenceError:
+            stats.errors += 1
+            stats.deadReferences += 1
+            stats.latency.add(self.clock() - start)
+            raise
+        except Exception:
+            stats.errors += 1
+            stats.latency.add(self.clock() - start)
+            raise
+
+        if isinstance(result, defer.Deferred):
+            return self._finish(stats, start, result)
+        stats.latency.add(self.clock() - start)
+        return result
+
+    def instrument(self, cls):
+        ''' Class decorator that wraps all the remote_ methods of a class '''
+        for attr in dir(cls):
+            if not attr.startswith('remote_'):
+                continue
+            method = getattr(cls, attr)
+            setattr(cls, attr, self._wrapMethod(attr[len('remote_'):], method))
+        return cls
+
+    def _wrapMethod(self, name, method):
+        @functools.wraps(method)
+        def wrapper(instance, *args, **kwargs):
+            return self._record(self.incoming, name,
+                                lambda *a, **kw: method(instance, *a, **kw),
+                                args, kwargs)
+        return wrapper
+
+    def wrapReference(self, reference):
+        ''' Returns the reference with callRemote instrumented '''
+        return InstrumentedReference(self, reference)
+
+    def getStats(self):
+        return {'uptime' : self.clock() - self.started,
+                'incoming' : dict((name, stats.getStats())
+                                  for name, stats in self.incoming.iteritems()),
+                'outgoing' : dict((name, stats.getStats())
+                                  for name, stats in self.outgoing.iteritems())}
+
+
+class InstrumentedReference(object):
+    ''' A remote reference that records the calls made through it '''
+    def __init__(self, stats, reference):
+        self.stats = stats
+        self.reference = reference
+
+    def callRemote(self, method, *args, **kwargs):
+        call = lambda *a, **kw: self.reference.callRemote(method, *a, **kw)
+        return self.stats._record(self.stats.outgoing, method, call,
+                                  args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.reference, name)
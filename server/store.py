@@ -0,0 +1,188 @@
+'''
+Where the presence of logged in users is kept. The in memory store is used
+by default, the SQLite store also writes everything to disk so that a server
+that is restarted can start with the presence it had before and serve
+getCascaderList while the clients reconnect
+'''
+import json
+import time
+import sqlite3
+import threading
+import Queue
+import logging
+
+from twisted.spread import pb
+
+logger = logging.getLogger('MyLogger')
+
+class PresenceStore(object):
+    '''
+    Interface for the presence stores. Each user has a row, which is a tuple
+    of (hostname, cascading, subjects)
+    '''
+    def get(self, username):
+        ''' Returns the row for the user or None '''
+        raise NotImplementedError
+
+    def getAll(self):
+        ''' Returns a list of (username, row) '''
+        raise NotImplementedError
+
+    def set(self, username, hostname, cascading, subjects):
+        raise NotImplementedError
+
+    def remove(self, username):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryPresenceStore(PresenceStore):
+    '''
+    >>> store = MemoryPresenceStore()
+    >>> store.set('user', 'host', True, ['a'])
+    >>> store.get('user')
+    ('host', True, frozenset(['a']))
+    >>> store.remove('user')
+    >>> store.getAll()
+    []
+    '''
+    def __init__(self):
+        self.rows = {}
+
+    def get(self, username):
+        return self.rows.get(username)
+
+    def getAll(self):
+        return self.rows.items()
+
+    def set(self, username, hostname, cascading, subjects):
+        self.rows[username] = (hostname, bool(cascading), frozenset(subjects))
+
+    def remove(self, username):
+        self.rows.pop(username, None)
+
+
+class SqlitePresenceStore(MemoryPresenceStore):
+    '''
+    Reads are served from memory, but every change is also written to a
+    SQLite database using its write ahead log. The database is written by
+    a background thread which commits the changes made over commitInterval
+    seconds in one transaction, only keeping the last change for each user
+    '''
+
+    _stop = object()
+
+    def __init__(self, filename, commitInterval=1.0):
+        MemoryPresenceStore.__init__(self)
+        self.filename = filename
+        self.commitInterval = commitInterval
+
+        conn = self._connect()
+        try:
+            for username, hostname, cascading, subjects in conn.execute(
+                    'SELECT username, hostname, cascading, subjects '
+                    'FROM presence'):
+                subjects = [s.encode('utf-8') for s in json.loads(subjects)]
+                self.rows[username] = (hostname, bool(cascading),
+                                       frozenset(subjects))
+        finally:
+            conn.close()
+        logger.info('Loaded the presence of %d users from %s',
+                    len(self.rows), filename)
+
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run,
+                                       name='SqlitePresenceStore')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.filename)
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS presence ('
+                     'username TEXT PRIMARY KEY, '
+                     'hostname TEXT, '
+                     'cascading INTEGER, '
+                     'subjects TEXT)')
+        conn.commit()
+        return conn
+
+    def set(self, username, hostname, cascading, subjects):
+        MemoryPresenceStore.set(self, username, hostname, cascading, subjects)
+        self.queue.put((username, self.rows[username]))
+
+    def remove(self, username):
+        MemoryPresenceStore.remove(self, username)
+        self.queue.put((username, None))
+
+    def _getBatch(self):
+        ''' Waits for a change, then collects changes for commitInterval '''
+        batch = [self.queue.get()]
+        deadline = time.time() + self.commitInterval
+        while batch[-1] is not self._stop:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(True, remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = self._getBatch()
+
+            #only the last change to each user matters
+            changes = dict(c for c in batch if c is not self._stop)
+            try:
+                for username, row in changes.iteritems():
+                    if row is None:
+                        conn.execute('DELETE FROM presence WHERE username = ?',
+                                     (username,))
+                    else:
+                        hostname, cascading, subjects = row
+                        conn.execute('INSERT OR REPLACE INTO presence '
+                                     'VALUES (?, ?, ?, ?)',
+                                     (username, hostname, int(cascading),
+                                      json.dumps(sorted(subjects))))
+                conn.commit()
+            except sqlite3.Error:
+                logger.exception('Failed to write presence to %s',
+                                 self.filename)
+
+            if self._stop in batch:
+                conn.close()
+                return
+
+    def close(self):
+        ''' Writes anything outstanding and stops the thread '''
+        if self.thread.isAlive():
+            self.queue.put(self._stop)
+            self.thread.join()
+
+
+class DisconnectedClient(object):
+    ''' Client reference for a user that hasn't reconnected yet '''
+    def callRemote(self, method, *args):
+        raise pb.DeadReferenceError('Client hasn\'t reconnected')
+
+
+class DetachedUser(object):
+    '''
+    A user loaded from the store when the server started who hasn't logged
+    back in yet. This provides the parts of UserService that other users use
+    '''
+    def __init__(self, user, hostname, presence):
+        self.user = user
+        self.hostname = hostname
+        self.presence = presence
+        self.client = DisconnectedClient()
+
+    def getPresence(self):
+        return self.presence
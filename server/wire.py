@@ -0,0 +1,103 @@
+'''
+Compact encoding of presence for sending to clients.
+
+Rather than sending the hostname and a set of subject names for every
+cascader, subjects and hosts are given integer ids. Subjects are sent as a
+bitmask of their ids and hosts as their id. The tables of ids are sent to
+the client once when it asks for the compact encoding, apart from the
+hosts, which the client already has in its copy of data/hosts. The client
+sends a digest of its hosts and is only sent the table if they differ.
+
+Anything that isn't in the tables is sent as it was before, a hostname
+string or a list of subjects, so the client can tell the two apart by type.
+
+Subjects added to the catalog while the server is running are given the
+next ids, so the ids a client already has stay the same. Each client is
+only sent ids it has the table for, anything newer is sent as a list
+until it asks for the tables again
+'''
+import hashlib
+
+def hostsDigest(hosts):
+    '''
+    Digest of a list of hosts, both sides should compute this the same way
+
+    >>> hostsDigest(['a', 'b']) == hostsDigest(['a', 'b'])
+    True
+    >>> hostsDigest(['a', 'b']) == hostsDigest(['b', 'a'])
+    False
+    '''
+    return hashlib.md5('\n'.join(hosts)).hexdigest()
+
+
+class WireTables(object):
+    '''
+    >>> tables = WireTables(['b', 'a', 'c'], ['host1', 'host2'])
+    >>> tables.subjects
+    ['a', 'b', 'c']
+    >>> tables.encode(('user', 'host2', set(['a', 'c'])))
+    ('user', 1, 5)
+    >>> tables.encode(('user', 'unknown', set(['a', 'd'])))
+    ('user', 'unknown', ['a', 'd'])
+    >>> tables.addSubjects(['d', 'a'])
+    >>> tables.subjects
+    ['a', 'b', 'c', 'd']
+    >>> tables.encode(('user', 'host1', set(['a', 'd'])), subjectCount=3)
+    ('user', 0, ['a', 'd'])
+    >>> tables.encode(('user', 'host1', set(['a', 'd'])))
+    ('user', 0, 9)
+    '''
+    def __init__(self, subjects, hosts):
+        '''
+        subjects - the subjects that can be cascaded, the ids are their
+                   position once sorted, see addSubjects for later ones
+        hosts - the hosts in the order they are in data/hosts
+        '''
+        self.subjects = sorted(subjects)
+        self.hosts = list(hosts)
+        self.digest = hostsDigest(self.hosts)
+
+        self.subjectIds = dict((s, i) for i, s in enumerate(self.subjects))
+        self.hostIds = dict((h, i) for i, h in enumerate(self.hosts))
+
+    def addSubjects(self, subjects):
+        '''
+        Gives the subjects that don't have ids the ids after the existing
+        ones. Subjects are never removed, so the ids don't change
+        '''
+        for subject in sorted(subjects):
+            if subject not in self.subjectIds:
+                self.subjectIds[subject] = len(self.subjects)
+                self.subjects.append(subject)
+
+    def getTables(self, clientDigest):
+        '''
+        Returns the (subjects, hosts) for the client, hosts is None if the
+        client already has the same hosts
+        '''
+        hosts = None if clientDigest == self.digest else self.hosts
+        return list(self.subjects), hosts
+
+    def encodeHost(self, hostname):
+        return self.hostIds.get(hostname, hostname)
+
+    def encodeSubjects(self, subjects, subjectCount=None):
+        '''
+        subjectCount - the number of subjects in the table the client has,
+                       None if it has all of them
+        '''
+        if subjectCount is None:
+            subjectCount = len(self.subjects)
+        mask = 0
+        for subject in subjects:
+            subjectId = self.subjectIds.get(subject, subjectCount)
+            if subjectId >= subjectCount:
+                return sorted(subjects)
+            mask |= 1 << subjectId
+        return mask
+
+    def encode(self, entry, subjectCount=None):
+        ''' Encodes a (username, hostname, subjects) tuple '''
+        username, hostname, subjects = entry
+        return (username, self.encodeHost(hostname),
+                self.encodeSubjects(subjects, subjectCount))